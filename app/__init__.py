@@ -1,12 +1,12 @@
 # Third-party imports
 from flask import Flask
 from flask_bootstrap import Bootstrap
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_migrate import Migrate
 
 # Local imports
 from config import app_config
+from .database import SQLAlchemy
 
 db = SQLAlchemy()
 login_manager = LoginManager()
@@ -29,7 +29,28 @@ def create_app():
     login_manager.login_message = "You must be logged in to access this page."
     login_manager.login_view = "auth.login"
     migrate.init_app(app, db)
+    from .hashing import password_hasher
+    password_hasher.init_app(app)
     from . import models
+    from .jobs import job_runner
+    job_runner.init_app(app)
+    from .user_cache import user_cache
+    user_cache.init_app(app)
+    from . import changes, rollups, search
+    rollups.rollup_folder.init_app(app)
+    from .board import room_board
+    room_board.init_app(app)
+    from .fragments import fragment_cache
+    fragment_cache.init_app(app)
+
+    from . import commands
+    commands.init_app(app)
+
+    from . import instrumentation
+    instrumentation.init_app(app)
+
+    from . import tenancy
+    tenancy.init_app(app)
 
     from .errors import errors_bp
     app.register_blueprint(errors_bp)
@@ -43,4 +64,10 @@ def create_app():
     from .home import home_bp
     app.register_blueprint(home_bp)
 
+    from .feeds import feeds_bp
+    app.register_blueprint(feeds_bp, url_prefix='/feeds')
+
+    from .api import api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     return app
\ No newline at end of file
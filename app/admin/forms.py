@@ -1,6 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, BooleanField, SubmitField
-from wtforms.validators import DataRequired
+from wtforms import StringField, PasswordField, BooleanField, SubmitField, \
+    SelectField, IntegerField
+from wtforms.fields.html5 import DateField
+from wtforms.validators import DataRequired, Optional
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 
 class DepartmentForm(FlaskForm):
@@ -13,8 +15,20 @@ class RoleForm(FlaskForm):
     description = StringField('Description', validators=[DataRequired()])
     submit = SubmitField('Submit')
 
+class JobForm(FlaskForm):
+    submit = SubmitField('Run')
+
 class UploadForm(FlaskForm):
     upload = FileField('Import', validators=[
         FileRequired(), FileAllowed(['csv', 'txt'], 'Text file only!')
     ])
-    submit = SubmitField('Submit')
\ No newline at end of file
+    submit = SubmitField('Submit')
+
+class ExportForm(FlaskForm):
+    format = SelectField('Format', choices=[('csv', 'CSV'),
+                                            ('jsonl', 'JSON Lines')])
+    compress = BooleanField('Gzip')
+    account_id = IntegerField('Account', validators=[Optional()])
+    start = DateField('From', validators=[Optional()])
+    end = DateField('To', validators=[Optional()])
+    submit = SubmitField('Export')
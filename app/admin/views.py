@@ -1,70 +1,157 @@
-from flask import abort, flash, redirect, render_template, url_for, request
+import json
+from datetime import timedelta
+
+from flask import abort, current_app, flash, jsonify, redirect, \
+    render_template, url_for, request, Response, stream_with_context
 from flask_login import current_user, login_required
-from io import StringIO
-import csv
+from sqlalchemy import func
 
 from . import admin_bp
-from .forms import DepartmentForm, RoleForm, UploadForm
+from .forms import DepartmentForm, ExportForm, JobForm, RoleForm, UploadForm
 from .. import db
-from ..models import Department, Role
+from ..booking import day_of
+from ..decorators import admin_required
+from ..exporter import FORMATS, export, exporters
+from ..importer import importers
+from ..instrumentation import request_stats
+from ..jobs import JobsBusy, job_runner, save_upload
+from ..models import ArchivedMeeting, Department, Job, Meeting, Role, Room, \
+    Site, User
+from ..pagination import paginate_request
+from ..queries import MEETING_NAMES, ROOM_NAMES, SITE_NAMES, USER_NAMES, \
+    archived_meetings_with_people, meetings_with_people, rooms_with_site, \
+    sites_with_region, users_with_role_and_account
 
 
 def check_admin():
     """
     Prevent non-admins from accessing the page
+
+    Views can use the @admin_required decorator for the same check.
     """
     if not current_user.is_admin:
         abort(403)
 
 
-# Department Views
+# Jobs an admin may start from the jobs page
+MAINTENANCE_JOBS = {
+    'rebuild_rollups': 'Rebuild usage rollups',
+    'rebuild_search': 'Rebuild the search index',
+    'archive_meetings': 'Archive past meetings',
+    'insert_roles': 'Reset the default roles',
+}
 
 
-@admin_bp.route('/departments', methods=['GET', 'POST'])
-@login_required
-def list_departments():
+def start_job(name, **params):
     """
-    List all departments
+    Submit a job & redirect to its page, or back if the runner is full
     """
-    check_admin()
+    try:
+        job_id = job_runner.submit(name, user_id=current_user.id, **params)
+    except JobsBusy:
+        flash('Too many jobs are running; try again in a minute.')
+        return redirect(request.referrer or url_for('admin.list_jobs'))
+    return redirect(url_for('admin.show_job', id=job_id))
 
-    departments = Department.query.all()
-    form = UploadForm()
 
+def start_import(upload, name):
+    """
+    Import an uploaded CSV file in the background using the configured
+    chunk size
+    """
+    return start_job('import', path=save_upload(upload), table=name,
+                     chunk_size=current_app.config['IMPORT_CHUNK_SIZE'],
+                     max_errors=current_app.config['IMPORT_MAX_ERRORS'])
+
+
+def paginate(*args, **kwargs):
+    """
+    Keyset paginate a list view, rejecting bad query strings with a 400
+    """
+    try:
+        return paginate_request(*args, **kwargs)
+    except ValueError:
+        abort(400)
+
+
+# Import Views
+
+
+@admin_bp.route('/import/<name>', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def import_rows(name):
+    """
+    Import departments, sites, rooms, users or meetings from a CSV file
+    """
+    if name not in importers:
+        abort(404)
+    form = UploadForm()
     if form.validate_on_submit():
+        return start_import(request.files['upload'], name)
 
-        csv_file = StringIO()
+    return render_template('admin/import.html', form=form, name=name,
+                           title=f'Import {name.title()}')
 
-        try:
-            # request.files returns an ImmutableMultiDict containing the file as
-            # a FileStorage object.
-            #
-            # bytes.decode() returns a string decoded from the given bytes where
-            # default encoding is 'utf-8'.
-            #
-            # It is possible to use a str or bytes-like object as a file for reading &
-            # writing. For strings StringIO can be used like a file opened in text mode.
-            csv_file = StringIO(request.files['upload'].read().decode())
-
-            csv_content = csv.DictReader(csv_file)
-
-            for row in csv_content:
-                department = Department(name=row['name'], description=row['description'])
-                db.session.add(department)
-            db.session.commit()
-            flash('You have successfully imported the new department(s).')
 
-        except UnicodeDecodeError:
-            flash('Unicode Decode Error')
+# Export Views
 
-        except:
-            db.session.rollback()
-            flash('Error')
 
-        finally:
-            csv_file.close()
+@admin_bp.route('/export/<name>')
+@login_required
+@admin_required
+def export_rows(name):
+    """
+    Download meetings, rooms or users as CSV or JSON Lines, optionally
+    gzipped & limited to an account & (for meetings) a range of days
+
+    The file is streamed as it's read from the database, however large.
+    """
+    if name not in exporters:
+        abort(404)
+    form = ExportForm(request.args, meta={'csrf': False})
+    if not exporters[name].dated:
+        del form.start
+        del form.end
+    if 'format' not in request.args or not form.validate():
+        return render_template('admin/export.html', form=form, name=name,
+                               title=f'Export {name.title()}')
+
+    format, compress = form.format.data, form.compress.data
+    start = end = None
+    if exporters[name].dated:
+        start = form.start.data and day_of(form.start.data)
+        end = form.end.data and day_of(form.end.data) + timedelta(days=1)
+    chunks = export(name, format, compress, form.account_id.data, start, end)
+    filename = f'{name}.{format}' + ('.gz' if compress else '')
+    response = Response(
+        stream_with_context(chunks),
+        mimetype='application/gzip' if compress else FORMATS[format])
+    response.headers['Content-Disposition'] = \
+        f'attachment; filename={filename}'
+    return response
+
 
-        return redirect(url_for('admin.list_departments'))
+# Department Views
+
+
+@admin_bp.route('/departments', methods=['GET', 'POST'])
+@login_required
+@admin_required
+def list_departments():
+    """
+    List all departments
+    """
+    departments = paginate(Department, ('name', 'description'),
+                           sortable=('name', 'id'))
+    form = UploadForm()
+
+    if form.validate_on_submit():
+        # request.files returns an ImmutableMultiDict containing the file as
+        # a FileStorage object. It is copied to a temporary file that the
+        # import job reads incrementally, so the request returns at once &
+        # the upload is never held in memory as a whole.
+        return start_import(request.files['upload'], 'departments')
 
     return render_template('admin/departments/departments.html', form=form,
                            departments=departments, title="Departments")
@@ -72,12 +159,11 @@ def list_departments():
 
 @admin_bp.route('/departments/add', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def add_department():
     """
     Add a department to the database
     """
-    check_admin()
-
     form = DepartmentForm()
     if form.validate_on_submit():
         # Populates the attributes of the passed department obj with data from the form's fields
@@ -104,12 +190,11 @@ def add_department():
 
 @admin_bp.route('/departments/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def edit_department(id):
     """
     Edit a department
     """
-    check_admin()
-
     department = Department.query.get_or_404(id)
     # The obj parameter is used to populate form defaults on the initial view.
     # If there is any POST data at all, then the object data is ignored.
@@ -140,12 +225,11 @@ def edit_department(id):
 
 @admin_bp.route('/departments/delete/<int:id>', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def delete_department(id):
     """
     Delete a department from the database
     """
-    check_admin()
-
     department = Department.query.get_or_404(id)
     db.session.delete(department)
     db.session.commit()
@@ -160,25 +244,27 @@ def delete_department(id):
 
 @admin_bp.route('/roles')
 @login_required
+@admin_required
 def list_roles():
     """
     List all roles
     """
-    check_admin()
-
-    roles = Role.query.all()
+    # Count each role's users in the same query instead of once per row
+    user_count = db.session.query(func.count(User.id)) \
+        .filter(User.role_id == Role.id).correlate(Role).as_scalar()
+    roles = paginate(Role, ('name', 'permissions'), sortable=('name', 'id'),
+                     extra_columns=(user_count.label('user_count'),))
 
     return render_template('admin/roles/roles.html', roles=roles, title='Roles')
 
 
 @admin_bp.route('/roles/add', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def add_role():
     """
     Add a role to the database
     """
-    check_admin()
-
     form = RoleForm()
     if form.validate_on_submit():
         #role = Role(name=form.name.data, description=form.description.data)
@@ -204,12 +290,11 @@ def add_role():
 
 @admin_bp.route('/roles/edit/<int:id>', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def edit_role(id):
     """
     Edit a role
     """
-    check_admin()
-
     role = Role.query.get_or_404(id)
     form = RoleForm(obj=role)
     if form.validate_on_submit():
@@ -235,16 +320,203 @@ def edit_role(id):
 
 @admin_bp.route('/roles/delete/<int:id>', methods=['GET', 'POST'])
 @login_required
+@admin_required
 def delete_role(id):
     """
     Delete a role from the database
     """
-    check_admin()
-
     role = Role.query.get_or_404(id)
     db.session.delete(role)
     db.session.commit()
     flash('You have successfully deleted the role.')
 
     # redirect to the roles page
-    return redirect(url_for('admin.list_roles'))
\ No newline at end of file
+    return redirect(url_for('admin.list_roles'))
+
+
+# Listing Views
+#
+# Read-only, paginated listings of the larger tables. Each one selects only
+# the columns it shows, with the names of related rows joined into the same
+# query (see app/queries.py) rather than loaded per row.
+
+
+@admin_bp.route('/users')
+@login_required
+@admin_required
+def list_users():
+    """
+    List users
+    """
+    columns = ('email', 'staff_number', 'role', 'account', 'is_enabled')
+    users = paginate(User, ('email', 'staff_number', 'is_enabled'),
+                     sortable=('email', 'id'),
+                     filterable=('account_id', 'role_id'),
+                     query=users_with_role_and_account(),
+                     extra_columns=USER_NAMES)
+    return render_template('admin/list.html', page=users, columns=columns,
+                           endpoint='admin.list_users',
+                           depends=('user', 'role', 'account'), title='Users')
+
+
+@admin_bp.route('/sites')
+@login_required
+@admin_required
+def list_sites():
+    """
+    List sites
+    """
+    columns = ('code', 'name', 'address', 'region', 'account')
+    sites = paginate(Site, ('code', 'name', 'address'),
+                     sortable=('code', 'name', 'id'),
+                     filterable=('account_id', 'region_id'),
+                     query=sites_with_region(), extra_columns=SITE_NAMES)
+    return render_template('admin/list.html', page=sites, columns=columns,
+                           endpoint='admin.list_sites',
+                           depends=('site', 'account'), title='Sites')
+
+
+@admin_bp.route('/rooms')
+@login_required
+@admin_required
+def list_rooms():
+    """
+    List rooms
+    """
+    columns = ('name', 'description', 'site', 'region', 'account', 'cost')
+    rooms = paginate(Room, ('name', 'description', 'cost'),
+                     sortable=('name', 'cost', 'id'),
+                     filterable=('account_id', 'site_id'),
+                     query=rooms_with_site(), extra_columns=ROOM_NAMES)
+    return render_template('admin/list.html', page=rooms, columns=columns,
+                           endpoint='admin.list_rooms',
+                           depends=('room', 'site', 'account'), title='Rooms')
+
+
+@admin_bp.route('/meetings')
+@login_required
+@admin_required
+def list_meetings():
+    """
+    List meetings
+    """
+    columns = ('title', 'room', 'date', 'start_time', 'end_time', 'host',
+               'booker', 'account')
+    meetings = paginate(Meeting, ('title', 'date', 'start_time', 'end_time'),
+                        sortable=('date', 'id'),
+                        filterable=('account_id', 'room_id', 'host_id',
+                                    'booker_id'),
+                        query=meetings_with_people(),
+                        extra_columns=MEETING_NAMES)
+    return render_template('admin/list.html', page=meetings, columns=columns,
+                           endpoint='admin.list_meetings',
+                           depends=('meeting', 'room', 'user', 'account'),
+                           title='Meetings')
+
+
+@admin_bp.route('/meetings/archive')
+@login_required
+@admin_required
+def list_archived_meetings():
+    """
+    List meetings moved to the archive
+    """
+    columns = ('id', 'title', 'room', 'date', 'start_time', 'end_time',
+               'host', 'booker', 'account')
+    meetings = paginate(ArchivedMeeting,
+                        ('id', 'title', 'date', 'start_time', 'end_time'),
+                        sortable=('date', 'id'),
+                        filterable=('account_id', 'room_id', 'host_id',
+                                    'booker_id'),
+                        query=archived_meetings_with_people(),
+                        extra_columns=MEETING_NAMES)
+    return render_template('admin/list.html', page=meetings, columns=columns,
+                           endpoint='admin.list_archived_meetings',
+                           depends=('meeting', 'room', 'user', 'account'),
+                           title='Archived Meetings')
+
+
+# Stats Views
+
+
+@admin_bp.route('/stats')
+@login_required
+@admin_required
+def stats():
+    """
+    Show per-endpoint request, template & SQL timings
+    """
+    return render_template('admin/stats.html', stats=request_stats.snapshot(),
+                           enabled=current_app.config['REQUEST_STATS'],
+                           title='Stats')
+
+
+@admin_bp.route('/stats.txt')
+@login_required
+@admin_required
+def stats_export():
+    """
+    Export the request stats in the Prometheus text format
+    """
+    return Response(request_stats.prometheus(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+# Job Views
+
+
+@admin_bp.route('/jobs')
+@login_required
+@admin_required
+def list_jobs():
+    """
+    List the latest background jobs & offer the maintenance jobs
+    """
+    jobs = Job.query.order_by(Job.id.desc()) \
+        .limit(current_app.config['ADMIN_PAGE_SIZE']).all()
+    return render_template('admin/jobs.html', jobs=jobs, form=JobForm(),
+                           maintenance=MAINTENANCE_JOBS, title='Jobs')
+
+
+@admin_bp.route('/jobs/start/<name>', methods=['POST'])
+@login_required
+@admin_required
+def start_maintenance(name):
+    """
+    Start one of the MAINTENANCE_JOBS
+    """
+    if name not in MAINTENANCE_JOBS:
+        abort(404)
+    if not JobForm().validate_on_submit():
+        abort(400)
+    return start_job(name)
+
+
+@admin_bp.route('/jobs/<int:id>')
+@login_required
+@admin_required
+def show_job(id):
+    """
+    Show a job's progress; the page reloads itself until the job finishes
+    """
+    job = Job.query.get_or_404(id)
+    result = json.loads(job.result) if job.result else None
+    return render_template('admin/job.html', job=job, result=result,
+                           title=f'Job {job.id}')
+
+
+@admin_bp.route('/jobs/<int:id>.json')
+@login_required
+@admin_required
+def job_status(id):
+    """
+    Report a job's status & progress for polling clients
+    """
+    job = Job.query.get_or_404(id)
+    return jsonify(
+        id=job.id, name=job.name, status=job.status, progress=job.progress,
+        total=job.total, message=job.message, error=job.error,
+        result=json.loads(job.result) if job.result else None,
+        created_at=job.created_at.isoformat(),
+        started_at=job.started_at and job.started_at.isoformat(),
+        finished_at=job.finished_at and job.finished_at.isoformat())
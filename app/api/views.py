@@ -0,0 +1,128 @@
+from flask import current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy.exc import OperationalError
+
+from . import api_bp
+from .. import db
+from ..batch import apply_batch
+from ..instrumentation import query_budget
+from ..search import KINDS, search
+
+# Most results a search may ask for
+MAX_SEARCH_RESULTS = 50
+
+# Statements of a batch however big it is (the login, loading what the items
+# refer to, the rollups & commit), per room it books in or touches, & per
+# item for writing the meeting itself
+BATCH_QUERIES = 20
+BATCH_ROOM_QUERIES = 5
+BATCH_ITEM_QUERIES = 1
+
+
+def error(status, message, **headers):
+    response = jsonify(error=message)
+    response.status_code = status
+    response.headers.extend(headers)
+    return response
+
+
+@api_bp.before_request
+def require_json_login():
+    """
+    Answer with JSON errors instead of redirecting to the login form
+
+    The API authenticates with the session cookie like the rest of the site.
+    Only application/json bodies are accepted, which a cross-site form can't
+    send, so the API needs no CSRF token.
+    """
+    if not current_user.is_authenticated:
+        return error(401, 'login required')
+    if request.method == 'POST' and not request.is_json:
+        return error(415, 'expected an application/json body')
+
+
+def batch_budget():
+    """
+    Query budget of a batch: a fixed part, a share per room & one write
+    per item
+
+    Batches claim & read rooms, not single items, so the rooms an item can
+    touch are counted: the one it names, & the room of the meeting or
+    series a move or cancel finds.
+    """
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list):
+        return BATCH_QUERIES
+    room_ids = set()
+    found = 0
+    for raw in operations:
+        if not isinstance(raw, dict):
+            continue
+        room_ids.add(raw.get('room_id'))
+        found += raw.get('op') in ('move', 'cancel')
+    room_ids.discard(None)
+    return BATCH_QUERIES + BATCH_ROOM_QUERIES * (len(room_ids) + found) + \
+        BATCH_ITEM_QUERIES * len(operations)
+
+
+@api_bp.route('/meetings/batch', methods=['POST'])
+@query_budget(batch_budget)
+def meetings_batch():
+    """
+    Create, move & cancel many meetings in one transaction
+
+    The body is {"operations": [...], "atomic": true}, each operation one of
+
+        {"op": "create", "room_id", "date", "start_time", "duration",
+         "title", "host_id"?, "is_private"?}
+        {"op": "move", "id", "room_id"?, "date"?, "start_time"?,
+         "duration"?}
+        {"op": "cancel", "id"} or {"op": "cancel", "series_id", "date"}
+
+    with dates as YYYY-MM-DD & times as minutes past midnight or HH:MM.
+    The response lists a result per operation, in order. An atomic batch
+    with any failed item is not applied & answered with 409.
+    """
+    body = request.get_json(silent=True)
+    operations = body.get('operations') if isinstance(body, dict) else None
+    if not isinstance(operations, list) or not operations:
+        return error(400, 'operations must be a non-empty list')
+    limit = current_app.config['API_BATCH_LIMIT']
+    if len(operations) > limit:
+        return error(413, f'at most {limit} operations per batch')
+    atomic = bool(body.get('atomic', True))
+    try:
+        results, committed = apply_batch(operations, current_user, atomic)
+    except OperationalError:
+        # The database stayed locked or picked this transaction to abort
+        db.session.rollback()
+        return error(503, 'database busy, try again', **{'Retry-After': '1'})
+    response = jsonify(committed=committed, results=results)
+    if atomic and not committed:
+        response.status_code = 409
+    return response
+
+
+@api_bp.route('/search')
+def search_entities():
+    """
+    Typeahead search over users, rooms & sites, best matches first
+
+    ?q= is the text typed so far; kind= (repeatable) narrows the search to
+    user, room and/or site. Admins search every account, or the one given
+    as account_id=; everyone else searches their own account.
+    """
+    kinds = request.args.getlist('kind') or KINDS
+    if not set(kinds) <= set(KINDS):
+        return error(400, f'kind must be one of {", ".join(KINDS)}')
+    limit = min(request.args.get('limit', 10, type=int), MAX_SEARCH_RESULTS)
+    if current_user.is_admin:
+        account_id = request.args.get('account_id', type=int)
+    else:
+        account_id = current_user.account_id
+        if account_id is None:
+            return jsonify(results=[])
+    hits = search(request.args.get('q', ''), kinds, account_id,
+                  max(limit, 1))
+    return jsonify(results=[hit._asdict() for hit in hits])
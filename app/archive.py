@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, select, union_all
+
+from . import db
+from .booking import day_of
+from .changes import bump_rooms
+from .fragments import fragment_cache
+from .models import Account, ArchivedMeeting, Meeting
+
+meetings = Meeting.__table__
+archived = ArchivedMeeting.__table__
+accounts = Account.__table__
+
+# The columns both tables share, in the order they're copied & read
+COLUMNS = ('id', 'title', 'room_id', 'account_id', 'host_id', 'booker_id',
+           'date', 'start_time', 'end_time', 'duration', 'is_private')
+
+
+def default_cutoff():
+    """
+    Return the first day kept in the meetings table, ARCHIVE_AFTER_DAYS ago
+    """
+    return day_of(datetime.today()) - timedelta(
+        days=current_app.config['ARCHIVE_AFTER_DAYS'])
+
+
+def archive_batch(connection, account_id, cutoff, batch_size):
+    """
+    Move up to batch_size of an account's meetings before cutoff into the
+    archive, oldest first, & return how many were moved
+
+    The batch is found through ix_meetings_account_date_id, so no index on
+    date alone is needed in the meetings table.
+    """
+    ids = [id for id, in connection.execute(
+        select([meetings.c.id]).where(and_(
+            meetings.c.account_id == account_id, meetings.c.date < cutoff))
+        .order_by(meetings.c.date, meetings.c.id)
+        .limit(batch_size))]
+    if not ids:
+        return 0
+    room_ids = {room_id for room_id, in connection.execute(
+        select([meetings.c.room_id]).distinct()
+        .where(meetings.c.id.in_(ids)))}
+    columns = [meetings.c[name] for name in COLUMNS]
+    connection.execute(archived.insert().from_select(
+        COLUMNS, select(columns).where(meetings.c.id.in_(ids))))
+    connection.execute(meetings.delete().where(meetings.c.id.in_(ids)))
+    # Feeds that included these meetings have to be refetched
+    bump_rooms(connection, room_ids)
+    return len(ids)
+
+
+def archive(cutoff=None, batch_size=None, progress=None):
+    """
+    Move the meetings of days before cutoff into meetings_archive & return
+    how many were moved
+
+    Every batch is copied & deleted in a transaction of its own, so writers
+    are only held up for one batch at a time & an interrupted run can just
+    be started again: it picks up with whatever is still left. The rows go
+    through Core rather than the session, so usage rollups, which already
+    count them, are left alone. progress, if given, is called with the
+    total moved after each batch.
+    """
+    cutoff = cutoff or default_cutoff()
+    batch_size = batch_size or current_app.config['ARCHIVE_BATCH_SIZE']
+    moved = 0
+    account_ids = [id for id, in db.session.execute(
+        select([accounts.c.id]).order_by(accounts.c.id))]
+    db.session.commit()
+    for account_id in account_ids:
+        while True:
+            count = archive_batch(db.session.connection(), account_id,
+                                  cutoff, batch_size)
+            db.session.commit()
+            if not count:
+                break
+            moved += count
+            if progress is not None:
+                progress(moved)
+    if moved:
+        fragment_cache.bump('meeting')
+    return moved
+
+
+def _archived_since(start, end=None):
+    query = db.session.query(archived.c.id).filter(archived.c.date >= start)
+    if end is not None:
+        query = query.filter(archived.c.date < end)
+    return db.session.query(query.exists()).scalar()
+
+
+def all_meetings(start=None, end=None, account_id=None):
+    """
+    Return a subquery of the meetings on the days in [start, end), hot &
+    archived alike, with the COLUMNS of both tables
+
+    This is the read API for reports that may reach back past the archive
+    cutoff. The filters are applied to each table on its own so their
+    indexes are used, & the archive is skipped when nothing in it falls
+    within the range.
+    """
+    parts = [meetings]
+    if start is None or _archived_since(start, end):
+        parts.append(archived)
+    selects = []
+    for table in parts:
+        query = select([table.c[name] for name in COLUMNS])
+        if start is not None:
+            query = query.where(table.c.date >= start)
+        if end is not None:
+            query = query.where(table.c.date < end)
+        if account_id is not None:
+            query = query.where(table.c.account_id == account_id)
+        selects.append(query)
+    if len(selects) == 1:
+        return selects[0].alias('all_meetings')
+    return union_all(*selects).alias('all_meetings')
@@ -4,7 +4,8 @@ from flask_login import current_user, login_required, login_user, logout_user
 
 from . import auth_bp
 from .forms import LoginForm
-#from .. import db
+from .. import db
+from ..hashing import HashingBusy
 from ..models import User
 
 
@@ -18,7 +19,20 @@ def login():
     """
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        if user is not None and user.verify_password(form.password.data):
+        try:
+            verified = user is not None and \
+                user.verify_password(form.password.data)
+            if verified and user.needs_rehash:
+                # The configured hash method or cost changed; upgrade the
+                # hash while the plain password is at hand
+                user.password = form.password.data
+                db.session.commit()
+        except HashingBusy:
+            # Shed load rather than queue logins behind a saturated pool
+            flash('The server is busy, please try again in a moment.')
+            return render_template('auth/login.html', form=form,
+                                   title="Login"), 503, {'Retry-After': '5'}
+        if verified:
             login_user(user, remember=form.remember_me.data)
             next_page = request.args.get('next')
             if not next_page or url_parse(next_page).netloc != '':
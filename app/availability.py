@@ -0,0 +1,114 @@
+from collections import namedtuple
+from datetime import date, timedelta
+
+import numpy as np
+
+from . import db
+from .booking import MINUTES_PER_DAY, day_of
+from .models import Meeting, Room, Site
+from .recurrence import active, expand
+
+FreeSlot = namedtuple('FreeSlot', 'room_id date start_time end_time')
+
+
+def room_ids_for(site_id=None, region_id=None, account_id=None):
+    """
+    Return the sorted ids of the rooms at a site and/or in a region
+    """
+    query = db.session.query(Room.id)
+    if site_id is not None:
+        query = query.filter(Room.site_id == site_id)
+    if region_id is not None:
+        query = query.join(Site, Room.site_id == Site.id) \
+            .filter(Site.region_id == region_id)
+    if account_id is not None:
+        query = query.filter(Room.account_id == account_id)
+    return [room_id for room_id, in query.order_by(Room.id)]
+
+
+def occupancy(room_ids, rows):
+    """
+    Build a (rooms, minutes) boolean bitmap of one day from meeting rows
+
+    Each row is a (room_id, start_time, end_time) tuple. Rather than filling
+    each meeting minute by minute, +1/-1 is scattered at its start & end and a
+    cumulative sum along the minute axis turns those edges into the count of
+    meetings in progress, so the cost is one pass per day for all rooms.
+    """
+    edges = np.zeros((len(room_ids), MINUTES_PER_DAY + 1), dtype=np.int32)
+    if rows:
+        rows = np.asarray(rows, dtype=np.int64)
+        index = np.searchsorted(room_ids, rows[:, 0])
+        starts = np.clip(rows[:, 1], 0, MINUTES_PER_DAY)
+        ends = np.clip(rows[:, 2], 0, MINUTES_PER_DAY)
+        np.add.at(edges, (index, starts), 1)
+        np.add.at(edges, (index, ends), -1)
+    return np.cumsum(edges, axis=1)[:, :MINUTES_PER_DAY] > 0
+
+
+def free_starts(busy, duration, candidates):
+    """
+    Return a (rooms, candidates) mask of the starts free for duration minutes
+
+    With a running total of busy minutes, the busy minutes inside any window
+    are the difference of two entries of the total, so every candidate start
+    of every room is tested at once.
+    """
+    total = np.zeros((busy.shape[0], MINUTES_PER_DAY + 1), dtype=np.int32)
+    np.cumsum(busy, axis=1, out=total[:, 1:])
+    return total[:, candidates + duration] - total[:, candidates] == 0
+
+
+def find_free_slots(duration, site_id=None, region_id=None, account_id=None,
+                    start=None, days=7, limit=10, step=15, day_start=0,
+                    day_end=MINUTES_PER_DAY):
+    """
+    Find the first free slots of duration minutes across a site or region
+
+    Slots start on multiples of step minutes within [day_start, day_end) &
+    are ordered by date, start time, then room id. Meetings for every room
+    are fetched in a single query, occurrences of recurring series are
+    computed for the searched days only, and each day is searched for all
+    rooms at once, stopping as soon as limit slots have been found.
+    """
+    if duration <= 0 or day_end - day_start < duration:
+        raise ValueError(f'invalid duration {duration}')
+    room_ids = room_ids_for(site_id, region_id, account_id)
+    if not room_ids:
+        return []
+    room_ids = np.asarray(room_ids, dtype=np.int64)
+
+    first = day_of(start or date.today())
+    last = first + timedelta(days=days)
+    rows = db.session.query(
+            Meeting.date, Meeting.room_id, Meeting.start_time, Meeting.end_time
+        ).filter(
+            Meeting.room_id.in_(room_ids.tolist()),
+            Meeting.date >= first,
+            Meeting.date < last,
+        )
+    by_day = [[] for _ in range(days)]
+    for day, room_id, start_time, end_time in rows:
+        by_day[(day - first).days].append((room_id, start_time, end_time))
+    # Recurring series are expanded for the searched days only
+    for occurrence in expand(active(room_ids.tolist(), first, last), first,
+                             last):
+        by_day[(occurrence.date - first).days].append(
+            (occurrence.room_id, occurrence.start_time, occurrence.end_time))
+
+    first_start = -(-day_start // step) * step
+    candidates = np.arange(first_start, day_end - duration + 1, step)
+    slots = []
+    for offset, meetings in enumerate(by_day):
+        free = free_starts(occupancy(room_ids, meetings), duration, candidates)
+        # Transpose to (candidates, rooms) so nonzero() yields slots in time
+        # order, then room order
+        starts, rooms = np.nonzero(free.T)
+        day = first + timedelta(days=offset)
+        for i, j in zip(starts[:limit - len(slots)], rooms):
+            start_time = int(candidates[i])
+            slots.append(FreeSlot(int(room_ids[j]), day, start_time,
+                                  start_time + duration))
+        if len(slots) >= limit:
+            break
+    return slots
@@ -0,0 +1,374 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from . import db
+from .booking import check_times, claim, cancel_occurrence
+from .models import Meeting, MeetingSeries, Room, User
+from .recurrence import active, exception_dates, occurs_on, rule_of
+
+OPERATIONS = ('create', 'move', 'cancel')
+
+# What a room-day holds while a batch is checked: a stored meeting
+# (meeting_id), a series occurrence (series_id) or an item of the batch
+# itself (index)
+Slot = namedtuple('Slot', 'meeting_id series_id index start_time end_time')
+
+
+class ItemError(ValueError):
+    """
+    Raised for a batch item that can't be applied; status goes in its result
+    """
+    def __init__(self, status, message, conflicts=()):
+        self.status = status
+        self.conflicts = conflicts
+        super(ItemError, self).__init__(message)
+
+
+class Item(object):
+    """
+    One validated operation of a batch
+    """
+    def __init__(self, index, raw):
+        if not isinstance(raw, dict):
+            raise ItemError('invalid', 'an operation must be an object')
+        self.index = index
+        self.op = raw.get('op')
+        if self.op not in OPERATIONS:
+            raise ItemError(
+                'invalid', f'op must be one of {", ".join(OPERATIONS)}')
+        self.id = _int(raw, 'id', required=self.op == 'move' or (
+            self.op == 'cancel' and 'series_id' not in raw))
+        self.series_id = _int(raw, 'series_id') \
+            if self.op == 'cancel' and self.id is None else None
+        required = self.op == 'create'
+        self.room_id = _int(raw, 'room_id', required)
+        self.day = _day(raw, 'date', required or self.series_id is not None)
+        self.start_time = _time(raw, 'start_time', required)
+        self.duration = _int(raw, 'duration', required)
+        if self.op == 'create':
+            self.title = raw.get('title')
+            if not isinstance(self.title, str) or \
+                    not 0 < len(self.title) <= 60:
+                raise ItemError('invalid', 'title must be 1-60 characters')
+            self.host_id = _int(raw, 'host_id')
+            self.is_private = bool(raw.get('is_private', False))
+
+
+def _int(raw, key, required=False):
+    value = raw.get(key)
+    if value is None:
+        if required:
+            raise ItemError('invalid', f'{key} is required')
+        return None
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ItemError('invalid', f'{key} must be an integer')
+    return value
+
+
+def _day(raw, key, required=False):
+    value = raw.get(key)
+    if value is None:
+        if required:
+            raise ItemError('invalid', f'{key} is required')
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        raise ItemError('invalid', f'{key} must be a date (YYYY-MM-DD)')
+
+
+def _time(raw, key, required=False):
+    """
+    Read minutes past midnight, given as a number or as 'HH:MM'
+    """
+    value = raw.get(key)
+    if isinstance(value, str):
+        try:
+            hours, minutes = value.split(':')
+            return int(hours) * 60 + int(minutes)
+        except ValueError:
+            raise ItemError('invalid', f'{key} must be minutes or HH:MM')
+    return _int(raw, key, required)
+
+
+def _conflict(slot, room_id, day):
+    return {
+        'id': slot.meeting_id,
+        'series_id': slot.series_id,
+        'index': slot.index,
+        'room_id': room_id,
+        'date': day.strftime('%Y-%m-%d'),
+        'start_time': slot.start_time,
+        'end_time': slot.end_time,
+    }
+
+
+class Batch(object):
+    """
+    Check & apply many meeting operations in one transaction
+
+    Every meeting, series & room the items refer to is read up front with
+    one query each, the room-days the batch books into are claimed (see
+    booking.claim), and the schedule of each room is read with one query
+    for all of its days. Items are then checked in order against those
+    schedules in memory, so later items see the effect of earlier ones &
+    a batch can't double-book a room against itself.
+    """
+    def __init__(self, operations, user):
+        self.user = user
+        self.items = []
+        self.results = []
+        for index, raw in enumerate(operations):
+            result = {'index': index,
+                      'op': raw.get('op') if isinstance(raw, dict) else None}
+            self.results.append(result)
+            try:
+                self.items.append(Item(index, raw))
+            except ItemError as e:
+                self._fail(result, e)
+        self.schedules = defaultdict(list)
+        self.created = {}
+        self.gone = set()
+
+    @property
+    def failed(self):
+        return sum(result['status'] != 'ok' for result in self.results)
+
+    def _fail(self, result, error):
+        result['status'] = error.status
+        result['error'] = str(error)
+        if error.conflicts:
+            result['conflicts'] = list(error.conflicts)
+
+    def _load(self):
+        items = self.items
+        meeting_ids = {item.id for item in items if item.id is not None}
+        series_ids = {item.series_id for item in items
+                      if item.series_id is not None}
+        self.meetings = {meeting.id: meeting for meeting in
+                         Meeting.query.filter(Meeting.id.in_(meeting_ids))} \
+            if meeting_ids else {}
+        self.series = {series.id: series for series in
+                       MeetingSeries.query.filter(
+                           MeetingSeries.id.in_(series_ids))} \
+            if series_ids else {}
+        room_ids = {item.room_id for item in items
+                    if item.room_id is not None}
+        room_ids.update(meeting.room_id for meeting in self.meetings.values())
+        room_ids.update(series.room_id for series in self.series.values())
+        self.rooms = {room.id: room for room in
+                      Room.query.filter(Room.id.in_(room_ids))} \
+            if room_ids else {}
+        host_ids = {item.host_id for item in items
+                    if item.op == 'create' and item.host_id is not None}
+        self.hosts = dict(db.session.query(User.id, User.account_id)
+                          .filter(User.id.in_(host_ids))) \
+            if host_ids else {}
+
+    def _room_days(self):
+        """
+        Return {room_id: days} booked into, & {room_id: days} touched at all
+        """
+        booked = defaultdict(set)
+        touched = defaultdict(set)
+        for item in self.items:
+            if item.op == 'cancel':
+                if item.series_id in self.series:
+                    touched[self.series[item.series_id].room_id].add(item.day)
+                elif item.id in self.meetings:
+                    meeting = self.meetings[item.id]
+                    touched[meeting.room_id].add(meeting.date)
+                continue
+            meeting = self.meetings.get(item.id)
+            if item.op == 'move':
+                if meeting is None:
+                    continue
+                touched[meeting.room_id].add(meeting.date)
+            room_id = item.room_id if item.room_id is not None \
+                else meeting.room_id
+            day = item.day if item.day is not None else meeting.date
+            if room_id in self.rooms:
+                booked[room_id].add(day)
+                touched[room_id].add(day)
+        return booked, touched
+
+    def _read_schedules(self, touched):
+        for room_id, days in touched.items():
+            rows = db.session.query(
+                Meeting.id, Meeting.date, Meeting.start_time,
+                Meeting.end_time).filter(Meeting.room_id == room_id,
+                                         Meeting.date.in_(list(days)))
+            for meeting_id, day, start_time, end_time in rows:
+                self.schedules[room_id, day].append(
+                    Slot(meeting_id, None, None, start_time, end_time))
+        if not touched:
+            return
+        days = set().union(*touched.values())
+        series_list = active(touched, min(days),
+                             max(days) + timedelta(days=1)).all()
+        skips = exception_dates(series.id for series in series_list)
+        for series in series_list:
+            rule = rule_of(series)
+            skip = skips.get(series.id, ())
+            for day in touched[series.room_id]:
+                if occurs_on(rule, day) and day not in skip:
+                    self.schedules[series.room_id, day].append(
+                        Slot(None, series.id, None, series.start_time,
+                             series.end_time))
+
+    def _room(self, room_id):
+        room = self.rooms.get(room_id)
+        if room is None:
+            raise ItemError('not_found', f'room {room_id} does not exist')
+        if not self.user.is_admin and room.account_id != self.user.account_id:
+            raise ItemError('forbidden', f'room {room_id} is not yours')
+        return room
+
+    def _host(self, host_id, room):
+        if host_id not in self.hosts:
+            raise ItemError('not_found', f'user {host_id} does not exist')
+        if self.hosts[host_id] != room.account_id:
+            raise ItemError('forbidden', f'user {host_id} is not in the '
+                            f'account of room {room.id}')
+
+    def _meeting(self, item):
+        meeting = self.meetings.get(item.id)
+        if meeting is None or item.id in self.gone:
+            raise ItemError('not_found', f'meeting {item.id} does not exist')
+        self._room(meeting.room_id)
+        return meeting
+
+    def _place(self, item, room_id, day, start_time, duration,
+               meeting_id=None):
+        """
+        Return the slot for an item after checking it is free
+        """
+        self._room(room_id)
+        end_time = start_time + duration
+        try:
+            check_times(start_time, end_time)
+        except ValueError as e:
+            raise ItemError('invalid', str(e))
+        conflicts = [
+            _conflict(slot, room_id, day)
+            for slot in self.schedules[room_id, day]
+            if slot.start_time < end_time and slot.end_time > start_time
+            and (meeting_id is None or slot.meeting_id != meeting_id)]
+        if conflicts:
+            raise ItemError('conflict', f'{len(conflicts)} conflicting '
+                            'meeting(s)', conflicts)
+        return Slot(meeting_id, None, item.index, start_time, end_time)
+
+    def _unplace(self, room_id, day, match):
+        slots = self.schedules[room_id, day]
+        for i, slot in enumerate(slots):
+            if match(slot):
+                del slots[i]
+                return True
+        return False
+
+    def _create(self, item, result):
+        if item.host_id is not None:
+            self._host(item.host_id, self._room(item.room_id))
+        slot = self._place(item, item.room_id, item.day, item.start_time,
+                           item.duration)
+        meeting = Meeting(
+            title=item.title, room_id=item.room_id, date=item.day,
+            start_time=item.start_time, end_time=slot.end_time,
+            duration=item.duration, is_private=item.is_private,
+            host_id=self.user.id if item.host_id is None else item.host_id,
+            booker_id=self.user.id)
+        db.session.add(meeting)
+        self.schedules[item.room_id, item.day].append(slot)
+        self.created[item.index] = meeting
+
+    def _move(self, item, result):
+        meeting = self._meeting(item)
+        room_id = meeting.room_id if item.room_id is None else item.room_id
+        day = meeting.date if item.day is None else item.day
+        start_time = meeting.start_time if item.start_time is None \
+            else item.start_time
+        duration = meeting.duration if item.duration is None \
+            else item.duration
+        slot = self._place(item, room_id, day, start_time, duration,
+                           meeting_id=meeting.id)
+        self._unplace(meeting.room_id, meeting.date,
+                      lambda other: other.meeting_id == meeting.id)
+        self.schedules[room_id, day].append(slot)
+        meeting.room_id = room_id
+        meeting.date = day
+        meeting.start_time = start_time
+        meeting.end_time = slot.end_time
+        meeting.duration = duration
+        result['id'] = meeting.id
+
+    def _cancel(self, item, result):
+        if item.series_id is None:
+            meeting = self._meeting(item)
+            self._unplace(meeting.room_id, meeting.date,
+                          lambda other: other.meeting_id == meeting.id)
+            db.session.delete(meeting)
+            self.gone.add(meeting.id)
+            result['id'] = meeting.id
+            return
+        series = self.series.get(item.series_id)
+        if series is None:
+            raise ItemError('not_found',
+                            f'series {item.series_id} does not exist')
+        self._room(series.room_id)
+        if not self._unplace(series.room_id, item.day,
+                             lambda other: other.series_id == series.id):
+            raise ItemError('not_found', f'series {series.id} does not occur '
+                            f'on {item.day:%Y-%m-%d}')
+        cancel_occurrence(series, item.day)
+        result['series_id'] = series.id
+
+    def apply(self):
+        """
+        Check every item & stage the ones that pass in the session
+        """
+        self._load()
+        booked, touched = self._room_days()
+        with db.primary():
+            for room_id in sorted(booked):
+                claim(room_id, booked[room_id])
+            self._read_schedules(touched)
+        apply = {'create': self._create, 'move': self._move,
+                 'cancel': self._cancel}
+        for item in self.items:
+            result = self.results[item.index]
+            try:
+                apply[item.op](item, result)
+                result['status'] = 'ok'
+            except ItemError as e:
+                self._fail(result, e)
+        return self
+
+    def commit(self):
+        """
+        Commit the staged items, filling in the ids of created meetings
+        """
+        db.session.flush()
+        for index, meeting in self.created.items():
+            self.results[index]['id'] = meeting.id
+        db.session.commit()
+
+
+def apply_batch(operations, user, atomic=True):
+    """
+    Apply a list of create, move & cancel operations for user in one
+    transaction & return (results, committed)
+
+    Each result holds the item's index, op & status: 'ok', 'invalid',
+    'not_found', 'forbidden' or 'conflict' (with the slots it overlaps).
+    A host must be a user of the account the room belongs to.
+    An atomic batch is only committed if every item is 'ok'; otherwise the
+    items that passed are committed & the rest skipped.
+    """
+    batch = Batch(operations, user).apply()
+    if atomic and batch.failed or not any(
+            result['status'] == 'ok' for result in batch.results):
+        db.session.rollback()
+        return batch.results, False
+    batch.commit()
+    return batch.results, True
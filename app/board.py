@@ -0,0 +1,299 @@
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .booking import day_of
+from .changes import changed_rooms
+from .models import Meeting, MeetingSeries, Room
+from .recurrence import ONE_DAY, active, expand
+
+
+class BoardFull(Exception):
+    """
+    Raised when a process already streams to LIVE_MAX_SUBSCRIBERS screens
+    """
+
+
+def _entry(title, is_private, start_time, end_time):
+    # The board is shared by every screen, so private titles are never shown
+    return dict(title='Busy' if is_private else title, start_time=start_time,
+                end_time=end_time)
+
+
+def site_status(site_id, now=None):
+    """
+    Return whether each room of a site is free now & what's next, as
+    (status, changes_at)
+
+    Today's meetings & series occurrences that haven't ended are read with
+    three queries for the whole site. changes_at is when a meeting starts
+    or ends & the status becomes stale on its own.
+    """
+    now = now or datetime.now()
+    today = day_of(now)
+    minute = now.hour * 60 + now.minute
+    rooms = db.session.query(Room.id, Room.name) \
+        .filter(Room.site_id == site_id).order_by(Room.name).all()
+    room_ids = [id for id, _ in rooms]
+    schedule = {id: [] for id in room_ids}
+    if room_ids:
+        meetings = db.session.query(
+                Meeting.room_id, Meeting.title, Meeting.is_private,
+                Meeting.start_time, Meeting.end_time) \
+            .filter(Meeting.room_id.in_(room_ids), Meeting.date == today,
+                    Meeting.end_time > minute)
+        for room_id, title, is_private, start_time, end_time in meetings:
+            schedule[room_id].append(
+                _entry(title, is_private, start_time, end_time))
+        series = active(room_ids, today, today + ONE_DAY) \
+            .filter(MeetingSeries.end_time > minute).all()
+        private = {obj.id for obj in series if obj.is_private}
+        for occurrence in expand(series, today, today + ONE_DAY):
+            if occurrence.end_time > minute:
+                schedule[occurrence.room_id].append(_entry(
+                    occurrence.title, occurrence.series_id in private,
+                    occurrence.start_time, occurrence.end_time))
+    changes_at = today + ONE_DAY
+    board = []
+    for id, name in rooms:
+        entries = sorted(schedule[id], key=lambda entry: entry['start_time'])
+        current = next((entry for entry in entries
+                        if entry['start_time'] <= minute), None)
+        upcoming = next((entry for entry in entries
+                         if entry['start_time'] > minute), None)
+        for entry, at in ((current, 'end_time'), (upcoming, 'start_time')):
+            if entry is not None:
+                changes_at = min(changes_at,
+                                 today + timedelta(minutes=entry[at]))
+        board.append(dict(id=id, name=name, free=current is None,
+                          current=current, next=upcoming))
+    return dict(site_id=site_id, date=f'{today:%Y-%m-%d}', rooms=board), \
+        changes_at
+
+
+class Channel(object):
+    """
+    The latest status of one site & how many screens are waiting on it
+    """
+    def __init__(self, site_id, lock):
+        self.site_id = site_id
+        self.changed = threading.Condition(lock)
+        self.version = 0
+        self.status = None
+        self.message = None
+        self.room_ids = frozenset()
+        self.changes_at = None
+        self.refreshed = 0.0
+        self.subscribers = 0
+
+
+class Subscription(object):
+    """
+    Iterates over the server-sent events of a channel until closed
+
+    Each screen only ever gets the latest status: one that falls behind
+    skips the versions in between instead of queueing them. A comment is
+    sent after keepalive seconds without a change, which is also how a
+    closed connection is noticed.
+    """
+    def __init__(self, board, channel, keepalive):
+        self.board = board
+        self.channel = channel
+        self.keepalive = keepalive
+        self.seen = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        channel = self.channel
+        with self.board.lock:
+            if self.closed:
+                raise StopIteration
+            if channel.version == self.seen:
+                channel.changed.wait(self.keepalive)
+            version, message = channel.version, channel.message
+        if version == self.seen:
+            return ': keepalive\n\n'
+        self.seen = version
+        return message
+
+    def close(self):
+        with self.board.lock:
+            if not self.closed:
+                self.closed = True
+                self.channel.subscribers -= 1
+                self.board.subscribers -= 1
+
+
+class RoomBoard(object):
+    """
+    Shares one status per site between every screen showing it
+
+    Committed changes to meetings & series mark the sites of their rooms
+    dirty, and a single thread recomputes each dirty site once & wakes its
+    subscribers, however many there are. The thread also recomputes a site
+    when one of its meetings starts or ends, & every LIVE_MAX_AGE seconds
+    to pick up writes made by other processes or bulk imports, which this
+    process doesn't see. Sites nobody watches are forgotten.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.channels = {}
+        self.dirty = set()
+        self.subscribers = 0
+        self.thread = None
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LIVE_KEEPALIVE', 15)
+        app.config.setdefault('LIVE_MAX_AGE', 60)
+        app.config.setdefault('LIVE_MAX_SUBSCRIBERS', 1000)
+        self.app = app
+
+    def subscribe(self, site_id):
+        """
+        Return a Subscription to the status of a site, starting with the
+        current one
+        """
+        config = self.app.config
+        with self.lock:
+            if self.subscribers >= config['LIVE_MAX_SUBSCRIBERS']:
+                raise BoardFull('too many screens are subscribed')
+            channel = self.channels.get(site_id)
+            if channel is None:
+                channel = self.channels[site_id] = Channel(site_id, self.lock)
+                self.dirty.add(site_id)
+                self.wakeup.notify()
+            channel.subscribers += 1
+            self.subscribers += 1
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self._run, name='room-board', daemon=True)
+                self.thread.start()
+        return Subscription(self, channel, config['LIVE_KEEPALIVE'])
+
+    def status(self, site_id):
+        """
+        Return the current status of a site, shared if someone watches it
+        """
+        with self.lock:
+            channel = self.channels.get(site_id)
+            if channel is not None and channel.status is not None and \
+                    site_id not in self.dirty and not self._stale(channel):
+                return channel.status
+        return site_status(site_id)[0]
+
+    def rooms_changed(self, room_ids):
+        """
+        Mark the watched sites of room_ids dirty
+        """
+        with self.lock:
+            sites = [site_id for site_id, channel in self.channels.items()
+                     if channel.room_ids & room_ids]
+            if sites:
+                self.dirty.update(sites)
+                self.wakeup.notify()
+
+    def _stale(self, channel):
+        if channel.changes_at is None:
+            return True
+        return datetime.now() >= channel.changes_at or time.monotonic() - \
+            channel.refreshed >= self.app.config['LIVE_MAX_AGE']
+
+    def _due(self):
+        # Called with the lock held
+        for site_id, channel in list(self.channels.items()):
+            if not channel.subscribers:
+                del self.channels[site_id]
+                self.dirty.discard(site_id)
+        due = {site_id for site_id, channel in self.channels.items()
+               if site_id in self.dirty or self._stale(channel)}
+        self.dirty -= due
+        return due
+
+    def _timeout(self):
+        # Seconds until a watched status goes stale, or None for never
+        if not self.channels:
+            return None
+        now, clock = datetime.now(), time.monotonic()
+        max_age = self.app.config['LIVE_MAX_AGE']
+        return max(0, min(
+            min((channel.changes_at - now).total_seconds(),
+                channel.refreshed + max_age - clock)
+            if channel.changes_at is not None else 0
+            for channel in self.channels.values()))
+
+    def _run(self):
+        while True:
+            with self.lock:
+                due = self._due()
+                while not due:
+                    self.wakeup.wait(self._timeout())
+                    due = self._due()
+            app = self.app
+            with app.app_context():
+                try:
+                    results = [(site_id,) + site_status(site_id)
+                               for site_id in sorted(due)]
+                except Exception:
+                    app.logger.exception('Could not refresh room status')
+                    results = []
+                finally:
+                    db.session.remove()
+            if not results:
+                time.sleep(1)
+                with self.lock:
+                    self.dirty.update(due)
+                continue
+            self._publish(results)
+
+    def _publish(self, results):
+        with self.lock:
+            for site_id, status, changes_at in results:
+                channel = self.channels.get(site_id)
+                if channel is None:
+                    continue
+                channel.changes_at = changes_at
+                channel.refreshed = time.monotonic()
+                channel.room_ids = frozenset(
+                    room['id'] for room in status['rooms'])
+                if status == channel.status:
+                    continue
+                channel.status = status
+                channel.version += 1
+                channel.message = f'id: {channel.version}\nevent: status\n' \
+                    f'data: {json.dumps(status)}\n\n'
+                channel.changed.notify_all()
+
+
+room_board = RoomBoard()
+
+
+@event.listens_for(Session, 'after_flush')
+def _remember_rooms(session, flush_context):
+    if room_board.channels:
+        room_ids = changed_rooms(session)
+        if room_ids:
+            session.info.setdefault('board_rooms', set()).update(room_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_rooms(session):
+    room_ids = session.info.pop('board_rooms', None)
+    if room_ids:
+        room_board.rooms_changed(room_ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_rooms(session):
+    session.info.pop('board_rooms', None)
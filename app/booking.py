@@ -0,0 +1,325 @@
+import random
+import time
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, bindparam
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .database import insert_missing
+from .models import Meeting, MeetingSeries, RoomDay, SeriesException
+from .recurrence import Occurrence, Rule, active, check_rule, exception_dates, \
+    occurs_on, overlapping_occurrences, rule_of, shared_days, \
+    dates, until_for_count, weekday_mask
+
+# Meeting.start_time & Meeting.end_time are stored as minutes past midnight
+MINUTES_PER_DAY = 24 * 60
+# Longest span of a recurring series, which bounds how far its conflict
+# check & rollups have to look
+MAX_SERIES_DAYS = 2 * 366
+# Attempts & initial backoff (seconds) of reserve() when the database is busy
+RESERVE_ATTEMPTS = 5
+RETRY_DELAY = 0.01
+
+room_days = RoomDay.__table__
+
+
+class BookingConflict(Exception):
+    """
+    Raised when a meeting would overlap another meeting in the same room
+
+    conflicts holds Meetings and/or recurrence.Occurrences of a series.
+    """
+    def __init__(self, conflicts):
+        self.conflicts = conflicts
+        super(BookingConflict, self).__init__(
+            f'{len(conflicts)} conflicting meeting(s)')
+
+
+def day_of(value):
+    """
+    Normalise a date or datetime to the midnight datetime stored in
+    Meeting.date
+    """
+    if isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    raise TypeError(f'expected a date or datetime, got {value!r}')
+
+
+def check_times(start_time, end_time):
+    """
+    Validate a start/end pair expressed in minutes past midnight
+    """
+    if not 0 <= start_time < end_time <= MINUTES_PER_DAY:
+        raise ValueError(
+            f'invalid meeting time {start_time}-{end_time}; expected '
+            f'0 <= start < end <= {MINUTES_PER_DAY}')
+
+
+def overlapping(room_ids, day, start_time, end_time, exclude_id=None):
+    """
+    Query for meetings in any of room_ids overlapping [start_time, end_time)
+
+    Two half-open intervals overlap when each one starts before the other one
+    ends. The filter maps onto ix_meetings_room_schedule as an equality seek on
+    (room_id, date) followed by a range scan on start_time, so the cost grows
+    with the meetings booked in that room on that day rather than the size of
+    the table.
+    """
+    query = Meeting.query.filter(
+        Meeting.room_id.in_(list(room_ids)),
+        Meeting.date == day_of(day),
+        Meeting.start_time < end_time,
+        Meeting.end_time > start_time,
+        )
+    if exclude_id is not None:
+        query = query.filter(Meeting.id != exclude_id)
+    return query
+
+
+def find_conflicts(room_id, day, start_time, end_time, exclude_id=None):
+    """
+    Return the meetings & series occurrences in room_id that overlap
+    [start_time, end_time), ordered by start time
+    """
+    check_times(start_time, end_time)
+    meetings = overlapping([room_id], day, start_time, end_time,
+                           exclude_id=exclude_id).all()
+    occurrences = overlapping_occurrences([room_id], day_of(day), start_time,
+                                          end_time)
+    return sorted(meetings + occurrences, key=lambda m: m.start_time)
+
+
+def is_free(room_id, day, start_time, end_time, exclude_id=None):
+    check_times(start_time, end_time)
+    query = overlapping([room_id], day, start_time, end_time,
+                        exclude_id=exclude_id)
+    if db.session.query(query.exists()).scalar():
+        return False
+    return not overlapping_occurrences([room_id], day_of(day), start_time,
+                                       end_time)
+
+
+def free_rooms(room_ids, day, start_time, end_time):
+    """
+    Return the subset of room_ids free for all of [start_time, end_time)
+
+    A single query collects the busy rooms, instead of one query per room. The
+    order of room_ids is preserved in the result.
+    """
+    check_times(start_time, end_time)
+    room_ids = list(room_ids)
+    if not room_ids:
+        return []
+    busy = overlapping(room_ids, day, start_time, end_time) \
+        .with_entities(Meeting.room_id).distinct()
+    busy = {room_id for room_id, in busy}
+    busy.update(occurrence.room_id for occurrence in overlapping_occurrences(
+        room_ids, day_of(day), start_time, end_time))
+    return [room_id for room_id in room_ids if room_id not in busy]
+
+
+def claim(room_id, days):
+    """
+    Lock the RoomDay rows of room_id for days until the transaction ends
+
+    Run before the conflict check, this turns check-then-insert into a
+    critical section per room & day: a concurrent booking of the same day
+    waits for this transaction & then sees its meeting. The rows are
+    created on first use & touched in a fixed order, so two bookings
+    claiming several days can't deadlock. On SQLite, where the whole
+    database has a single writer, it makes the booking take the write lock
+    before reading rather than failing to upgrade a read lock later.
+    """
+    days = sorted(set(days))
+    if not days:
+        return
+    connection = db.session.connection()
+    connection.execute(insert_missing(room_days, connection.dialect.name),
+                       [dict(room_id=room_id, date=day, claims=0)
+                        for day in days])
+    connection.execute(
+        room_days.update().where(and_(
+            room_days.c.room_id == bindparam('claim_room'),
+            room_days.c.date == bindparam('claim_date'),
+            )).values(claims=room_days.c.claims + 1),
+        [dict(claim_room=room_id, claim_date=day) for day in days])
+
+
+def book_meeting(room_id, day, start_time, duration, **kwargs):
+    """
+    Add a meeting to the session after checking the room is free
+
+    The room's day is claimed first, so the check holds until the session
+    is committed. Raises BookingConflict if the room is taken. The caller
+    is responsible for committing the session; reserve() does that & also
+    retries when the database is busy.
+    """
+    end_time = start_time + duration
+    with db.primary():
+        claim(room_id, [day_of(day)])
+        conflicts = find_conflicts(room_id, day, start_time, end_time)
+    if conflicts:
+        raise BookingConflict(conflicts)
+    meeting = Meeting(room_id=room_id, date=day_of(day), start_time=start_time,
+                      end_time=end_time, duration=duration, **kwargs)
+    db.session.add(meeting)
+    return meeting
+
+
+def reserve(room_id, day, start_time, duration, attempts=RESERVE_ATTEMPTS,
+            **kwargs):
+    """
+    Book a meeting in a transaction of its own & commit it
+
+    Concurrent bookings of the same room & day queue on its claim, so the
+    later one fails with BookingConflict instead of double-booking. When
+    the database gives up waiting (SQLite's busy timeout, a deadlock or a
+    serialization failure) the booking is rolled back & retried after a
+    randomized, growing delay.
+    """
+    for attempt in range(attempts):
+        try:
+            meeting = book_meeting(room_id, day, start_time, duration,
+                                   **kwargs)
+            db.session.commit()
+            return meeting
+        except BookingConflict:
+            db.session.rollback()
+            raise
+        except OperationalError:
+            db.session.rollback()
+            if attempt == attempts - 1:
+                raise
+            time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+
+
+def move_meeting(meeting, room_id=None, day=None, start_time=None,
+                 duration=None):
+    """
+    Reschedule an existing meeting after checking the new slot is free
+    """
+    room_id = meeting.room_id if room_id is None else room_id
+    day = meeting.date if day is None else day
+    start_time = meeting.start_time if start_time is None else start_time
+    duration = meeting.duration if duration is None else duration
+    end_time = start_time + duration
+    with db.primary():
+        claim(room_id, [day_of(day)])
+        conflicts = find_conflicts(room_id, day, start_time, end_time,
+                                   exclude_id=meeting.id)
+    if conflicts:
+        raise BookingConflict(conflicts)
+    meeting.room_id = room_id
+    meeting.date = day_of(day)
+    meeting.start_time = start_time
+    meeting.end_time = end_time
+    meeting.duration = duration
+    return meeting
+
+
+def series_conflicts(room_id, rule, start_time, end_time):
+    """
+    Return the meetings & occurrences that a new series would overlap
+
+    Only the meetings overlapping its time of day within its span are read,
+    and other series are compared rule against rule, so neither side is
+    ever expanded into rows.
+    """
+    meetings = Meeting.query.filter(
+        Meeting.room_id == room_id,
+        Meeting.date >= rule.start_date,
+        Meeting.date <= rule.until,
+        Meeting.start_time < end_time,
+        Meeting.end_time > start_time,
+        ).order_by(Meeting.date, Meeting.start_time)
+    conflicts = [meeting for meeting in meetings
+                 if occurs_on(rule, meeting.date)]
+
+    others = active([room_id], rule.start_date,
+                    rule.until + timedelta(days=1)).filter(
+        MeetingSeries.start_time < end_time,
+        MeetingSeries.end_time > start_time).all()
+    skips = exception_dates(other.id for other in others)
+    for other in others:
+        for day in shared_days(rule, rule_of(other),
+                               other_skip=skips.get(other.id, ())):
+            conflicts.append(Occurrence(other.id, other.room_id, day,
+                                        other.start_time, other.end_time,
+                                        other.title))
+    return conflicts
+
+
+def book_series(room_id, start_date, start_time, duration, frequency='weekly',
+                interval=1, weekdays=None, until=None, count=None, **kwargs):
+    """
+    Add a recurring series to the session after checking every occurrence
+
+    A series ends on until or after count occurrences. Weekly series repeat
+    on weekdays (numbers with Monday as 0, or 'MO', 'TU'...), by default the
+    weekday of start_date. Raises BookingConflict listing every clash. The
+    caller is responsible for committing the session.
+    """
+    start_date = day_of(start_date)
+    end_time = start_time + duration
+    check_times(start_time, end_time)
+    if frequency == 'weekly':
+        weekdays = weekday_mask(weekdays or [start_date.weekday()])
+    else:
+        weekdays = None
+    rule = Rule(frequency, interval, weekdays, start_date, start_date)
+    if until is None and count is None:
+        raise ValueError('a series needs an end date or a count')
+    if until is None:
+        check_rule(rule)
+        until = until_for_count(rule, count)
+    rule = rule._replace(until=day_of(until))
+    check_rule(rule)
+    if (rule.until - rule.start_date).days > MAX_SERIES_DAYS:
+        raise ValueError(f'a series may span at most {MAX_SERIES_DAYS} days')
+
+    with db.primary():
+        claim(room_id, dates(rule))
+        conflicts = series_conflicts(room_id, rule, start_time, end_time)
+    if conflicts:
+        raise BookingConflict(conflicts)
+    series = MeetingSeries(room_id=room_id, start_date=rule.start_date,
+                           until=rule.until, start_time=start_time,
+                           end_time=end_time, duration=duration,
+                           frequency=frequency, interval=interval,
+                           weekdays=weekdays, **kwargs)
+    db.session.add(series)
+    return series
+
+
+def cancel_occurrence(series, day):
+    """
+    Cancel the occurrence of series on day by recording an exception
+    """
+    day = day_of(day)
+    if not occurs_on(rule_of(series), day):
+        raise ValueError(f'{series!r} does not occur on {day:%Y-%m-%d}')
+    exception = SeriesException(series=series, date=day)
+    db.session.add(exception)
+    return exception
+
+
+def move_occurrence(series, day, room_id=None, new_day=None, start_time=None,
+                    duration=None):
+    """
+    Replace the occurrence of series on day with a one-off meeting
+
+    The occurrence is cancelled first, so the meeting may overlap its old
+    slot.
+    """
+    cancel_occurrence(series, day)
+    db.session.flush()
+    return book_meeting(
+        series.room_id if room_id is None else room_id,
+        day if new_day is None else new_day,
+        series.start_time if start_time is None else start_time,
+        series.duration if duration is None else duration,
+        title=series.title, host_id=series.host_id,
+        booker_id=series.booker_id, is_private=series.is_private)
@@ -0,0 +1,46 @@
+from datetime import datetime
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, attributes
+
+from .models import Meeting, MeetingSeries, Room, SeriesException
+
+rooms = Room.__table__
+
+
+def changed_rooms(session):
+    """
+    Return the ids of rooms whose schedule the pending flush changes
+
+    A meeting moved between rooms changes both of them; an exception changes
+    the room of its series.
+    """
+    room_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, (Meeting, MeetingSeries)):
+            room_ids.update(attributes.get_history(obj, 'room_id').sum())
+        elif isinstance(obj, SeriesException) and obj.series is not None:
+            room_ids.add(obj.series.room_id)
+    for obj in session.dirty:
+        if isinstance(obj, (Meeting, MeetingSeries)) and \
+                session.is_modified(obj):
+            room_ids.update(attributes.get_history(obj, 'room_id').sum())
+    room_ids.discard(None)
+    return room_ids
+
+
+def bump_rooms(connection, room_ids):
+    """
+    Increment the version of room_ids, e.g. after a bulk write of meetings
+    """
+    if room_ids:
+        connection.execute(
+            rooms.update().where(rooms.c.id.in_(list(room_ids))).values(
+                version=rooms.c.version + 1, changed_at=datetime.utcnow()))
+
+
+@event.listens_for(Session, 'after_flush')
+def _bump_room_versions(session, flush_context):
+    room_ids = changed_rooms(session)
+    if room_ids:
+        bump_rooms(session.connection(), room_ids)
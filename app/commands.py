@@ -0,0 +1,119 @@
+import time
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+rollups_cli = AppGroup('rollups', help='Maintain the usage rollup tables.')
+search_cli = AppGroup('search', help='Maintain the full-text search index.')
+archive_cli = AppGroup('archive', help='Move past meetings out of the hot '
+                                      'tables.')
+
+
+@rollups_cli.command('rebuild')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='First day to rebuild (widened to the start of its month).')
+@click.option('--end', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Day after the last one to rebuild (widened to a month end).')
+def rebuild_rollups(start, end):
+    """
+    Recompute usage rollups from the meetings table
+    """
+    from .rollups import rebuild
+
+    count = rebuild(start, end)
+    click.echo(f'Wrote {count} rollup rows.')
+
+
+@rollups_cli.command('fold')
+def fold_rollups():
+    """
+    Add pending site & account usage deltas to the rollups
+    """
+    from .rollups import rollup_folder
+
+    count = rollup_folder.fold()
+    click.echo(f'Folded {count} usage deltas.')
+
+
+@search_cli.command('rebuild')
+def rebuild_search():
+    """
+    Refill the search index from the users, rooms & sites tables
+    """
+    from . import db
+    from .search import rebuild, supported
+
+    connection = db.session.connection()
+    if not supported(connection):
+        raise click.ClickException(
+            f'{connection.dialect.name} has no search index to rebuild.')
+    rebuild(connection)
+    db.session.commit()
+    click.echo('Rebuilt the search index.')
+
+
+@archive_cli.command('meetings')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Archive the days before this one (default: '
+                   'ARCHIVE_AFTER_DAYS ago).')
+@click.option('--batch-size', type=int,
+              help='Meetings moved per transaction (default: '
+                   'ARCHIVE_BATCH_SIZE).')
+def archive_meetings(before, batch_size):
+    """
+    Move past meetings into meetings_archive, a batch at a time
+
+    Safe to interrupt & run again; it carries on with what's left.
+    """
+    from .archive import archive, default_cutoff
+
+    before = before or default_cutoff()
+    click.echo(f'Archiving meetings before {before:%Y-%m-%d}.')
+    moved = archive(before, batch_size,
+                    progress=lambda moved: click.echo(f'Moved {moved}.'))
+    click.echo(f'Archived {moved} meetings.')
+
+
+@click.command('generate')
+@click.option('--accounts', default=10, show_default=True,
+              help='Accounts to create.')
+@click.option('--sites', 'sites_per_account', default=5, show_default=True,
+              help='Sites per account.')
+@click.option('--rooms', 'rooms_per_site', default=10, show_default=True,
+              help='Rooms per site.')
+@click.option('--users', default=1000, show_default=True,
+              help='Users, shared between the new accounts.')
+@click.option('--meetings', 'meetings_per_room_per_day', default=4,
+              show_default=True, help='Meetings per room per day.')
+@click.option('--days', default=30, show_default=True,
+              help='Days of meetings to create.')
+@click.option('--start', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='First day of meetings (default today).')
+@click.option('--weekends/--no-weekends', default=False, show_default=True,
+              help='Book meetings on Saturdays & Sundays too.')
+@click.option('--seed', default=0, show_default=True,
+              help='Random seed; the same seed generates the same data.')
+@click.option('--chunk-size', default=10000, show_default=True,
+              help='Rows per INSERT.')
+@with_appcontext
+def generate_data(**options):
+    """
+    Bulk insert synthetic accounts, sites, rooms, users & meetings
+    """
+    from .generator import generate
+
+    started = time.perf_counter()
+    try:
+        report = generate(**options)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+    for table, count in report.counts.items():
+        click.echo(f'{table}: {count}')
+    click.echo(f'Done in {time.perf_counter() - started:.1f}s.')
+
+
+def init_app(app):
+    app.cli.add_command(rollups_cli)
+    app.cli.add_command(search_cli)
+    app.cli.add_command(archive_cli)
+    app.cli.add_command(generate_data)
@@ -0,0 +1,210 @@
+import random
+import time
+from contextlib import contextmanager
+from functools import partial
+
+from flask import has_request_context, request, session as flask_session
+from flask_sqlalchemy import BaseQuery, SQLAlchemy as BaseSQLAlchemy, \
+    SignallingSession, get_state
+from sqlalchemy import event, inspect, orm
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql.expression import CompoundSelect, Select, UpdateBase
+
+
+def set_sqlite_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f'PRAGMA {name}={value}')
+    cursor.close()
+
+
+def insert_missing(table, dialect):
+    """
+    Return an INSERT into table that skips rows violating a unique key
+
+    Inserting every row a statement needs this way & then updating them is
+    an upsert that two transactions can't both fail or both win.
+    """
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert().prefix_with('OR IGNORE')
+
+
+def tenant_column(entity):
+    """
+    Return the column of a mapped class (or alias) naming its account
+
+    That is account_id, or the column named by __tenant_column__ (e.g. 'id'
+    for Account itself); None for models that don't belong to an account.
+    """
+    mapper = inspect(entity).mapper
+    name = getattr(mapper.class_, '__tenant_column__', 'account_id')
+    if name not in mapper.columns:
+        return None
+    return getattr(entity, name)
+
+
+class TenantQuery(BaseQuery):
+    """
+    A query that only returns rows of the session's tenant, if it has one
+
+    While session.info['tenant'] holds an account id (see SQLAlchemy.tenant)
+    every entity the query selects that belongs to an account is filtered
+    by it when the query is compiled, so per-tenant code can't forget the
+    filter. all_tenants() lifts the filter for one query.
+    """
+    def for_account(self, account_id):
+        """
+        Filter every selected entity that belongs to an account explicitly
+        """
+        query = self.enable_assertions(False)
+        for description in self.column_descriptions:
+            entity = description['entity']
+            column = tenant_column(entity) if entity is not None else None
+            if column is not None:
+                query = query.filter(column == account_id)
+        return query
+
+    def all_tenants(self):
+        return self.execution_options(all_tenants=True)
+
+
+@event.listens_for(TenantQuery, 'before_compile', retval=True)
+def _scope_to_tenant(query):
+    # Not marked bake_ok, so lazy loads aren't cached under one tenant's id
+    account_id = query.session.info.get('tenant') \
+        if query.session is not None else None
+    if account_id is None or query._execution_options.get('all_tenants'):
+        return query
+    return query.for_account(account_id)
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends plain SELECTs to a replica when reads are routed
+
+    Reads go to a randomly chosen bind from SQLALCHEMY_REPLICA_BINDS while
+    info['replica'] is set. Flushes, DML & raw SQL always use the primary,
+    and once the session has written anything every later read does too, so
+    a request always sees its own changes.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.info['wrote'] = True
+        elif (self.info.get('replica') and not self._flushing
+              and not self.info.get('wrote')
+              and isinstance(clause, (Select, CompoundSelect))):
+            bind = SignallingSession.get_bind(self, mapper, clause)
+            # Models with their own __bind_key__ are left where they are
+            if bind is self.bind:
+                replicas = self.app.config['SQLALCHEMY_REPLICA_BINDS']
+                return get_state(self.app).db.get_engine(
+                    self.app, bind=random.choice(replicas))
+            return bind
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_written(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _remember_write(session):
+    # The time of a user's last write is kept in their session cookie, so
+    # whichever worker serves their next request keeps them on the primary
+    if (session.info.get('wrote') and has_request_context()
+            and session.app.config['SQLALCHEMY_REPLICA_BINDS']):
+        flask_session['_last_write'] = time.time()
+
+
+class SQLAlchemy(BaseSQLAlchemy):
+    """
+    Flask-SQLAlchemy with SQLite pragmas, tenant scoping & optional
+    read/write splitting
+
+    SQLITE_PRAGMAS are applied to every new SQLite connection. Queries are
+    TenantQuerys, scoped to an account inside db.tenant(). When
+    SQLALCHEMY_REPLICA_BINDS names one or more SQLALCHEMY_BINDS, GET & HEAD
+    requests read from those replicas unless the user wrote something less
+    than READ_AFTER_WRITE_WINDOW seconds ago. db.replica() & db.primary()
+    route the reads of a block of code explicitly.
+    """
+    sqlite_pragmas = {}
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('query_class', TenantQuery)
+        super(SQLAlchemy, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLITE_PRAGMAS', {})
+        app.config.setdefault('SQLALCHEMY_REPLICA_BINDS', [])
+        app.config.setdefault('READ_AFTER_WRITE_WINDOW', 10)
+        self.sqlite_pragmas = app.config['SQLITE_PRAGMAS']
+        super(SQLAlchemy, self).init_app(app)
+
+        if app.config['SQLALCHEMY_REPLICA_BINDS']:
+            @app.before_request
+            def route_reads():
+                self.session().info['replica'] = \
+                    request.method in ('GET', 'HEAD') and self.replica_allowed()
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super(SQLAlchemy, self).create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite' and self.sqlite_pragmas:
+            event.listen(engine, 'connect',
+                         partial(set_sqlite_pragmas, dict(self.sqlite_pragmas)))
+        return engine
+
+    def replica_allowed(self):
+        """
+        True unless there are no replicas or the user has written recently
+        """
+        app = self.get_app()
+        if not app.config['SQLALCHEMY_REPLICA_BINDS']:
+            return False
+        if has_request_context():
+            last_write = flask_session.get('_last_write')
+            return last_write is None or \
+                time.time() - last_write > app.config['READ_AFTER_WRITE_WINDOW']
+        return True
+
+    @contextmanager
+    def _reads(self, replica):
+        session = self.session()
+        previous = session.info.get('replica', False)
+        session.info['replica'] = replica
+        try:
+            yield session
+        finally:
+            session.info['replica'] = previous
+
+    def replica(self):
+        """
+        Read from a replica inside the block, e.g. for reports
+        """
+        return self._reads(self.replica_allowed())
+
+    def primary(self):
+        """
+        Read from the primary inside the block, e.g. for booking transactions
+        """
+        return self._reads(False)
+
+    @contextmanager
+    def tenant(self, account_id):
+        """
+        Scope the queries of the block to account_id (None lifts the scope)
+        """
+        session = self.session()
+        previous = session.info.get('tenant')
+        session.info['tenant'] = account_id
+        try:
+            yield session
+        finally:
+            session.info['tenant'] = previous
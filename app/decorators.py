@@ -0,0 +1,27 @@
+from functools import wraps
+
+from flask import abort
+from flask_login import current_user
+
+from .models import Permission
+
+
+def permission_required(permission):
+    """
+    Abort with 403 unless the current user's role grants permission
+
+    The check reads the permission bits resolved when the user was loaded,
+    so it costs no queries. Apply it below @login_required.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if not current_user.can(permission):
+                abort(403)
+            return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+def admin_required(f):
+    return permission_required(Permission.ADMIN)(f)
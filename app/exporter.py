@@ -0,0 +1,169 @@
+import csv
+import io
+import json
+import zlib
+from abc import ABC, abstractmethod
+
+from sqlalchemy.orm import aliased
+
+from . import db
+from .archive import all_meetings
+from .models import Account, Role, Room, Site, User
+
+# Content types of the export formats
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Rows fetched from the cursor, & written out, at a time
+BATCH_SIZE = 1000
+
+
+class Exporter(ABC):
+    """
+    Streams the rows of one table, with names from the tables it refers to
+
+    The columns of each row are named by fields, which include the ones the
+    matching Importer reads under the same names, so an export can be
+    imported again. Subclasses build the query in query().
+    """
+    fields = ()
+    # Whether rows can be filtered to a range of days
+    dated = False
+
+    @abstractmethod
+    def query(self, account_id=None, start=None, end=None):
+        """
+        Return the query of the rows, with a column per name in fields
+        """
+
+    def rows(self, account_id=None, start=None, end=None):
+        return self.query(account_id, start, end).yield_per(BATCH_SIZE)
+
+
+class RoomExporter(Exporter):
+    fields = ('id', 'name', 'description', 'site_id', 'account_id', 'cost',
+              'site')
+
+    def query(self, account_id=None, start=None, end=None):
+        query = db.session.query(
+                Room.id, Room.name, Room.description, Room.site_id,
+                Room.account_id, Room.cost, Site.code
+            ).outerjoin(Site, Room.site_id == Site.id).order_by(Room.id)
+        if account_id is not None:
+            query = query.filter(Room.account_id == account_id)
+        return query
+
+
+class UserExporter(Exporter):
+    # Never the password hash
+    fields = ('id', 'email', 'staff_number', 'role_id', 'account_id',
+              'is_enabled', 'role', 'account')
+
+    def query(self, account_id=None, start=None, end=None):
+        query = db.session.query(
+                User.id, User.email, User.staff_number, User.role_id,
+                User.account_id, User.is_enabled, Role.name, Account.code
+            ).outerjoin(Role, User.role_id == Role.id) \
+            .outerjoin(Account, User.account_id == Account.id) \
+            .order_by(User.id)
+        if account_id is not None:
+            query = query.filter(User.account_id == account_id)
+        return query
+
+
+class MeetingExporter(Exporter):
+    """
+    Meetings, archived ones included, with their room, site, host & booker
+    """
+    fields = ('id', 'title', 'room_id', 'host_id', 'booker_id', 'date',
+              'start_time', 'duration', 'is_private', 'end_time',
+              'account_id', 'room', 'site_id', 'site', 'host', 'booker')
+    dated = True
+
+    def query(self, account_id=None, start=None, end=None):
+        meetings = all_meetings(start, end, account_id)
+        host = aliased(User)
+        booker = aliased(User)
+        return db.session.query(
+                meetings.c.id, meetings.c.title, meetings.c.room_id,
+                meetings.c.host_id, meetings.c.booker_id, meetings.c.date,
+                meetings.c.start_time, meetings.c.duration,
+                meetings.c.is_private, meetings.c.end_time,
+                meetings.c.account_id, Room.name, Room.site_id, Site.code,
+                host.email, booker.email
+            ).outerjoin(Room, meetings.c.room_id == Room.id) \
+            .outerjoin(Site, Room.site_id == Site.id) \
+            .outerjoin(host, meetings.c.host_id == host.id) \
+            .outerjoin(booker, meetings.c.booker_id == booker.id) \
+            .order_by(meetings.c.date, meetings.c.start_time, meetings.c.id)
+
+
+exporters = {
+    'meetings': MeetingExporter,
+    'rooms': RoomExporter,
+    'users': UserExporter,
+}
+
+
+def _batches(rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def csv_chunks(fields, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    for batch in _batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # The header alone, for an export without rows
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def jsonl_chunks(fields, rows):
+    for batch in _batches(rows):
+        yield ''.join(json.dumps(dict(zip(fields, row)), default=str) + '\n'
+                      for row in batch)
+
+
+def gzip_chunks(chunks):
+    """
+    Compress chunks of bytes into one gzip stream, as they come
+    """
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(name, format='csv', compress=False, account_id=None, start=None,
+           end=None):
+    """
+    Yield the export called name as chunks of bytes
+
+    Rows are read from the cursor BATCH_SIZE at a time & each batch is
+    encoded (& compressed) before the next is read, so memory use doesn't
+    grow with the size of the export. start & end limit dated exports to
+    the days in [start, end).
+    """
+    exporter = exporters[name]()
+    rows = exporter.rows(account_id, start, end)
+    encode = csv_chunks if format == 'csv' else jsonl_chunks
+    chunks = (chunk.encode() for chunk in encode(exporter.fields, rows))
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,5 @@
+from flask import Blueprint
+
+feeds_bp = Blueprint('feeds', __name__)
+
+from . import views
@@ -0,0 +1,76 @@
+from datetime import timedelta
+
+CRLF = '\r\n'
+
+
+def escape(text):
+    """
+    Escape a TEXT value as required by RFC 5545
+    """
+    return text.replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\r\n', '\\n').replace('\n', '\\n')
+
+
+def fold(line):
+    """
+    Fold a content line so that no line is longer than 75 octets
+    """
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line + CRLF
+    parts = []
+    limit = 75
+    while encoded:
+        cut = min(limit, len(encoded))
+        # Don't split a multi-byte character
+        while cut < len(encoded) and (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode('utf-8'))
+        encoded = encoded[cut:]
+        # Continuation lines start with a space, which counts towards 75
+        limit = 74
+    return (CRLF + ' ').join(parts) + CRLF
+
+
+def local_time(day, minutes):
+    # Meetings are in the site's local time, so they're written as "floating"
+    # times without a time zone
+    return (day + timedelta(minutes=minutes)).strftime('%Y%m%dT%H%M%S')
+
+
+def header(name):
+    return ''.join(fold(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//Storm//Room Booking//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{escape(name)}',
+        ))
+
+
+def footer():
+    return 'END:VCALENDAR' + CRLF
+
+
+def event(uid, stamp, day, start_time, end_time, summary, location,
+          rrule=None, exdates=()):
+    """
+    Return a VEVENT; rrule & exdates (days) make it a recurring event
+    """
+    lines = [
+        'BEGIN:VEVENT',
+        f'UID:{uid}',
+        f'DTSTAMP:{stamp}',
+        f'DTSTART:{local_time(day, start_time)}',
+        f'DTEND:{local_time(day, end_time)}',
+        f'SUMMARY:{escape(summary)}',
+        f'LOCATION:{escape(location)}',
+        ]
+    if rrule:
+        lines.append(f'RRULE:{rrule}')
+    if exdates:
+        lines.append('EXDATE:' + ','.join(
+            local_time(exdate, start_time) for exdate in sorted(exdates)))
+    lines.append('END:VEVENT')
+    return ''.join(fold(line) for line in lines)
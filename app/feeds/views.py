@@ -0,0 +1,248 @@
+from datetime import datetime, timedelta
+
+from flask import abort, current_app, jsonify, request, Response, \
+    stream_with_context, url_for
+from flask_login import current_user, login_required
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from sqlalchemy import func, or_
+
+from . import feeds_bp, ical
+from .. import db
+from ..board import BoardFull, room_board
+from ..booking import day_of
+from ..models import Meeting, MeetingSeries, Room, Site, User
+from ..recurrence import exception_dates, rrule
+from ..user_cache import user_cache
+
+# Rows fetched from the database cursor at a time while streaming a feed
+BATCH_SIZE = 500
+
+
+def serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'],
+                                  salt='ics-feed')
+
+
+def can_view(kind, id, account_id, user=None):
+    user = user or current_user
+    if user.is_admin:
+        return True
+    if kind == 'user':
+        return id == user.id
+    return account_id is not None and account_id == user.account_id
+
+
+def viewer_id(kind, id, account_id):
+    """
+    Return the id of the user a feed is served to, or abort
+
+    Calendar clients can't log in, so a feed URL carries a signed token
+    naming the feed & the user who subscribed to it. Tokens expire after
+    ICS_FEED_TOKEN_DAYS, & the user must still exist, be enabled & be
+    allowed to view the feed on every fetch. Logged in users may also fetch
+    feeds directly.
+    """
+    token = request.args.get('token')
+    if token:
+        max_age = current_app.config['ICS_FEED_TOKEN_DAYS'] * 24 * 60 * 60
+        try:
+            token_kind, token_id, user_id = serializer().loads(
+                token, max_age=max_age)
+        except (BadSignature, ValueError):
+            abort(403)
+        if (token_kind, token_id) != (kind, id):
+            abort(403)
+        user = user_cache.load(user_id)
+        if user is None or not user.is_enabled or \
+                not can_view(kind, id, account_id, user):
+            abort(403)
+        return user_id
+    if not current_user.is_authenticated:
+        abort(401)
+    if not can_view(kind, id, account_id):
+        abort(403)
+    return current_user.id
+
+
+def window():
+    today = day_of(datetime.today())
+    return (today - timedelta(days=current_app.config['ICS_FEED_PAST_DAYS']),
+            today + timedelta(days=current_app.config['ICS_FEED_FUTURE_DAYS']))
+
+
+def meetings_in(first, last):
+    return db.session.query(
+            Meeting.id, Meeting.title, Meeting.date, Meeting.start_time,
+            Meeting.end_time, Meeting.is_private, Meeting.host_id,
+            Meeting.booker_id, Room.name
+        ).join(Room, Meeting.room_id == Room.id) \
+        .filter(Meeting.date >= first, Meeting.date < last) \
+        .order_by(Meeting.date, Meeting.start_time)
+
+
+def series_in(first, last):
+    """
+    Query the series that may occur in the window, with their room names
+
+    Series are published as one recurring event each rather than expanded,
+    so calendar clients compute the occurrences themselves.
+    """
+    return db.session.query(MeetingSeries, Room.name) \
+        .join(Room, MeetingSeries.room_id == Room.id) \
+        .filter(MeetingSeries.until >= first, MeetingSeries.start_date < last) \
+        .order_by(MeetingSeries.start_date, MeetingSeries.id)
+
+
+def not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    since = request.if_modified_since
+    return since is not None and last_modified is not None and \
+        last_modified <= since.replace(tzinfo=None)
+
+
+def feed_response(name, etag, last_modified, query, series, viewer):
+    """
+    Stream query, then series, as an iCalendar feed, or answer 304 if the
+    client is current
+
+    The ETag is derived from room versions, so an unchanged feed costs a
+    single small query. Otherwise the rows are streamed from the cursor in
+    batches rather than building the calendar in memory.
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(microsecond=0)
+    if not_modified(etag, last_modified):
+        response = Response(status=304)
+    else:
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+
+        def generate():
+            yield ical.header(name)
+            for (id, title, day, start_time, end_time, is_private, host_id,
+                    booker_id, room) in query.yield_per(BATCH_SIZE):
+                if is_private and viewer not in (host_id, booker_id):
+                    title = 'Busy'
+                yield ical.event(f'meeting-{id}@storm', stamp, day,
+                                 start_time, end_time, title, room)
+            rows = series.all()
+            skips = exception_dates(obj.id for obj, _ in rows)
+            for obj, room in rows:
+                title = obj.title
+                if obj.is_private and viewer not in (obj.host_id,
+                                                     obj.booker_id):
+                    title = 'Busy'
+                yield ical.event(f'series-{obj.id}@storm', stamp,
+                                 obj.start_date, obj.start_time, obj.end_time,
+                                 title, room, rrule=rrule(obj),
+                                 exdates=skips.get(obj.id, ()))
+            yield ical.footer()
+
+        response = Response(stream_with_context(generate()),
+                            mimetype='text/calendar')
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # Clients may keep the feed but must revalidate it on every poll
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+@feeds_bp.route('/rooms/<int:id>.ics')
+def room_feed(id):
+    room = Room.query.get_or_404(id)
+    viewer = viewer_id('room', id, room.account_id)
+    first, last = window()
+    etag = f'room-{id}-{room.version}-{first:%Y%m%d}-{viewer}'
+    query = meetings_in(first, last).filter(Meeting.room_id == id)
+    series = series_in(first, last).filter(MeetingSeries.room_id == id)
+    return feed_response(room.name, etag, room.changed_at, query, series,
+                         viewer)
+
+
+@feeds_bp.route('/sites/<int:id>.ics')
+def site_feed(id):
+    site = Site.query.get_or_404(id)
+    viewer = viewer_id('site', id, site.account_id)
+    first, last = window()
+    rooms, versions, last_modified = db.session.query(
+        func.count(Room.id), func.sum(Room.version), func.max(Room.changed_at)
+        ).filter(Room.site_id == id).one()
+    etag = f'site-{id}-{rooms}-{versions or 0}-{first:%Y%m%d}-{viewer}'
+    query = meetings_in(first, last).filter(Room.site_id == id)
+    series = series_in(first, last).filter(Room.site_id == id)
+    return feed_response(site.name or site.code, etag, last_modified, query,
+                         series, viewer)
+
+
+@feeds_bp.route('/sites/<int:id>/status')
+def site_status_events(id):
+    """
+    Stream whether each room of a site is free & what's next, as
+    server-sent events
+
+    Every change sends the whole board as a status event; a site feed token
+    works for lobby displays that can't log in. Each open stream holds a
+    server thread, so serve these from a threaded or asynchronous worker.
+    """
+    site = Site.query.get_or_404(id)
+    viewer_id('site', id, site.account_id)
+    try:
+        events = room_board.subscribe(id)
+    except BoardFull:
+        return Response('Too many status screens', status=503,
+                        headers={'Retry-After': '30'})
+    # The stream never queries, so don't hold a connection while it's open
+    db.session.remove()
+    response = Response(events, mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@feeds_bp.route('/sites/<int:id>/status.json')
+def site_status_snapshot(id):
+    site = Site.query.get_or_404(id)
+    viewer_id('site', id, site.account_id)
+    return jsonify(room_board.status(id))
+
+
+@feeds_bp.route('/users/<int:id>.ics')
+def user_feed(id):
+    user = User.query.get_or_404(id)
+    viewer = viewer_id('user', id, user.account_id)
+    first, last = window()
+    query = meetings_in(first, last).filter(
+        or_(Meeting.host_id == id, Meeting.booker_id == id))
+    series = series_in(first, last).filter(
+        or_(MeetingSeries.host_id == id, MeetingSeries.booker_id == id))
+    # Any change to one of the user's meetings or series bumps the version
+    # of a room it's in, or changes how many of them there are
+    meetings, versions, last_modified = query.order_by(None).with_entities(
+        func.count(Meeting.id), func.sum(Room.version),
+        func.max(Room.changed_at)).one()
+    series_count, series_versions, series_modified = series.order_by(None) \
+        .with_entities(func.count(MeetingSeries.id), func.sum(Room.version),
+                       func.max(Room.changed_at)).one()
+    etag = f'user-{id}-{meetings}-{versions or 0}-{series_count}-' \
+        f'{series_versions or 0}-{first:%Y%m%d}-{viewer}'
+    last_modified = max(filter(None, (last_modified, series_modified)),
+                        default=None)
+    return feed_response(user.email, etag, last_modified, query, series,
+                         viewer)
+
+
+@feeds_bp.route('/<any(room, site, user):kind>/<int:id>/subscribe')
+@login_required
+def subscribe(kind, id):
+    """
+    Return a feed URL with a token calendar clients can subscribe to
+    """
+    model = {'room': Room, 'site': Site, 'user': User}[kind]
+    obj = model.query.get_or_404(id)
+    if not can_view(kind, id, obj.account_id):
+        abort(403)
+    token = serializer().dumps([kind, id, current_user.id])
+    return jsonify(url=url_for(f'feeds.{kind}_feed', id=id, token=token,
+                               _external=True))
@@ -0,0 +1,161 @@
+import time
+from functools import wraps
+
+from flask import make_response, request, session
+from flask_login import current_user
+from markupsafe import Markup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .cache import LRUCache, RedisCache
+from .models import Account, Department, Meeting, MeetingSeries, Role, \
+    Room, SeriesException, Site, User
+
+# Models whose changes evict the fragments that depend on them, by the name
+# used in depends=(...)
+entities = {
+    Account: 'account',
+    Department: 'department',
+    Meeting: 'meeting',
+    MeetingSeries: 'meeting',
+    SeriesException: 'meeting',
+    Role: 'role',
+    Room: 'room',
+    Site: 'site',
+    User: 'user',
+}
+
+
+class FragmentCache(object):
+    """
+    Cache of rendered template fragments & pages
+
+    Keys combine the fragment name with the current user's account & role
+    and the current version of every entity the fragment depends on. A
+    change to an entity gives it a new version, so stale fragments are never
+    looked up again & simply age out of the backend; nothing has to be
+    found & deleted.
+
+    Versions are kept per account & globally; bump(entity) without an
+    account invalidates the entity for everyone. Admins see every account,
+    so their fragments depend on a version bumped by a change in any of them.
+    """
+    def __init__(self, app=None):
+        self.backend = LRUCache()
+        self.enabled = True
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('FRAGMENT_CACHE_BACKEND', 'lru')
+        app.config.setdefault('FRAGMENT_CACHE_URL', None)
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 2048)
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 300)
+        self.enabled = app.config['FRAGMENT_CACHE_BACKEND'] is not None
+        if app.config['FRAGMENT_CACHE_BACKEND'] == 'redis':
+            self.backend = RedisCache(app.config['FRAGMENT_CACHE_URL'],
+                                      ttl=app.config['FRAGMENT_CACHE_TTL'])
+        else:
+            self.backend = LRUCache(maxsize=app.config['FRAGMENT_CACHE_SIZE'],
+                                    ttl=app.config['FRAGMENT_CACHE_TTL'])
+        app.add_template_global(self.cached)
+
+    def version(self, entity, account_id=None):
+        key = f'version:{entity}:{account_id}'
+        version = self.backend.get(key)
+        if version is None:
+            # An evicted version must not come back as an old value, which
+            # could revive fragments rendered before the last change
+            version = self.bump(entity, account_id)
+        return version
+
+    def bump(self, entity, account_id=None):
+        version = str(time.time_ns())
+        self.backend.set(f'version:{entity}:{account_id}', version, ttl=0)
+        if account_id is not None:
+            self.backend.set(f'version:{entity}:*', version, ttl=0)
+        return version
+
+    def key(self, name, depends=(), vary=''):
+        if current_user.is_authenticated:
+            account_id, role = current_user.account_id, current_user.role_id
+        else:
+            account_id, role = None, 'anonymous'
+        scope = '*' if current_user.is_admin else account_id
+        versions = '.'.join(
+            f'{self.version(entity)}-{self.version(entity, scope)}'
+            for entity in depends)
+        return f'fragment:{name}:{account_id}:{role}:{versions}:{vary}'
+
+    def cached(self, name, depends=(), vary='', caller=None):
+        """
+        Template global caching the body of a {% call %} block
+
+            {% call cached('nav', depends=('site',)) %}...{% endcall %}
+        """
+        if not self.enabled:
+            return caller()
+        key = self.key(name, depends, vary)
+        html = self.backend.get(key)
+        if html is None:
+            html = str(caller())
+            self.backend.set(key, html)
+        return Markup(html)
+
+    def cached_page(self, name, depends=()):
+        """
+        Cache the HTML a view returns for GET requests
+
+        Pages that would show flashed messages are rendered as usual, as the
+        messages are part of the page.
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                if (not self.enabled or request.method != 'GET'
+                        or session.get('_flashes')):
+                    return f(*args, **kwargs)
+                key = self.key(name, depends, request.full_path)
+                html = self.backend.get(key)
+                if html is not None:
+                    return html
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and \
+                        response.mimetype == 'text/html' and \
+                        not response.is_streamed:
+                    self.backend.set(key, response.get_data(as_text=True))
+                return response
+            return decorated_function
+        return decorator
+
+
+fragment_cache = FragmentCache()
+
+
+def _account_id(obj):
+    if isinstance(obj, Account):
+        return obj.id
+    return getattr(obj, 'account_id', None)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_changes(session, flush_context):
+    changes = session.info.setdefault('fragment_changes', set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        entity = entities.get(type(obj))
+        if entity is not None:
+            changes.add((entity, _account_id(obj)))
+
+
+@event.listens_for(Session, 'after_commit')
+def _evict_fragments(session):
+    # Versions change only once the data is committed, so a concurrent
+    # request can't cache a fragment rendered from the old rows under the
+    # new version
+    for entity, account_id in session.info.pop('fragment_changes', ()):
+        fragment_cache.bump(entity, account_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_changes(session):
+    session.info.pop('fragment_changes', None)
@@ -0,0 +1,248 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func, select
+
+from . import db
+from .hashing import password_hasher
+from .models import Account, Meeting, Region, Role, Room, Site, User
+from .rollups import rebuild
+
+# ISO 3166-1 alpha-2 codes & short names of the regions sites are spread over
+REGIONS = (
+    ('hk', 'HONG KONG'),
+    ('my', 'MALAYSIA'),
+    ('sg', 'SINGAPORE'),
+    ('th', 'THAILAND'),
+    ('ca', 'CANADA'),
+    ('us', 'UNITED STATES OF AMERICA'),
+    ('cn', 'CHINA'),
+    )
+
+TITLES = ('Stand-up', 'Planning', 'Retrospective', 'Interview', '1:1',
+          'Design review', 'Sales call', 'Training', 'All hands', 'Workshop')
+
+# Meetings are laid out on a 15 minute grid within office hours
+SLOT = 15
+DAY_START = 8 * 60
+DAY_END = 18 * 60
+MAX_SLOTS = 8
+
+
+class GeneratorReport(object):
+    """
+    Number of rows generated per table
+    """
+    def __init__(self):
+        self.counts = {}
+
+    def add(self, table, count):
+        self.counts[table] = self.counts.get(table, 0) + count
+
+    def __repr__(self):
+        counts = ', '.join(f'{count} {table}'
+                           for table, count in self.counts.items())
+        return f'GeneratorReport: {counts}'
+
+
+def insert_regions(connection):
+    """
+    Insert the regions in REGIONS that aren't in the database yet
+    """
+    regions = Region.__table__
+    existing = {code for code, in connection.execute(
+        select([regions.c.code]))}
+    rows = [dict(code=code, name=name) for code, name in REGIONS
+            if code not in existing]
+    if rows:
+        connection.execute(regions.insert(), rows)
+    return len(rows)
+
+
+def _next_id(connection, table):
+    return (connection.execute(select([func.max(table.c.id)])).scalar() or 0) + 1
+
+
+def _insert(connection, table, rows, chunk_size):
+    for i in range(0, len(rows), chunk_size):
+        connection.execute(table.insert(), rows[i:i + chunk_size])
+
+
+def _advance_sequence(connection, table):
+    """
+    Move the id sequence of table past explicitly inserted ids
+
+    PostgreSQL hands out serial ids from a sequence that INSERTs with ids
+    of their own don't advance; other databases take the next id from the
+    table itself.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    connection.execute(select([func.setval(
+        func.pg_get_serial_sequence(table.name, 'id'),
+        select([func.max(table.c.id)]).as_scalar())]))
+
+
+def day_schedules(rng, rooms, count):
+    """
+    Return (start_times, durations) arrays of count meetings for each of rooms
+
+    The office day is cut into count equal segments & each meeting is placed
+    inside its own segment, so meetings in a room never overlap & no overlap
+    check is needed however many are generated.
+    """
+    segment = (DAY_END - DAY_START) // SLOT // count
+    slots = rng.integers(1, min(segment, MAX_SLOTS) + 1, size=(rooms, count))
+    offsets = (rng.random((rooms, count)) * (segment - slots + 1)).astype(int)
+    start_times = DAY_START + (np.arange(count) * segment + offsets) * SLOT
+    return start_times.ravel(), (slots * SLOT).ravel()
+
+
+def generate(accounts=10, sites_per_account=5, rooms_per_site=10, users=1000,
+             meetings_per_room_per_day=4, days=30, start=None, weekends=False,
+             seed=0, password='password', chunk_size=10000):
+    """
+    Bulk insert a synthetic, internally consistent data set
+
+    New accounts get sites_per_account sites of rooms_per_site rooms each;
+    users are shared round-robin between the new accounts, & each room gets
+    meetings_per_room_per_day meetings on each of the days from start
+    (default today), hosted & booked by users of its account. Rows are
+    written with Core executemany INSERTs, so millions of meetings take
+    seconds, & the same seed always produces the same data. Everything is
+    added next to what's already there; the rollups of the generated period
+    are rebuilt at the end. Returns a GeneratorReport.
+    """
+    max_per_day = (DAY_END - DAY_START) // SLOT
+    if not 0 <= meetings_per_room_per_day <= max_per_day:
+        raise ValueError(f'meetings_per_room_per_day must be between 0 and '
+                         f'{max_per_day}')
+    if accounts < 1:
+        raise ValueError('accounts must be at least 1')
+
+    rng = random.Random(seed)
+    start = datetime.combine(start or datetime.utcnow().date(),
+                             datetime.min.time())
+    report = GeneratorReport()
+    connection = db.session.connection()
+
+    report.add('regions', insert_regions(connection))
+    region_ids = [id for id, in connection.execute(
+        select([Region.__table__.c.id]).order_by(Region.__table__.c.id))]
+    Role.insert_roles(commit=False)
+    role_id = Role.query.filter_by(default=True).first().id
+
+    # Ids are assigned here rather than by the database, so that sites can
+    # point at accounts & meetings at rooms without reading anything back;
+    # _advance_sequence keeps later inserts from reusing them
+    account_table = Account.__table__
+    first_account = _next_id(connection, account_table)
+    account_ids = list(range(first_account, first_account + accounts))
+    _insert(connection, account_table, [
+        dict(id=id, code=f'A{id}', name=f'Account {id}', is_enabled=True)
+        for id in account_ids], chunk_size)
+    _advance_sequence(connection, account_table)
+    report.add('accounts', accounts)
+
+    site_table = Site.__table__
+    site_id = _next_id(connection, site_table)
+    sites = []
+    for account_id in account_ids:
+        for i in range(sites_per_account):
+            sites.append(dict(
+                id=site_id, code=f'S{i + 1:03d}', name=f'Site {site_id}',
+                address=f'{rng.randint(1, 999)} Main Street',
+                region_id=rng.choice(region_ids) if region_ids else None,
+                account_id=account_id))
+            site_id += 1
+    _insert(connection, site_table, sites, chunk_size)
+    if sites:
+        _advance_sequence(connection, site_table)
+    report.add('sites', len(sites))
+
+    room_table = Room.__table__
+    room_id = _next_id(connection, room_table)
+    rooms = []
+    for site in sites:
+        for i in range(rooms_per_site):
+            rooms.append(dict(
+                id=room_id, name=f'{site["code"]}-R{i + 1:02d}',
+                description=f'{rng.choice((4, 6, 8, 12, 20))} seats',
+                site_id=site['id'], account_id=site['account_id'],
+                cost=rng.choice((0, 1, 2, 5, 10)), version=0))
+            room_id += 1
+    _insert(connection, room_table, rooms, chunk_size)
+    if rooms:
+        _advance_sequence(connection, room_table)
+    report.add('rooms', len(rooms))
+
+    # Hashing is deliberately slow, so every generated user shares one hash
+    password_hash = password_hasher.hash(password)
+    user_table = User.__table__
+    first_user = _next_id(connection, user_table)
+    account_users = {account_id: [] for account_id in account_ids}
+    user_rows = []
+    for id in range(first_user, first_user + users):
+        account_id = account_ids[(id - first_user) % accounts]
+        account_users[account_id].append(id)
+        user_rows.append(dict(
+            id=id, email=f'user{id}@example.com', staff_number=f'{id:08d}',
+            password_hash=password_hash, role_id=role_id,
+            account_id=account_id, is_enabled=True))
+    _insert(connection, user_table, user_rows, chunk_size)
+    if user_rows:
+        _advance_sequence(connection, user_table)
+    report.add('users', users)
+
+    # Meetings are generated a day at a time with vectorised random draws &
+    # written a chunk at a time, so memory stays bounded however many are
+    # asked for
+    meeting_table = Meeting.__table__
+    dates = [start + timedelta(days=i) for i in range(days)]
+    if not weekends:
+        dates = [day for day in dates if day.weekday() < 5]
+    per_room = meetings_per_room_per_day
+    count = 0
+    if per_room and rooms:
+        meeting_rng = np.random.default_rng(seed)
+        room_ids = np.repeat([room['id'] for room in rooms], per_room)
+        room_accounts = np.repeat([room['account_id'] for room in rooms],
+                                  per_room)
+        # Users were dealt round-robin, so the users of the account at
+        # index k are first_user + k + i * accounts
+        account_index = np.repeat(
+            [room['account_id'] - first_account for room in rooms], per_room)
+        account_sizes = np.array([len(account_users[account_id])
+                                  for account_id in account_ids])[account_index]
+        titles = len(TITLES)
+        for day in dates:
+            start_times, durations = day_schedules(meeting_rng, len(rooms),
+                                                   per_room)
+            hosts = first_user + account_index + accounts * (
+                meeting_rng.random(len(room_ids)) * account_sizes).astype(int)
+            hosts = np.where(account_sizes > 0, hosts, -1)
+            title_index = meeting_rng.integers(0, titles, len(room_ids))
+            private = meeting_rng.random(len(room_ids)) < 0.1
+            rows = [
+                dict(title=TITLES[title], room_id=room_id,
+                     account_id=account_id, host_id=host if host >= 0 else None,
+                     booker_id=host if host >= 0 else None, date=day,
+                     start_time=start_time, end_time=start_time + duration,
+                     duration=duration, is_private=is_private)
+                for room_id, account_id, host, title, start_time, duration,
+                is_private in zip(room_ids.tolist(), room_accounts.tolist(),
+                                  hosts.tolist(), title_index.tolist(),
+                                  start_times.tolist(), durations.tolist(),
+                                  private.tolist())]
+            _insert(connection, meeting_table, rows, chunk_size)
+            count += len(rows)
+    # Everything but the rollups is one transaction, roles & regions included,
+    # as committing every chunk costs a sync each time
+    db.session.commit()
+    report.add('meetings', count)
+
+    # Core INSERTs bypass the ORM events that maintain the rollups
+    if count:
+        rebuild(dates[0], dates[-1] + timedelta(days=1))
+    return report
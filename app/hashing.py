@@ -0,0 +1,105 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, \
+    check_password_hash, generate_password_hash
+
+
+class HashingBusy(Exception):
+    """
+    Raised when the hashing pool & its queue are full, or a hash timed out
+    """
+
+
+def normalize_method(method):
+    """
+    Spell out the PBKDF2 iterations werkzeug would pick, as stored in hashes
+    """
+    if method.startswith('pbkdf2:') and method.count(':') == 1:
+        return f'{method}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+class PasswordHasher(object):
+    """
+    Hashes & verifies passwords on a bounded pool of worker threads
+
+    PBKDF2 releases the GIL, so the pool caps how many CPU cores logins use
+    at once rather than letting every request thread hash concurrently.
+    Once PASSWORD_HASH_WORKERS hashes are running & PASSWORD_HASH_QUEUE more
+    are waiting, further calls fail fast with HashingBusy, which the login
+    view turns into a 503, instead of piling up behind the pool.
+
+    PASSWORD_HASH_METHOD & PASSWORD_SALT_LENGTH set the cost of new hashes;
+    hashes made with other parameters keep verifying & are upgraded on the
+    next successful login (see needs_rehash). Bulk callers such as imports
+    pass block=True to wait for a slot instead, one hash at a time.
+    """
+    def __init__(self, app=None):
+        self.method = normalize_method('pbkdf2:sha256')
+        self.salt_length = 8
+        self.timeout = None
+        self.executor = None
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PASSWORD_HASH_METHOD', 'pbkdf2:sha256')
+        app.config.setdefault('PASSWORD_SALT_LENGTH', 8)
+        app.config.setdefault('PASSWORD_HASH_WORKERS', 4)
+        app.config.setdefault('PASSWORD_HASH_QUEUE', 64)
+        app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
+        self.method = normalize_method(app.config['PASSWORD_HASH_METHOD'])
+        self.salt_length = app.config['PASSWORD_SALT_LENGTH']
+        self.timeout = app.config['PASSWORD_HASH_TIMEOUT']
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+        if workers:
+            self.executor = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix='password-hash')
+            self._slots = threading.BoundedSemaphore(
+                workers + app.config['PASSWORD_HASH_QUEUE'])
+
+    def _run(self, f, *args, block=False):
+        # Without a pool (e.g. in scripts) hash in the calling thread
+        if self.executor is None:
+            return f(*args)
+        if not self._slots.acquire(blocking=block):
+            raise HashingBusy('too many passwords are being hashed')
+        try:
+            future = self.executor.submit(f, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        if block:
+            return future.result()
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise HashingBusy('timed out waiting for the password hash')
+
+    def hash(self, password, block=False):
+        return self._run(generate_password_hash, password, self.method,
+                         self.salt_length, block=block)
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        True if pwhash was made with another method, cost or a shorter salt
+        """
+        if not pwhash or pwhash.count('$') < 2:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        return method != self.method or len(salt) < self.salt_length
+
+
+password_hasher = PasswordHasher()
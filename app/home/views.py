@@ -1,15 +1,73 @@
-from flask import render_template
-from flask_login import login_required
+from datetime import datetime
+
+from flask import abort, jsonify, render_template, request
+from flask_login import current_user, login_required
 
 from . import home_bp
+from .. import db
+from ..availability import find_free_slots
+from ..fragments import fragment_cache
+from ..models import Site
+from ..rollups import period_start, usage, usage_by_scope
 
 
 @home_bp.route('/')
+@fragment_cache.cached_page('index')
 def index():
     return render_template('home/index.html', title="Welcome")
 
 
 @home_bp.route('/dashboard')
 @login_required
+@fragment_cache.cached_page('dashboard', depends=('meeting', 'room', 'site'))
 def dashboard():
-    return render_template('home/dashboard.html', title="Dashboard")
\ No newline at end of file
+    """
+    Show the usage of the user's account, read from the rollup tables
+    """
+    account_id = current_user.account_id
+    monthly = daily = sites = []
+    if account_id is not None:
+        this_month = period_start('month', datetime.today())
+        last_year = this_month.replace(year=this_month.year - 1)
+        monthly = usage('account', account_id, 'month', start=last_year)
+        daily = usage('account', account_id, 'day', start=this_month)
+        codes = db.session.query(Site.id, Site.code, Site.name) \
+            .filter(Site.account_id == account_id).order_by(Site.code).all()
+        totals = usage_by_scope('site', [id for id, _, _ in codes], 'month',
+                                this_month)
+        sites = [(code, name, totals[id]) for id, code, name in codes
+                 if id in totals]
+    return render_template('home/dashboard.html', title="Dashboard",
+                           monthly=monthly, daily=daily, sites=sites)
+
+
+@home_bp.route('/rooms/free-slots')
+@login_required
+def free_slots():
+    """
+    Find the first free slots of a given duration at a site or in a region
+    """
+    site_id = request.args.get('site_id', type=int)
+    region_id = request.args.get('region_id', type=int)
+    duration = request.args.get('duration', 30, type=int)
+    if site_id is None and region_id is None:
+        abort(400)
+    start = request.args.get('start')
+    try:
+        start = datetime.strptime(start, '%Y-%m-%d') if start else None
+        slots = find_free_slots(
+            duration, site_id=site_id, region_id=region_id, start=start,
+            days=min(request.args.get('days', 7, type=int), 90),
+            limit=min(request.args.get('limit', 10, type=int), 100),
+            step=max(request.args.get('step', 15, type=int), 1),
+            )
+    except ValueError:
+        abort(400)
+    return jsonify(slots=[
+        {
+            'room_id': slot.room_id,
+            'date': slot.date.strftime('%Y-%m-%d'),
+            'start_time': slot.start_time,
+            'end_time': slot.end_time,
+        } for slot in slots
+        ])
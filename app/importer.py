@@ -0,0 +1,361 @@
+import csv
+import io
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+
+from . import db
+from .booking import check_times, claim, day_of
+from .changes import bump_rooms
+from .fragments import entities, fragment_cache
+from .hashing import password_hasher
+from .models import Department, Meeting, Room, Site, User
+from .recurrence import ONE_DAY, active, expand
+from .rollups import apply_changes
+
+
+class RowError(ValueError):
+    """
+    Raised by converters & row hooks for a value that can't be imported
+    """
+
+
+class ImportReport(object):
+    """
+    Outcome of an import: rows written plus a (line, message) list of errors
+    """
+    def __init__(self, max_errors=500):
+        self.imported = 0
+        self.failed = 0
+        self.errors = []
+        self.max_errors = max_errors
+
+    def add_error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line, message))
+
+    @property
+    def truncated(self):
+        return self.failed > len(self.errors)
+
+    def __repr__(self):
+        return f'ImportReport: {self.imported} imported, {self.failed} failed'
+
+
+def _to_bool(value):
+    value = value.lower()
+    if value in ('1', 'true', 'yes', 'y', 't'):
+        return True
+    if value in ('0', 'false', 'no', 'n', 'f'):
+        return False
+    raise RowError(f'{value!r} is not a boolean')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        raise RowError(f'{value!r} is not an integer')
+
+
+def _to_date(value):
+    for fmt in ('%Y-%m-%d', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise RowError(f'{value!r} is not a date (YYYY-MM-DD)')
+
+
+def _converter(column):
+    """
+    Pick a converter for a CSV cell from the type of the target column
+    """
+    python_type = column.type.python_type
+    if python_type is bool:
+        return _to_bool
+    if python_type is int:
+        return _to_int
+    if python_type is datetime:
+        return _to_date
+    length = getattr(column.type, 'length', None)
+
+    def to_str(value):
+        if length is not None and len(value) > length:
+            raise RowError(f'longer than {length} characters')
+        return value
+    return to_str
+
+
+class Importer(object):
+    """
+    Validates CSV rows for one model & writes them with bulk INSERTs
+
+    Columns are converted according to the model's column types; a column is
+    required when it is NOT NULL & has no default. prepare(row) can be
+    overridden to derive or check values once a row has been converted.
+    """
+    model = None
+    # Column names accepted from the CSV file, besides those in extra_fields
+    fields = ()
+    extra_fields = ()
+
+    def __init__(self):
+        table = self.model.__table__
+        self.table = table
+        self.converters = {name: _converter(table.c[name])
+                           for name in self.fields}
+        self.required = [name for name in self.fields
+                         if not table.c[name].nullable
+                         and table.c[name].default is None]
+        # Every row must carry the same keys for executemany, so blank cells
+        # take the column default explicitly
+        self.defaults = {}
+        for name in self.fields:
+            default = table.c[name].default
+            self.defaults[name] = default.arg \
+                if default is not None and default.is_scalar else None
+
+    def convert(self, raw):
+        row = {}
+        for name in self.fields + self.extra_fields:
+            value = raw.get(name)
+            value = value.strip() if value is not None else ''
+            if value == '':
+                if name in self.required:
+                    raise RowError(f'{name} is required')
+                if name in self.defaults:
+                    row[name] = self.defaults[name]
+                continue
+            try:
+                row[name] = self.converters[name](value) \
+                    if name in self.converters else value
+            except RowError as e:
+                raise RowError(f'{name}: {e}')
+        return self.prepare(row)
+
+    def prepare(self, row):
+        return row
+
+    def check(self, chunk):
+        """
+        Split a chunk of converted (line, row) pairs into the rows to insert
+        & (line, message) errors, inside the transaction that inserts them
+        """
+        return chunk, []
+
+    def after_insert(self, connection, rows):
+        """
+        Called with the rows of each INSERT, inside its transaction
+        """
+
+    def missing_columns(self, header):
+        return [name for name in self.required if name not in header]
+
+
+class DepartmentImporter(Importer):
+    model = Department
+    fields = ('name', 'description')
+
+
+class SiteImporter(Importer):
+    model = Site
+    fields = ('code', 'name', 'address', 'region_id', 'account_id')
+
+
+class RoomImporter(Importer):
+    model = Room
+    fields = ('name', 'description', 'site_id', 'account_id', 'cost')
+
+
+class UserImporter(Importer):
+    model = User
+    fields = ('email', 'staff_number', 'role_id', 'account_id', 'is_enabled')
+    # Hashing is deliberately slow, so feeds without passwords import fastest
+    extra_fields = ('password',)
+
+    def prepare(self, row):
+        password = row.pop('password', None)
+        # Wait for the pool rather than failing like a login would when it
+        # is busy; an import holds at most one of its slots at a time
+        row['password_hash'] = password_hasher.hash(password, block=True) \
+            if password is not None else None
+        return row
+
+
+class MeetingImporter(Importer):
+    model = Meeting
+    fields = ('title', 'room_id', 'host_id', 'booker_id', 'date',
+              'start_time', 'duration', 'is_private')
+
+    def __init__(self):
+        super(MeetingImporter, self).__init__()
+        # Meetings carry the account of their room, looked up once per room
+        self.room_accounts = {}
+
+    def account_of(self, room_id):
+        if room_id not in self.room_accounts:
+            self.room_accounts[room_id] = db.session.query(Room.account_id) \
+                .filter(Room.id == room_id).scalar()
+        account_id = self.room_accounts[room_id]
+        if account_id is None:
+            raise RowError(f'room_id: no room {room_id}')
+        return account_id
+
+    def prepare(self, row):
+        row['account_id'] = self.account_of(row['room_id'])
+        row['date'] = day_of(row['date'])
+        row['end_time'] = row['start_time'] + row['duration']
+        try:
+            check_times(row['start_time'], row['end_time'])
+        except ValueError as e:
+            raise RowError(str(e))
+        return row
+
+    def check(self, chunk):
+        """
+        Claim the room days of a chunk, as booking does, & reject rows that
+        overlap a meeting or series occurrence or an earlier row
+
+        The schedules of every room & day in the chunk are read with one
+        query for meetings & one for series, whatever the size of the chunk.
+        """
+        keys = {(row['room_id'], row['date']) for _, row in chunk}
+        days_by_room = defaultdict(list)
+        for room_id, day in keys:
+            days_by_room[room_id].append(day)
+        # A fixed order, so that concurrent imports can't deadlock
+        for room_id in sorted(days_by_room):
+            claim(room_id, days_by_room[room_id])
+        room_ids = list(days_by_room)
+        days = sorted({day for _, day in keys})
+        booked = defaultdict(list)
+        meetings = db.session.query(
+                Meeting.room_id, Meeting.date, Meeting.start_time,
+                Meeting.end_time) \
+            .filter(Meeting.room_id.in_(room_ids), Meeting.date.in_(days))
+        for room_id, day, start_time, end_time in meetings:
+            booked[room_id, day].append((start_time, end_time))
+        series = active(room_ids, days[0], days[-1] + ONE_DAY)
+        for occurrence in expand(series, days[0], days[-1] + ONE_DAY):
+            key = (occurrence.room_id, occurrence.date)
+            if key in keys:
+                booked[key].append((occurrence.start_time,
+                                    occurrence.end_time))
+
+        accepted, rejected = [], []
+        for line, row in chunk:
+            schedule = booked[row['room_id'], row['date']]
+            if any(start_time < row['end_time'] and end_time > row['start_time']
+                   for start_time, end_time in schedule):
+                rejected.append((line, f'room {row["room_id"]} is already '
+                                       f'booked at that time'))
+                continue
+            schedule.append((row['start_time'], row['end_time']))
+            accepted.append((line, row))
+        return accepted, rejected
+
+    def after_insert(self, connection, rows):
+        # Bulk INSERTs bypass the ORM events that maintain the rollups &
+        # room versions
+        apply_changes(connection, [(1, row['room_id'], row['date'],
+                                    row['duration']) for row in rows])
+        bump_rooms(connection, {row['room_id'] for row in rows})
+
+
+importers = {
+    'departments': DepartmentImporter,
+    'sites': SiteImporter,
+    'rooms': RoomImporter,
+    'users': UserImporter,
+    'meetings': MeetingImporter,
+}
+
+
+def _write_chunk(importer, chunk, report):
+    """
+    Check & insert a chunk of (line, row) pairs with one executemany & commit
+
+    If the chunk violates a constraint, it is rolled back & retried one row
+    at a time so that only the offending rows are reported & skipped.
+    """
+    try:
+        accepted, rejected = importer.check(chunk)
+        rows = [row for _, row in accepted]
+        if rows:
+            db.session.execute(importer.table.insert(), rows)
+            importer.after_insert(db.session.connection(), rows)
+        db.session.commit()
+        report.imported += len(rows)
+        for line, message in rejected:
+            report.add_error(line, message)
+        return
+    except IntegrityError:
+        db.session.rollback()
+
+    for line, row in chunk:
+        try:
+            accepted, rejected = importer.check([(line, row)])
+            if rejected:
+                db.session.rollback()
+                report.add_error(*rejected[0])
+                continue
+            db.session.execute(importer.table.insert(), row)
+            importer.after_insert(db.session.connection(), [row])
+            db.session.commit()
+            report.imported += 1
+        except IntegrityError as e:
+            db.session.rollback()
+            report.add_error(line, str(e.orig))
+
+
+def import_csv(stream, name, chunk_size=1000, max_errors=500, progress=None):
+    """
+    Stream CSV rows from a binary file object into the table for name
+
+    Rows are decoded & parsed incrementally, so memory use is bounded by
+    chunk_size no matter how big the upload is. Each chunk is committed on its
+    own; invalid rows are reported in the returned ImportReport rather than
+    aborting the import. progress, if given, is called with the report after
+    every chunk.
+    """
+    importer = importers[name]()
+    report = ImportReport(max_errors=max_errors)
+    # utf-8-sig drops the byte order mark spreadsheet programs like to add
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    chunk = []
+    try:
+        missing = importer.missing_columns(reader.fieldnames or ())
+        if missing:
+            report.add_error(1, f'missing column(s): {", ".join(missing)}')
+            return report
+
+        for raw in reader:
+            try:
+                chunk.append((reader.line_num, importer.convert(raw)))
+            except RowError as e:
+                report.add_error(reader.line_num, str(e))
+                continue
+            if len(chunk) >= chunk_size:
+                _write_chunk(importer, chunk, report)
+                chunk = []
+                if progress is not None:
+                    progress(report)
+        if chunk:
+            _write_chunk(importer, chunk, report)
+
+    except UnicodeDecodeError:
+        report.add_error(reader.line_num + 1, 'not UTF-8 encoded text')
+    except (csv.Error, SQLAlchemyError) as e:
+        db.session.rollback()
+        report.add_error(reader.line_num, str(e))
+    finally:
+        # Detach so the wrapper doesn't close the upload when collected
+        text.detach()
+    if report.imported:
+        # Bulk INSERTs bypass the ORM events that evict cached fragments
+        fragment_cache.bump(entities[importer.model])
+    return report
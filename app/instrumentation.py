@@ -0,0 +1,316 @@
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import before_render_template, current_app, g, request, \
+    template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# Seconds after which a statement is logged as slow; set by init_app
+slow_query_threshold = None
+
+
+class QueryBudgetExceeded(AssertionError):
+    """
+    Raised when a request or block runs more SQL statements than allowed
+    """
+    def __init__(self, budget, statements):
+        self.budget = budget
+        self.statements = statements
+        listing = '\n'.join(f'  {statement}' for statement in statements)
+        super(QueryBudgetExceeded, self).__init__(
+            f'{len(statements)} queries exceed the budget of {budget}:\n'
+            f'{listing}')
+
+
+class QueryCounter(object):
+    """
+    Number & total time of the statements run while the counter is active;
+    the statements themselves are kept only if keep_statements is set
+    """
+    def __init__(self, keep_statements=True):
+        self.statements = [] if keep_statements else None
+        self.count = 0
+        self.duration = 0.0
+
+
+def normalize(statement):
+    """
+    Reduce a statement to its shape, so that slow queries group together
+    """
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    # IN lists vary in length with the data, not the query
+    return re.sub(r'\(\?(?:, \?)+\)', '(?...)', statement)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context,
+                   executemany):
+    elapsed = time.perf_counter() - conn.info['statement_started'].pop()
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+        counter.duration += elapsed
+        if counter.statements is not None:
+            counter.statements.append(statement)
+    if slow_query_threshold is not None and elapsed >= slow_query_threshold:
+        logger.warning('Slow query (%.1f ms): %s', elapsed * 1000,
+                       normalize(statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _failed_statement(context):
+    # after_cursor_execute doesn't run for a statement that failed
+    connection = context.connection
+    if connection is not None and connection.info.get('statement_started'):
+        connection.info['statement_started'].pop()
+
+
+def _push_counter(keep_statements=True):
+    counter = QueryCounter(keep_statements)
+    _local.__dict__.setdefault('counters', []).append(counter)
+    return counter
+
+
+def _pop_counter(counter):
+    _local.counters.remove(counter)
+
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements executed by this thread inside the block
+    """
+    counter = _push_counter()
+    try:
+        yield counter
+    finally:
+        _pop_counter(counter)
+
+
+@contextmanager
+def assert_max_queries(budget):
+    """
+    Fail with QueryBudgetExceeded if the block runs more than budget queries
+    """
+    with count_queries() as counter:
+        yield counter
+    if counter.count > budget:
+        raise QueryBudgetExceeded(budget, counter.statements)
+
+
+def query_budget(budget):
+    """
+    Override QUERY_BUDGET for one view
+
+    budget is a number, or a function returning the budget of the current
+    request for views whose work grows with what they're asked to do.
+    """
+    def decorator(f):
+        f.query_budget = budget
+        return f
+    return decorator
+
+
+class EndpointStats(object):
+    def __init__(self, window):
+        self.requests = 0
+        self.latency = 0.0
+        self.template_time = 0.0
+        self.queries = 0
+        self.query_time = 0.0
+        # Latencies of the most recent requests, for percentiles
+        self.recent = deque(maxlen=window)
+
+    def percentiles(self, *quantiles):
+        latencies = sorted(self.recent)
+        if not latencies:
+            return [0.0 for _ in quantiles]
+        return [latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+                for q in quantiles]
+
+
+class RequestStats(object):
+    """
+    In-memory, per-process totals & rolling latency percentiles by endpoint
+    """
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, latency, template_time, queries, query_time):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats(self.window)
+            stats.requests += 1
+            stats.latency += latency
+            stats.template_time += template_time
+            stats.queries += queries
+            stats.query_time += query_time
+            stats.recent.append(latency)
+
+    def snapshot(self):
+        """
+        Return a list of dicts, one per endpoint, busiest database user first
+        """
+        with self._lock:
+            rows = []
+            for endpoint, stats in self.endpoints.items():
+                p50, p95, p99 = stats.percentiles(*self.quantiles)
+                rows.append({
+                    'endpoint': endpoint,
+                    'requests': stats.requests,
+                    'latency': stats.latency,
+                    'template_time': stats.template_time,
+                    'queries': stats.queries,
+                    'query_time': stats.query_time,
+                    'p50': p50, 'p95': p95, 'p99': p99,
+                    })
+        return sorted(rows, key=lambda row: row['query_time'], reverse=True)
+
+    def prometheus(self):
+        """
+        Render the stats in the Prometheus text exposition format
+        """
+        lines = [
+            '# TYPE storm_request_duration_seconds summary',
+            '# TYPE storm_template_duration_seconds_total counter',
+            '# TYPE storm_sql_queries_total counter',
+            '# TYPE storm_sql_duration_seconds_total counter',
+            ]
+        for row in self.snapshot():
+            label = 'endpoint="{}"'.format(
+                row['endpoint'].replace('\\', '\\\\').replace('"', '\\"'))
+            for q, key in zip(self.quantiles, ('p50', 'p95', 'p99')):
+                lines.append(f'storm_request_duration_seconds'
+                             f'{{{label},quantile="{q}"}} {row[key]:.6f}')
+            lines += [
+                f'storm_request_duration_seconds_sum{{{label}}} '
+                f'{row["latency"]:.6f}',
+                f'storm_request_duration_seconds_count{{{label}}} '
+                f'{row["requests"]}',
+                f'storm_template_duration_seconds_total{{{label}}} '
+                f'{row["template_time"]:.6f}',
+                f'storm_sql_queries_total{{{label}}} {row["queries"]}',
+                f'storm_sql_duration_seconds_total{{{label}}} '
+                f'{row["query_time"]:.6f}',
+                ]
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+request_stats = RequestStats()
+
+
+def _start_template(sender, template, context, **extra):
+    g.setdefault('template_started', []).append(time.perf_counter())
+
+
+def _end_template(sender, template, context, **extra):
+    started = g.get('template_started')
+    if started:
+        g.template_time = g.get('template_time', 0.0) + \
+            time.perf_counter() - started.pop()
+
+
+def _init_stats(app):
+    """
+    Record latency, template & SQL time of every request in request_stats
+
+    Latency is measured up to the point the response is returned, so the
+    body of a streamed response isn't included.
+    """
+    global slow_query_threshold
+    slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD']
+    request_stats.window = app.config['REQUEST_STATS_WINDOW']
+    before_render_template.connect(_start_template, app)
+    template_rendered.connect(_end_template, app)
+
+    @app.before_request
+    def start_timing():
+        g.request_started = time.perf_counter()
+        g.stats_counter = _push_counter(keep_statements=False)
+
+    @app.after_request
+    def record_timing(response):
+        counter = g.pop('stats_counter', None)
+        if counter is not None:
+            _pop_counter(counter)
+            request_stats.record(
+                request.endpoint or 'unknown',
+                time.perf_counter() - g.request_started,
+                g.get('template_time', 0.0), counter.count, counter.duration)
+        return response
+
+    @app.teardown_request
+    def stop_timing(exc):
+        counter = g.pop('stats_counter', None)
+        if counter is not None:
+            _pop_counter(counter)
+
+
+def _init_budget(app):
+    @app.before_request
+    def start_counting():
+        g.query_counter = _push_counter()
+
+    @app.after_request
+    def check_budget(response):
+        counter = g.pop('query_counter', None)
+        if counter is None:
+            return response
+        _pop_counter(counter)
+        view = current_app.view_functions.get(request.endpoint)
+        budget = getattr(view, 'query_budget', app.config['QUERY_BUDGET'])
+        if callable(budget):
+            budget = budget()
+        if counter.count > budget:
+            raise QueryBudgetExceeded(budget, counter.statements)
+        return response
+
+    @app.teardown_request
+    def stop_counting(exc):
+        # after_request is skipped when the view raised
+        counter = g.pop('query_counter', None)
+        if counter is not None:
+            _pop_counter(counter)
+
+
+def init_app(app):
+    """
+    Set up the opt-in request instrumentation
+
+    REQUEST_STATS records per-endpoint latency, template time, SQL count &
+    SQL time (see the admin.stats page) and logs statements slower than
+    SLOW_QUERY_THRESHOLD seconds. QUERY_BUDGET (e.g. in testing) fails any
+    request that runs more statements than the budget of its view, so an
+    N+1 query pattern can't creep back in unnoticed.
+    """
+    app.config.setdefault('QUERY_BUDGET', None)
+    app.config.setdefault('REQUEST_STATS', False)
+    app.config.setdefault('REQUEST_STATS_WINDOW', 1000)
+    app.config.setdefault('SLOW_QUERY_THRESHOLD', 0.1)
+    if app.config['REQUEST_STATS']:
+        _init_stats(app)
+    if app.config['QUERY_BUDGET'] is not None:
+        _init_budget(app)
@@ -0,0 +1,261 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy.exc import OperationalError
+
+from . import db
+from .models import Job
+
+jobs = Job.__table__
+
+# Functions that can be run as jobs, by name (see task())
+tasks = {}
+
+
+class JobsBusy(Exception):
+    """
+    Raised when every worker is busy & the queue of waiting jobs is full
+    """
+
+
+def task(name):
+    """
+    Register a function as the job called name
+
+    It is called with a Progress & the keyword arguments the job was
+    submitted with, inside an app context of its own; whatever it returns
+    is stored as the job's result, so it must be JSON serializable.
+    """
+    def decorator(f):
+        tasks[name] = f
+        return f
+    return decorator
+
+
+def _update(job_id, **values):
+    """
+    Write to a job's row in a transaction of its own
+
+    The job's work runs in the session, which may be in the middle of a
+    transaction of its own when progress is reported.
+    """
+    values['updated_at'] = datetime.utcnow()
+    with db.engine.begin() as connection:
+        connection.execute(jobs.update().where(jobs.c.id == job_id)
+                           .values(**values))
+
+
+class Progress(object):
+    """
+    Reports how far a job has got; called as progress(done, total, message)
+
+    Calls within interval seconds of the last write are only remembered,
+    so a task can report every row without a write per row. A write that
+    finds the database locked is skipped, as the next one will catch up.
+    """
+    def __init__(self, job_id, interval=1.0):
+        self.job_id = job_id
+        self.interval = interval
+        self.written = 0
+        self.reported = False
+        self.done = 0
+        self.total = None
+        self.message = None
+
+    def __call__(self, done, total=None, message=None):
+        self.reported = True
+        self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message[:200]
+        now = time.monotonic()
+        if now - self.written < self.interval:
+            return
+        values = dict(progress=done)
+        if total is not None:
+            values['total'] = total
+        if message is not None:
+            values['message'] = message[:200]
+        try:
+            _update(self.job_id, **values)
+            self.written = now
+        except OperationalError:
+            pass
+
+    def finished(self):
+        """
+        Return the values completing the job's row: the last report, even
+        if it wasn't written, with progress at the total
+        """
+        if not self.reported:
+            return {}
+        total = self.total if self.total is not None else self.done
+        values = dict(progress=total, total=total)
+        if self.message is not None:
+            values['message'] = self.message
+        return values
+
+
+class JobRunner(object):
+    """
+    Runs registered tasks on a bounded pool of threads in this process
+
+    Each job is recorded in the jobs table before it is queued & updated as
+    it runs, so any worker process can report on it. Once JOB_WORKERS jobs
+    are running & JOB_QUEUE more are waiting, submit() fails fast with
+    JobsBusy. With JOB_WORKERS = 0 jobs run inline, e.g. in tests. There is
+    no broker: jobs queued or running in a process that exits stay in that
+    state.
+    """
+    def __init__(self, app=None):
+        self.executor = None
+        self._slots = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('JOB_WORKERS', 2)
+        app.config.setdefault('JOB_QUEUE', 16)
+        workers = app.config['JOB_WORKERS']
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = None
+        if workers:
+            self.executor = ThreadPoolExecutor(max_workers=workers,
+                                               thread_name_prefix='job')
+            self._slots = threading.BoundedSemaphore(
+                workers + app.config['JOB_QUEUE'])
+
+    def submit(self, name, user_id=None, **params):
+        """
+        Queue the task called name & return the id of its job
+        """
+        if name not in tasks:
+            raise KeyError(f'no task called {name!r}')
+        if self.executor is not None and \
+                not self._slots.acquire(blocking=False):
+            raise JobsBusy('too many jobs are queued')
+        try:
+            job = Job(name=name, params=json.dumps(params),
+                      created_by=user_id, status='queued')
+            db.session.add(job)
+            db.session.commit()
+            job_id = job.id
+            app = current_app._get_current_object()
+            if self.executor is None:
+                self.run(app, job_id)
+                return job_id
+            future = self.executor.submit(self.run, app, job_id)
+        except BaseException:
+            if self.executor is not None:
+                self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return job_id
+
+    def run(self, app, job_id):
+        with app.app_context():
+            job = Job.query.get(job_id)
+            name, params = job.name, json.loads(job.params or '{}')
+            db.session.commit()
+            _update(job_id, status='running', started_at=datetime.utcnow())
+            progress = Progress(job_id)
+            try:
+                result = tasks[name](progress, **params)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.exception('Job %s (%s) failed', job_id, name)
+                _update(job_id, status='failed',
+                        error=f'{type(e).__name__}: {e}',
+                        finished_at=datetime.utcnow())
+            else:
+                _update(job_id, status='done', result=json.dumps(result),
+                        finished_at=datetime.utcnow(), **progress.finished())
+            finally:
+                db.session.remove()
+
+
+job_runner = JobRunner()
+
+
+def save_upload(upload):
+    """
+    Copy an uploaded file to a temporary file a job can read after the
+    request has ended, & return its path
+    """
+    fd, path = tempfile.mkstemp(prefix='upload-', suffix='.csv')
+    with os.fdopen(fd, 'wb') as f:
+        upload.save(f)
+    return path
+
+
+# Tasks
+
+
+@task('import')
+def import_file(progress, path, table, chunk_size=1000, max_errors=500):
+    """
+    Import a saved CSV upload (see save_upload) & delete it
+    """
+    from .importer import import_csv
+
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            def report_progress(report):
+                progress(f.tell(), size, f'{report.imported} imported, '
+                                         f'{report.failed} rejected')
+
+            report = import_csv(f, table, chunk_size=chunk_size,
+                                max_errors=max_errors,
+                                progress=report_progress)
+            # import_csv doesn't report the last chunk
+            report_progress(report)
+    finally:
+        os.remove(path)
+    return dict(imported=report.imported, failed=report.failed,
+                errors=report.errors, truncated=report.truncated)
+
+
+@task('rebuild_rollups')
+def rebuild_rollups(progress, start=None, end=None):
+    from .rollups import rebuild
+
+    parse = lambda day: datetime.strptime(day, '%Y-%m-%d') if day else None
+    return dict(rows=rebuild(parse(start), parse(end)))
+
+
+@task('archive_meetings')
+def archive_meetings(progress, before=None):
+    from .archive import archive
+
+    before = datetime.strptime(before, '%Y-%m-%d') if before else None
+    moved = archive(before, progress=lambda moved: progress(
+        moved, message=f'{moved} meetings archived'))
+    return dict(archived=moved)
+
+
+@task('rebuild_search')
+def rebuild_search(progress):
+    from .search import rebuild, supported
+
+    connection = db.session.connection()
+    if supported(connection):
+        rebuild(connection)
+        db.session.commit()
+    return {}
+
+
+@task('insert_roles')
+def insert_roles(progress):
+    from .models import Role
+
+    Role.insert_roles()
+    return {}
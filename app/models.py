@@ -1,7 +1,9 @@
-from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from datetime import datetime
+
+from flask_login import AnonymousUserMixin, UserMixin
 
 from app import db, login_manager
+from app.hashing import password_hasher
 
 # Try naming classes w/ regular nouns (plurals are formed by adding 's'/'es')
 #
@@ -19,11 +21,17 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(80), unique=True, index=True)
     staff_number = db.Column(db.String(10))
-    password_hash = db.Column(db.String(128))
+    # Room for the longer hashes of stronger PASSWORD_HASH_METHODs
+    password_hash = db.Column(db.String(256))
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
     account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'))
     is_enabled = db.Column(db.Boolean, default=True)
 
+    # Per-tenant user lists & lookups seek on the account first
+    __table_args__ = (
+        db.Index('ix_users_account_email', 'account_id', 'email'),
+        )
+
     #username = db.Column(db.String(80), index=True, unique=True)
     #surname = db.Column(db.String(30))
     #given_name = db.Column(db.String(60))
@@ -40,25 +48,62 @@ class User(UserMixin, db.Model):
     def password(self):
         raise AttributeError('password is not a readable attribute.')
 
+    # Both run on the bounded hashing pool & may raise HashingBusy (see
+    # app/hashing.py)
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
+
+    @property
+    def needs_rehash(self):
+        return password_hasher.needs_rehash(self.password_hash)
+
+    @property
+    def permissions(self):
+        return (self.role.permissions or 0) if self.role is not None else 0
+
+    def can(self, perm):
+        return self.permissions & perm == perm
+
+    @property
+    def is_admin(self):
+        return self.can(Permission.ADMIN)
 
     def __repr__(self):
         return f'User: {self.email}'
 
 
+# Anonymous visitors get the same permission interface as users, so views and
+# templates can call current_user.can() without checking is_authenticated
+class AnonymousUser(AnonymousUserMixin):
+    permissions = 0
+    is_admin = False
+
+    def can(self, perm):
+        return False
+
+login_manager.anonymous_user = AnonymousUser
+
+
 # Set up user_loader
+#
+# This runs on every authenticated request, so it is answered from a
+# per-process cache of detached users (see app/user_cache.py); current_user is
+# therefore a read-only CachedUser rather than a User instance.
 @login_manager.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # Imported here as app.user_cache builds on the models in this module
+    from app.user_cache import user_cache
+    return user_cache.load(int(id))
 
 
 class Account(db.Model):
     __tablename__ = 'accounts'
+    # An account is its own tenant (see database.TenantQuery)
+    __tenant_column__ = 'id'
 
     id = db.Column(db.Integer, primary_key=True)
     code = db.Column(db.String(8), unique=True)
@@ -75,6 +120,17 @@ class Account(db.Model):
         return f'Account: {self.name}'
 
 
+class Department(db.Model):
+    __tablename__ = 'departments'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(60), unique=True, nullable=False)
+    description = db.Column(db.String(200))
+
+    def __repr__(self):
+        return f'Department: {self.name}'
+
+
 class Region(db.Model):
     __tablename__ = 'regions'
 
@@ -84,6 +140,8 @@ class Region(db.Model):
     # ISO 3166 Short name
     name = db.Column(db.String(30))
 
+    sites = db.relationship('Site', backref='region', lazy='dynamic')
+
     def __repr__(self):
         return f'Region: {self.code}'
 
@@ -101,9 +159,13 @@ class Site(db.Model):
         db.ForeignKey('accounts.id'),
         nullable=False
         )
-    # A tuple that contains only the item, the constraint instance
+    # The unique constraint doubles as the index of an account's sites
     __table_args__ = (
         db.UniqueConstraint('account_id', 'code', name='_unique_account_site'),
+        db.Index('ix_sites_account_region', 'account_id', 'region_id'),
+        # Keyset pagination of the admin list (see app/pagination.py)
+        db.Index('ix_sites_code_id', 'code', 'id'),
+        db.Index('ix_sites_name_id', 'name', 'id'),
         )
 
     rooms = db.relationship('Room', backref='site', lazy='dynamic')
@@ -125,8 +187,16 @@ class Room(db.Model):
         nullable=False
         )
     cost = db.Column(db.Integer)
+    # Bumped whenever one of the room's meetings is added, moved or removed
+    # (see app/changes.py), so clients can tell whether its schedule changed
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.DateTime)
     __table_args__ = (
         db.UniqueConstraint('account_id', 'name', name='_unique_account_room'),
+        db.Index('ix_rooms_account_site', 'account_id', 'site_id'),
+        # Keyset pagination of the admin list (see app/pagination.py)
+        db.Index('ix_rooms_name_id', 'name', 'id'),
+        db.Index('ix_rooms_cost_id', 'cost', 'id'),
         )
 
     meetings = db.relationship('Meeting', backref='room', lazy='dynamic')
@@ -141,18 +211,231 @@ class Meeting(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60), nullable=False)
     room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False)
-    host_id = db.Column(db.Integer, db.ForeignKey('users.id'))
-    booker_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    # Copied from the room when the meeting is flushed (see app/tenancy.py),
+    # so an account's meetings are found without joining rooms
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'),
+                           nullable=False)
+    host_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    booker_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
     date = db.Column(db.DateTime, nullable=False)
     start_time = db.Column(db.Integer, nullable=False)
     end_time = db.Column(db.Integer, nullable=False) # calculated
     duration = db.Column(db.Integer, nullable=False)
     is_private = db.Column(db.Boolean, default=False)
 
+    # Two foreign keys point at users, so each relationship names its own
+    host = db.relationship(
+        'User', foreign_keys=[host_id],
+        backref=db.backref('hosted_meetings', lazy='dynamic'))
+    booker = db.relationship(
+        'User', foreign_keys=[booker_id],
+        backref=db.backref('booked_meetings', lazy='dynamic'))
+
+    # start_time & end_time are minutes past midnight of 'date'. Leading with
+    # (room_id, date) lets an overlap check seek straight to one room's day &
+    # range-scan start_time, while end_time is read from the index itself
+    # rather than the table rows. An account's meetings by day have an index of
+    # their own, which also serves a keyset page of them.
+    __table_args__ = (
+        db.Index('ix_meetings_room_schedule',
+                 'room_id', 'date', 'start_time', 'end_time'),
+        db.Index('ix_meetings_account_date_id', 'account_id', 'date', 'id'),
+        # Keyset pagination of the admin list (see app/pagination.py)
+        db.Index('ix_meetings_date_id', 'date', 'id'),
+        )
+
+    def __init__(self, **kwargs):
+        super(Meeting, self).__init__(**kwargs)
+        if self.end_time is None and None not in (self.start_time, self.duration):
+            self.end_time = self.start_time + self.duration
+
     def __repr__(self):
         return f'Meeting {self.id} for {self.id} last for {self.duration}'
 
 
+class ArchivedMeeting(db.Model):
+    """
+    A meeting moved out of the meetings table once it's old enough (see
+    app/archive.py), keeping its id
+
+    Archived rows are only read by reports, so the table has no foreign keys
+    & just the indexes those need.
+    """
+    __tablename__ = 'meetings_archive'
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    title = db.Column(db.String(60), nullable=False)
+    room_id = db.Column(db.Integer, nullable=False)
+    account_id = db.Column(db.Integer, nullable=False)
+    host_id = db.Column(db.Integer)
+    booker_id = db.Column(db.Integer)
+    date = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.Integer, nullable=False)
+    end_time = db.Column(db.Integer, nullable=False)
+    duration = db.Column(db.Integer, nullable=False)
+    is_private = db.Column(db.Boolean, default=False)
+    __table_args__ = (
+        db.Index('ix_meetings_archive_date_id', 'date', 'id'),
+        db.Index('ix_meetings_archive_room_date', 'room_id', 'date'),
+        )
+
+    def __repr__(self):
+        return f'ArchivedMeeting {self.id} on {self.date:%Y-%m-%d}'
+
+
+class RoomDay(db.Model):
+    """
+    A room's bookings on one day, the row every booking of that day locks
+
+    Claiming the row is the first write of a booking transaction (see
+    booking.claim), so concurrent bookings of the same room & day are
+    serialized by the database while other rooms & days go ahead.
+    """
+    __tablename__ = 'room_days'
+
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), primary_key=True)
+    date = db.Column(db.DateTime, primary_key=True)
+    # Number of times the day was claimed, i.e. of bookings & moves into it
+    claims = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'RoomDay: {self.room_id} {self.date}'
+
+
+class MeetingSeries(db.Model):
+    """
+    A meeting repeating daily or weekly, stored as its rule instead of rows
+
+    Occurrences are computed only for the days being viewed or checked (see
+    app/recurrence.py); cancelled occurrences are kept as SeriesExceptions.
+    """
+    __tablename__ = 'meeting_series'
+
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(60), nullable=False)
+    room_id = db.Column(db.Integer, db.ForeignKey('rooms.id'), nullable=False)
+    # Copied from the room, like Meeting.account_id
+    account_id = db.Column(db.Integer, db.ForeignKey('accounts.id'),
+                           nullable=False)
+    host_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    booker_id = db.Column(db.Integer, db.ForeignKey('users.id'), index=True)
+    # Midnight of the first & last day the series may occur on
+    start_date = db.Column(db.DateTime, nullable=False)
+    until = db.Column(db.DateTime, nullable=False)
+    start_time = db.Column(db.Integer, nullable=False)
+    end_time = db.Column(db.Integer, nullable=False) # calculated
+    duration = db.Column(db.Integer, nullable=False)
+    is_private = db.Column(db.Boolean, default=False)
+    # 'daily' or 'weekly', every interval days/weeks
+    frequency = db.Column(db.String(6), nullable=False)
+    interval = db.Column(db.Integer, nullable=False, default=1)
+    # Weekly series: bit n is set for weekday n (Monday is 0)
+    weekdays = db.Column(db.Integer)
+
+    room = db.relationship(
+        'Room', backref=db.backref('series', lazy='dynamic'))
+    host = db.relationship('User', foreign_keys=[host_id])
+    booker = db.relationship('User', foreign_keys=[booker_id])
+    exceptions = db.relationship('SeriesException', backref='series',
+                                 cascade='all, delete-orphan')
+
+    # Finds the series of a room, or of an account, that may occur within a
+    # window of days
+    __table_args__ = (
+        db.Index('ix_meeting_series_room_window',
+                 'room_id', 'start_date', 'until'),
+        db.Index('ix_meeting_series_account_window',
+                 'account_id', 'start_date', 'until'),
+        )
+
+    def __init__(self, **kwargs):
+        super(MeetingSeries, self).__init__(**kwargs)
+        if self.end_time is None and None not in (self.start_time, self.duration):
+            self.end_time = self.start_time + self.duration
+        if self.interval is None:
+            self.interval = 1
+
+    def __repr__(self):
+        return f'MeetingSeries {self.id}: {self.title} ({self.frequency})'
+
+
+class SeriesException(db.Model):
+    """
+    A cancelled occurrence of a MeetingSeries
+
+    Only cancellation is recorded here; booking.move_occurrence moves an
+    occurrence by cancelling it & booking a one-off Meeting in its place.
+    """
+    __tablename__ = 'series_exceptions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    series_id = db.Column(db.Integer, db.ForeignKey('meeting_series.id'),
+                          nullable=False)
+    date = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('series_id', 'date',
+                            name='_unique_series_exception'),
+        )
+
+    def __repr__(self):
+        return f'SeriesException: {self.series_id} {self.date}'
+
+
+class UsageRollup(db.Model):
+    """
+    Booked meetings, minutes & cost of a room, site or account per day/month
+
+    Maintained incrementally as meetings change (see app/rollups.py), so
+    reports read a handful of rows instead of aggregating meetings.
+    """
+    __tablename__ = 'usage_rollups'
+
+    id = db.Column(db.Integer, primary_key=True)
+    # 'room', 'site' or 'account'
+    scope = db.Column(db.String(8), nullable=False)
+    scope_id = db.Column(db.Integer, nullable=False)
+    # 'day' or 'month'; period_start is midnight of the day/first of the month
+    period = db.Column(db.String(5), nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False)
+    meetings = db.Column(db.Integer, nullable=False, default=0)
+    minutes = db.Column(db.Integer, nullable=False, default=0)
+    cost = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'scope_id', 'period', 'period_start',
+                            name='_unique_usage_rollup'),
+        )
+
+    def __repr__(self):
+        return f'UsageRollup: {self.scope} {self.scope_id} {self.period_start}'
+
+
+class UsageDelta(db.Model):
+    """
+    A change to a site or account rollup not yet added to usage_rollups
+
+    Bookings append these instead of updating rows every booking in the
+    site or account would wait on; they're folded into the rollups in the
+    background (see rollups.RollupFolder).
+    """
+    __tablename__ = 'usage_deltas'
+
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(8), nullable=False)
+    scope_id = db.Column(db.Integer, nullable=False)
+    period = db.Column(db.String(5), nullable=False)
+    period_start = db.Column(db.DateTime, nullable=False)
+    meetings = db.Column(db.Integer, nullable=False)
+    minutes = db.Column(db.Integer, nullable=False)
+    cost = db.Column(db.Integer, nullable=False)
+    __table_args__ = (
+        db.Index('ix_usage_deltas_rollup',
+                 'scope', 'scope_id', 'period', 'period_start'),
+        )
+
+    def __repr__(self):
+        return f'UsageDelta: {self.scope} {self.scope_id} {self.period_start}'
+
+
 class Permission:
     READ = 1
     ADMIN = 512
@@ -193,7 +476,7 @@ class Role(db.Model):
         return self.permissions & perm == perm
 
     @staticmethod
-    def insert_roles():
+    def insert_roles(commit=True):
         roles = {
             'User': [Permission.READ],
             'Administrator': [Permission.READ, Permission.ADMIN],
@@ -208,7 +491,42 @@ class Role(db.Model):
                 role.add_permission(perm)
             role.default = (role.name == default_role)
             db.session.add(role)
-        db.session.commit()
+        if commit:
+            db.session.commit()
+
+    def __repr__(self):
+        return f'Role: {self.name}'
+
+
+class Job(db.Model):
+    """
+    A task run in the background by app/jobs.py, with its progress & outcome
+
+    status goes from 'queued' to 'running' to 'done' or 'failed'; progress
+    counts up to total (when known) while the job runs.
+    """
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(40), nullable=False)
+    # JSON encoded keyword arguments of the task, & its return value
+    params = db.Column(db.Text)
+    result = db.Column(db.Text)
+    status = db.Column(db.String(10), nullable=False, default='queued')
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    message = db.Column(db.String(200))
+    error = db.Column(db.Text)
+    created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, index=True)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
 
     def __repr__(self):
-        return f'Role: {self.name}'
\ No newline at end of file
+        return f'Job {self.id}: {self.name} ({self.status})'
@@ -0,0 +1,165 @@
+import base64
+import json
+from datetime import datetime
+
+from flask import current_app, request
+from sqlalchemy import and_, or_
+
+
+class KeysetPage(object):
+    """
+    One page of a keyset (seek) paginated query
+
+    Instead of an OFFSET, which makes the database walk past every skipped
+    row, the next page starts right after the (sort value, id) of the last
+    row shown. With an index on (sort column, id) each page costs the same
+    no matter how deep into the table it is.
+    """
+    def __init__(self, items, page_size, sort, descending, cursor=None,
+                 next_cursor=None):
+        self.items = items
+        self.page_size = page_size
+        self.sort = sort
+        self.descending = descending
+        self.cursor = cursor
+        self.next_cursor = next_cursor
+        # Query string the page was requested with, for building page links
+        self.args = {}
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def is_first(self):
+        return self.cursor is None
+
+    def url_args(self, **changes):
+        """
+        The page's query string arguments updated with changes (None removes)
+        """
+        args = dict(self.args, **changes)
+        return {name: value for name, value in args.items() if value is not None}
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def _encode(values):
+    values = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _decode(cursor, sort_column):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id = json.loads(data)
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid cursor {cursor!r}')
+    if value is not None and sort_column.type.python_type is datetime:
+        value = datetime.fromisoformat(value)
+    return value, id
+
+
+def _seek(column, id_column, value, id, descending):
+    """
+    Filter for the rows that follow (value, id) in the page order
+
+    NULL sort values come first, as SQLite & MySQL order them, & are
+    compared explicitly rather than coalesced: a function around the column
+    would keep its index from serving the seek & the ORDER BY.
+    """
+    if descending:
+        if value is None:
+            return and_(column.is_(None), id_column < id)
+        # The redundant bound lets the index seek instead of scanning
+        after = and_(column <= value, or_(column < value, id_column < id))
+        return or_(after, column.is_(None)) if column.nullable else after
+    if value is None:
+        return or_(column.isnot(None), id_column > id)
+    return and_(column >= value, or_(column > value, id_column > id))
+
+
+def _order(query, column, id_column, descending):
+    key = column.desc() if descending else column.asc()
+    # PostgreSQL puts NULLs last when ascending; match the other databases
+    if column.nullable and \
+            query.session.get_bind().dialect.name == 'postgresql':
+        key = key.nullslast() if descending else key.nullsfirst()
+    return query.order_by(
+        key, id_column.desc() if descending else id_column.asc())
+
+
+def keyset_paginate(query, sort_column, id_column, cursor=None, page_size=50,
+                    descending=False):
+    """
+    Return the page of query that follows cursor, ordered by sort_column
+
+    id_column breaks ties between equal sort values so that no row is skipped
+    or repeated between pages. The query's entities must include both columns
+    (as attributes named after them) so the next cursor can be read from the
+    last row.
+    """
+    if cursor is not None:
+        value, id = _decode(cursor, sort_column)
+        query = query.filter(_seek(sort_column, id_column, value, id,
+                                   descending))
+    query = _order(query, sort_column, id_column, descending)
+
+    # One row more than a page tells whether there is a next page, without
+    # a COUNT over the whole table
+    items = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        last = items[-1]
+        next_cursor = _encode([getattr(last, sort_column.key),
+                               getattr(last, id_column.key)])
+    return KeysetPage(items, page_size, sort_column.key, descending,
+                      cursor=cursor, next_cursor=next_cursor)
+
+
+def paginate_request(model, columns, sortable, filterable=(), default_sort=None,
+                     query=None, extra_columns=()):
+    """
+    Keyset paginate a projection of model from the request's query string
+
+    Recognised arguments are sort (one of sortable), desc=1, after (a cursor
+    from a previous page), per_page, and an equality filter for each name in
+    filterable. Only the named columns (plus extra_columns, e.g. labelled
+    subqueries) are selected, so rows are light-weight tuples rather than
+    full ORM objects.
+    """
+    table = model.__table__
+    sort = request.args.get('sort', default_sort or sortable[0])
+    if sort not in sortable:
+        raise ValueError(f'cannot sort by {sort!r}')
+    per_page = request.args.get('per_page',
+                                current_app.config['ADMIN_PAGE_SIZE'], type=int)
+    per_page = max(1, min(per_page, current_app.config['ADMIN_MAX_PAGE_SIZE']))
+
+    columns = list(columns)
+    for name in (sort, 'id'):
+        if name not in columns:
+            columns.append(name)
+    query = query if query is not None else model.query
+    query = query.with_entities(*[table.c[name] for name in columns],
+                                *extra_columns)
+    for name in filterable:
+        value = request.args.get(name)
+        if value:
+            column = table.c[name]
+            if column.type.python_type is int:
+                value = int(value)
+            query = query.filter(column == value)
+
+    page = keyset_paginate(query, table.c[sort], table.c.id,
+                           cursor=request.args.get('after') or None,
+                           page_size=per_page,
+                           descending=request.args.get('desc') == '1')
+    page.args = request.args.to_dict()
+    return page
@@ -0,0 +1,108 @@
+from collections import defaultdict
+
+from sqlalchemy.orm import aliased, contains_eager
+
+from .models import Account, ArchivedMeeting, Meeting, Region, Role, Room, \
+    Site, User
+
+# The one-to-many relationships (Account.users, Site.rooms, Room.meetings,
+# Role.users, ...) are lazy='dynamic', so they are queries that can't be
+# eager loaded, & the many-to-one backrefs load lazily. Walking either from
+# a list of rows costs one query per row. The helpers below load the common
+# list & detail shapes with a fixed number of queries instead.
+#
+# The shapes are outer joins, so the related rows load with contains_eager()
+# when whole objects are selected, & the *_NAMES columns can be selected
+# next to a projection of the rows' own columns (see admin.list_users).
+
+# Hosts & bookers are both users, so each is joined under a name of its own
+host = aliased(User, name='host')
+booker = aliased(User, name='booker')
+
+USER_NAMES = (Role.name.label('role'), Account.code.label('account'))
+SITE_NAMES = (Region.name.label('region'), Account.code.label('account'))
+ROOM_NAMES = (Site.code.label('site'), Region.name.label('region'),
+              Account.code.label('account'))
+MEETING_NAMES = (Room.name.label('room'), host.email.label('host'),
+                 booker.email.label('booker'), Account.code.label('account'))
+
+
+def users_with_role_and_account():
+    return User.query \
+        .outerjoin(Role, User.role_id == Role.id) \
+        .outerjoin(Account, User.account_id == Account.id) \
+        .options(contains_eager(User.role), contains_eager(User.account))
+
+
+def sites_with_region():
+    return Site.query \
+        .outerjoin(Region, Site.region_id == Region.id) \
+        .outerjoin(Account, Site.account_id == Account.id) \
+        .options(contains_eager(Site.region))
+
+
+def rooms_with_site():
+    """
+    Rooms with their site & the site's region loaded in the same query
+    """
+    return Room.query \
+        .outerjoin(Site, Room.site_id == Site.id) \
+        .outerjoin(Region, Site.region_id == Region.id) \
+        .outerjoin(Account, Room.account_id == Account.id) \
+        .options(contains_eager(Room.site).contains_eager(Site.region))
+
+
+def _with_people(query, model):
+    return query \
+        .outerjoin(Room, model.room_id == Room.id) \
+        .outerjoin(host, model.host_id == host.id) \
+        .outerjoin(booker, model.booker_id == booker.id) \
+        .outerjoin(Account, model.account_id == Account.id)
+
+
+def meetings_with_people():
+    """
+    Meetings with their room, host & booker loaded in the same query
+    """
+    return _with_people(Meeting.query, Meeting).options(
+        contains_eager(Meeting.room),
+        contains_eager(Meeting.host, alias=host),
+        contains_eager(Meeting.booker, alias=booker),
+        )
+
+
+def archived_meetings_with_people():
+    """
+    Archived meetings joined to their room, host & booker, for MEETING_NAMES
+    """
+    return _with_people(ArchivedMeeting.query, ArchivedMeeting)
+
+
+def group_by(query, key):
+    groups = defaultdict(list)
+    for obj in query:
+        groups[getattr(obj, key)].append(obj)
+    return groups
+
+
+def rooms_by_site(site_ids):
+    """
+    Return {site_id: [rooms]} for many sites with a single query
+    """
+    query = Room.query.filter(Room.site_id.in_(list(site_ids))) \
+        .order_by(Room.name)
+    return group_by(query, 'site_id')
+
+
+def meetings_by_room(room_ids, start=None, end=None):
+    """
+    Return {room_id: [meetings]} for many rooms with a single query,
+    optionally limited to the days in [start, end)
+    """
+    query = meetings_with_people().filter(Meeting.room_id.in_(list(room_ids)))
+    if start is not None:
+        query = query.filter(Meeting.date >= start)
+    if end is not None:
+        query = query.filter(Meeting.date < end)
+    return group_by(query.order_by(Meeting.date, Meeting.start_time),
+                    'room_id')
@@ -0,0 +1,183 @@
+import heapq
+from collections import defaultdict, namedtuple
+from datetime import timedelta
+
+from . import db
+from .models import MeetingSeries, SeriesException
+
+FREQUENCIES = ('daily', 'weekly')
+WEEKDAYS = ('MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU')
+
+Rule = namedtuple('Rule', 'frequency interval weekdays start_date until')
+Occurrence = namedtuple(
+    'Occurrence', 'series_id room_id date start_time end_time title')
+
+ONE_DAY = timedelta(days=1)
+
+
+def weekday_mask(weekdays):
+    """
+    Turn weekday numbers (Monday is 0) or names ('MO', 'TU'...) into a mask
+    """
+    mask = 0
+    for day in weekdays:
+        if isinstance(day, str):
+            day = WEEKDAYS.index(day.upper()[:2])
+        if not 0 <= day < 7:
+            raise ValueError(f'invalid weekday {day!r}')
+        mask |= 1 << day
+    return mask
+
+
+def rule_of(series):
+    return Rule(series.frequency, series.interval, series.weekdays,
+                series.start_date, series.until)
+
+
+def check_rule(rule):
+    if rule.frequency not in FREQUENCIES:
+        raise ValueError(f'frequency must be one of {", ".join(FREQUENCIES)}')
+    if not rule.interval or rule.interval < 1:
+        raise ValueError('interval must be at least 1')
+    if rule.frequency == 'weekly' and not rule.weekdays:
+        raise ValueError('a weekly series needs at least one weekday')
+    if rule.until < rule.start_date:
+        raise ValueError('a series must end on or after its first day')
+
+
+def occurs_on(rule, day):
+    """
+    True if the rule has an occurrence on day (ignoring exceptions)
+    """
+    if day < rule.start_date or (rule.until is not None and day > rule.until):
+        return False
+    if rule.frequency == 'daily':
+        return (day - rule.start_date).days % rule.interval == 0
+    # Weeks are counted from the Monday of the first week
+    first_monday = rule.start_date - timedelta(days=rule.start_date.weekday())
+    week = (day - first_monday).days // 7
+    return week % rule.interval == 0 and bool(rule.weekdays >> day.weekday() & 1)
+
+
+def dates(rule, start=None, end=None, skip=()):
+    """
+    Yield the days the rule occurs on within [start, end), in order
+
+    Only the requested window is walked, however long the series runs; a
+    rule without an end & no end given yields forever.
+    """
+    first = rule.start_date if start is None else max(start, rule.start_date)
+    last = rule.until
+    if end is not None:
+        last = end - ONE_DAY if last is None else min(end - ONE_DAY, last)
+    if rule.frequency == 'daily':
+        # Step straight from one occurrence to the next
+        offset = (first - rule.start_date).days % rule.interval
+        if offset:
+            first += timedelta(days=rule.interval - offset)
+        step = timedelta(days=rule.interval)
+    else:
+        step = ONE_DAY
+    day = first
+    while last is None or day <= last:
+        if (rule.frequency == 'daily' or occurs_on(rule, day)) \
+                and day not in skip:
+            yield day
+        day += step
+
+
+def until_for_count(rule, count):
+    """
+    Return the day of the count-th occurrence, to store a count as an end date
+    """
+    if count < 1:
+        raise ValueError('count must be at least 1')
+    for i, day in enumerate(dates(rule._replace(until=None)), 1):
+        if i == count:
+            return day
+
+
+def exception_dates(series_ids):
+    """
+    Return {series_id: {cancelled day, ...}} for series_ids with one query
+    """
+    skips = defaultdict(set)
+    series_ids = list(series_ids)
+    if series_ids:
+        rows = db.session.query(SeriesException.series_id,
+                                SeriesException.date) \
+            .filter(SeriesException.series_id.in_(series_ids))
+        for series_id, day in rows:
+            skips[series_id].add(day)
+    return skips
+
+
+def active(room_ids, start, end):
+    """
+    Query the series of room_ids that may occur within [start, end)
+    """
+    return MeetingSeries.query.filter(
+        MeetingSeries.room_id.in_(list(room_ids)),
+        MeetingSeries.start_date < end,
+        MeetingSeries.until >= start,
+        )
+
+
+def occurrences(series, start, end, skip=()):
+    for day in dates(rule_of(series), start, end, skip):
+        yield Occurrence(series.id, series.room_id, day, series.start_time,
+                         series.end_time, series.title)
+
+
+def expand(series_list, start, end):
+    """
+    Yield the occurrences of series_list within [start, end), by day & time
+
+    Exceptions for every series are read in one query; each series is then
+    expanded lazily & the generators are merged, so nothing outside the
+    window is ever computed.
+    """
+    series_list = list(series_list)
+    skips = exception_dates(series.id for series in series_list)
+    return heapq.merge(
+        *(occurrences(series, start, end, skips.get(series.id, ()))
+          for series in series_list),
+        key=lambda occurrence: (occurrence.date, occurrence.start_time))
+
+
+def overlapping_occurrences(room_ids, day, start_time, end_time,
+                            exclude_series_id=None):
+    """
+    Return the occurrences in room_ids on day overlapping [start_time, end_time)
+    """
+    query = active(room_ids, day, day + ONE_DAY).filter(
+        MeetingSeries.start_time < end_time,
+        MeetingSeries.end_time > start_time)
+    if exclude_series_id is not None:
+        query = query.filter(MeetingSeries.id != exclude_series_id)
+    return list(expand(query, day, day + ONE_DAY))
+
+
+def shared_days(rule, other, skip=(), other_skip=()):
+    """
+    Yield the days both rules occur on, walking only their common span
+    """
+    start = max(rule.start_date, other.start_date)
+    end = min(rule.until, other.until) + ONE_DAY
+    for day in dates(rule, start, end, skip):
+        if occurs_on(other, day) and day not in other_skip:
+            yield day
+
+
+def rrule(series):
+    """
+    Return the iCalendar RRULE value of a series
+    """
+    parts = [f'FREQ={series.frequency.upper()}',
+             f'INTERVAL={series.interval}',
+             f'UNTIL={series.until:%Y%m%d}T235959']
+    if series.frequency == 'weekly':
+        parts.append('BYDAY=' + ','.join(
+            name for i, name in enumerate(WEEKDAYS)
+            if series.weekdays >> i & 1))
+    return ';'.join(parts)
@@ -0,0 +1,459 @@
+import threading
+from collections import defaultdict, namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam, event, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, attributes
+
+from . import db
+from .archive import all_meetings
+from .database import insert_missing
+from .models import Meeting, MeetingSeries, Room, SeriesException, \
+    UsageDelta, UsageRollup
+from .recurrence import Rule, dates, exception_dates, occurs_on, rule_of
+
+SCOPES = ('room', 'site', 'account')
+PERIODS = ('day', 'month')
+
+rollups = UsageRollup.__table__
+deltas = UsageDelta.__table__
+rooms = Room.__table__
+
+# The totals of one period, pending deltas included
+Usage = namedtuple('Usage', 'period_start meetings minutes cost')
+
+
+def period_start(period, day):
+    if period == 'month':
+        return datetime(day.year, day.month, 1)
+    return datetime(day.year, day.month, day.day)
+
+
+def _room_info(connection, room_ids):
+    """
+    Return {room_id: (site_id, account_id, cost)} for room_ids
+    """
+    query = rooms.select().with_only_columns(
+        [rooms.c.id, rooms.c.site_id, rooms.c.account_id, rooms.c.cost]) \
+        .where(rooms.c.id.in_(list(room_ids)))
+    return {id: (site_id, account_id, cost or 0)
+            for id, site_id, account_id, cost in connection.execute(query)}
+
+
+def _accumulate(totals, room, room_id, day, meetings, minutes, cost):
+    site_id, account_id, _ = room
+    for scope, scope_id in zip(SCOPES, (room_id, site_id, account_id)):
+        if scope_id is None:
+            continue
+        for period in PERIODS:
+            key = (scope, scope_id, period, period_start(period, day))
+            total = totals[key]
+            total[0] += meetings
+            total[1] += minutes
+            total[2] += cost
+
+
+def _add_totals(connection, totals):
+    """
+    Add {(scope, scope_id, period, period_start): [meetings, minutes, cost]}
+    to the rollup rows, creating the missing ones
+    """
+    keys = []
+    updates = []
+    # A fixed order, so that transactions touching the same rows can't
+    # deadlock
+    for (scope, scope_id, period, start), (count, minutes, cost) \
+            in sorted(totals.items()):
+        if not (count or minutes or cost):
+            continue
+        keys.append(dict(scope=scope, scope_id=scope_id, period=period,
+                         period_start=start, meetings=0, minutes=0, cost=0))
+        updates.append(dict(key_scope=scope, key_scope_id=scope_id,
+                            key_period=period, key_start=start,
+                            add_meetings=count, add_minutes=minutes,
+                            add_cost=cost))
+    if not keys:
+        return
+    # Two statements for all rows: create the missing ones, then add to all
+    connection.execute(insert_missing(rollups, connection.dialect.name), keys)
+    connection.execute(rollups.update().where(and_(
+        rollups.c.scope == bindparam('key_scope'),
+        rollups.c.scope_id == bindparam('key_scope_id'),
+        rollups.c.period == bindparam('key_period'),
+        rollups.c.period_start == bindparam('key_start'),
+        )).values(
+        meetings=rollups.c.meetings + bindparam('add_meetings'),
+        minutes=rollups.c.minutes + bindparam('add_minutes'),
+        cost=rollups.c.cost + bindparam('add_cost'),
+        ), updates)
+
+
+def apply_changes(connection, changes, session=None):
+    """
+    Fold meeting changes into the rollups through connection
+
+    changes is an iterable of (sign, room_id, date, duration) with sign +1
+    for a booked meeting & -1 for a removed one. The deltas are merged per
+    rollup row first. Only the rows of the rooms themselves are updated in
+    this transaction; the site & account deltas are appended to usage_deltas,
+    which locks nothing other bookings wait on, & folded into their rollups
+    once session (db.session by default) commits.
+    """
+    changes = list(changes)
+    if not changes:
+        return
+    info = _room_info(connection, {room_id for _, room_id, _, _ in changes})
+    totals = defaultdict(lambda: [0, 0, 0])
+    for sign, room_id, day, duration in changes:
+        room = info.get(room_id)
+        if room is None:
+            continue
+        _accumulate(totals, room, room_id, day, sign, sign * duration,
+                    sign * duration * room[2])
+
+    _add_totals(connection, {key: total for key, total in totals.items()
+                             if key[0] == 'room'})
+    pending = [dict(scope=scope, scope_id=scope_id, period=period,
+                    period_start=start, meetings=count, minutes=minutes,
+                    cost=cost)
+               for (scope, scope_id, period, start), (count, minutes, cost)
+               in totals.items()
+               if scope != 'room' and (count or minutes or cost)]
+    if pending:
+        connection.execute(deltas.insert(), pending)
+        (session or db.session).info['rollup_deltas'] = True
+
+
+def fold(connection):
+    """
+    Add the pending site & account deltas to their rollups & delete them,
+    returning how many were folded
+
+    The deltas are locked first, so concurrent folds take turns rather than
+    counting a delta twice.
+    """
+    last = connection.execute(select([func.max(deltas.c.id)])).scalar()
+    if last is None:
+        return 0
+    rows = connection.execute(
+        select([deltas.c.scope, deltas.c.scope_id, deltas.c.period,
+                deltas.c.period_start, deltas.c.meetings, deltas.c.minutes,
+                deltas.c.cost])
+        .where(deltas.c.id <= last).with_for_update()).fetchall()
+    totals = defaultdict(lambda: [0, 0, 0])
+    for scope, scope_id, period, start, count, minutes, cost in rows:
+        total = totals[(scope, scope_id, period, start)]
+        total[0] += count
+        total[1] += minutes
+        total[2] += cost
+    _add_totals(connection, totals)
+    connection.execute(deltas.delete().where(deltas.c.id <= last))
+    return len(rows)
+
+
+class RollupFolder(object):
+    """
+    Folds the pending usage deltas into the rollups after commits
+
+    A fold runs ROLLUP_FOLD_DELAY seconds after the commit that appended
+    deltas, in a transaction of its own on a background thread, so the
+    shared site & account rows are updated once for all the bookings made
+    in the meantime. With a delay of 0 the fold runs right after the commit
+    instead. Deltas left behind by a failed fold or another process are
+    picked up by the next one; reads add them in until then.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.timer = None
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ROLLUP_FOLD_DELAY', 1.0)
+        self.app = app
+
+    def schedule(self):
+        delay = self.app.config['ROLLUP_FOLD_DELAY']
+        if not delay:
+            self.fold()
+            return
+        with self.lock:
+            if self.timer is not None:
+                return
+            self.timer = threading.Timer(delay, self._run)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def fold(self):
+        with db.engine.begin() as connection:
+            return fold(connection)
+
+    def _run(self):
+        with self.lock:
+            self.timer = None
+        app = self.app
+        with app.app_context():
+            try:
+                self.fold()
+            except OperationalError:
+                # Locked by another writer; try again later
+                self.schedule()
+            except Exception:
+                app.logger.exception('Could not fold usage deltas')
+            finally:
+                db.session.remove()
+
+
+rollup_folder = RollupFolder()
+
+
+def _load_old_value(target, value, oldvalue, initiator):
+    pass
+
+
+# History only knows an attribute's previous value if it was loaded before
+# being assigned; make assignment load it, so an update can be taken out of
+# the rollups it was counted in
+for _attribute in (Meeting.room_id, Meeting.date, Meeting.duration,
+                   MeetingSeries.room_id, MeetingSeries.duration,
+                   MeetingSeries.frequency, MeetingSeries.interval,
+                   MeetingSeries.weekdays, MeetingSeries.start_date,
+                   MeetingSeries.until):
+    event.listen(_attribute, 'set', _load_old_value, active_history=True)
+
+
+def _old(obj, name):
+    history = attributes.get_history(obj, name)
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(obj, name)
+
+
+def _series_changes(sign, rule, room_id, duration, skip):
+    return [(sign, room_id, day, duration) for day in dates(rule, skip=skip)]
+
+
+def _old_rule(series):
+    return Rule(*(_old(series, name) for name in (
+        'frequency', 'interval', 'weekdays', 'start_date', 'until')))
+
+
+def _series_of(session, exception):
+    series = exception.series
+    if series is None:
+        series = session.query(MeetingSeries).get(
+            _old(exception, 'series_id'))
+    return series
+
+
+def _recurring_changes(session):
+    """
+    Rollup deltas of the series & exceptions in the pending flush
+
+    Series are counted occurrence by occurrence, which their bounded span
+    keeps cheap. An exception cancels one occurrence, unless its series is
+    created or deleted in the same flush & so already accounts for it.
+    """
+    changes = []
+    for obj in session.new:
+        if isinstance(obj, MeetingSeries):
+            changes += _series_changes(1, rule_of(obj), obj.room_id,
+                                       obj.duration,
+                                       {e.date for e in obj.exceptions})
+        elif isinstance(obj, SeriesException):
+            series = _series_of(session, obj)
+            if series not in session.new and \
+                    occurs_on(rule_of(series), obj.date):
+                changes.append((-1, series.room_id, obj.date,
+                                series.duration))
+    for obj in session.deleted:
+        if isinstance(obj, MeetingSeries):
+            changes += _series_changes(-1, _old_rule(obj),
+                                       _old(obj, 'room_id'),
+                                       _old(obj, 'duration'),
+                                       {e.date for e in obj.exceptions})
+        elif isinstance(obj, SeriesException):
+            series = _series_of(session, obj)
+            if series is not None and series not in session.deleted and \
+                    occurs_on(rule_of(series), obj.date):
+                changes.append((1, series.room_id, obj.date, series.duration))
+    for obj in session.dirty:
+        if isinstance(obj, MeetingSeries) and any(
+                attributes.get_history(obj, name).has_changes()
+                for name in ('room_id', 'duration', 'frequency', 'interval',
+                             'weekdays', 'start_date', 'until')):
+            skip = {e.date for e in obj.exceptions}
+            changes += _series_changes(-1, _old_rule(obj),
+                                       _old(obj, 'room_id'),
+                                       _old(obj, 'duration'), skip)
+            changes += _series_changes(1, rule_of(obj), obj.room_id,
+                                       obj.duration, skip)
+    return changes
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_rollups(session, flush_context):
+    """
+    Write the rollup deltas of the meetings just flushed, in the same
+    transaction as the meetings themselves
+    """
+    changes = _recurring_changes(session)
+    for obj in session.new:
+        if isinstance(obj, Meeting):
+            changes.append((1, obj.room_id, obj.date, obj.duration))
+    for obj in session.deleted:
+        if isinstance(obj, Meeting):
+            changes.append((-1, _old(obj, 'room_id'), _old(obj, 'date'),
+                            _old(obj, 'duration')))
+    for obj in session.dirty:
+        if isinstance(obj, Meeting) and any(
+                attributes.get_history(obj, name).has_changes()
+                for name in ('room_id', 'date', 'duration')):
+            changes.append((-1, _old(obj, 'room_id'), _old(obj, 'date'),
+                            _old(obj, 'duration')))
+            changes.append((1, obj.room_id, obj.date, obj.duration))
+    if changes:
+        apply_changes(session.connection(), changes, session)
+
+
+@event.listens_for(Session, 'after_commit')
+def _fold_deltas(session):
+    if session.info.pop('rollup_deltas', False):
+        rollup_folder.schedule()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _forget_deltas(session):
+    session.info.pop('rollup_deltas', None)
+
+
+def rebuild(start=None, end=None, chunk_size=1000):
+    """
+    Recompute the rollups from the meetings & their archive, e.g. after a
+    backfill
+
+    start & end (dates, end exclusive) limit the rebuild; they're widened to
+    whole months so that monthly rows are recomputed from complete data.
+    Returns the number of rollup rows written.
+    """
+    if start is not None:
+        start = period_start('month', start)
+    if end is not None and end.day != 1:
+        # Round an exclusive end up to the first of the following month
+        end = period_start('month', period_start('month', end)
+                           + timedelta(days=32))
+    elif end is not None:
+        end = period_start('month', end)
+
+    connection = db.session.connection()
+    # Pending deltas of the range are counted again from the meetings
+    for table in (rollups, deltas):
+        delete = table.delete()
+        if start is not None:
+            delete = delete.where(table.c.period_start >= start)
+        if end is not None:
+            delete = delete.where(table.c.period_start < end)
+        connection.execute(delete)
+
+    # Aggregate to one row per room & day in SQL, then fan those out to the
+    # site & account scopes & to months in Python. Archived meetings still
+    # count.
+    source = all_meetings(start, end)
+    daily = db.session.query(
+            source.c.room_id, rooms.c.site_id, rooms.c.account_id,
+            rooms.c.cost, source.c.date, func.count(),
+            func.sum(source.c.duration)
+        ).join(rooms, source.c.room_id == rooms.c.id) \
+        .group_by(source.c.room_id, rooms.c.site_id, rooms.c.account_id,
+                  rooms.c.cost, source.c.date)
+
+    totals = defaultdict(lambda: [0, 0, 0])
+    for room_id, site_id, account_id, cost, day, count, minutes in daily:
+        _accumulate(totals, (site_id, account_id, cost or 0), room_id, day,
+                    count, minutes, minutes * (cost or 0))
+
+    # Series have no rows per occurrence, so they're expanded over the range
+    series = db.session.query(
+            MeetingSeries, rooms.c.site_id, rooms.c.account_id, rooms.c.cost
+        ).join(rooms, MeetingSeries.room_id == rooms.c.id)
+    if start is not None:
+        series = series.filter(MeetingSeries.until >= start)
+    if end is not None:
+        series = series.filter(MeetingSeries.start_date < end)
+    series = series.all()
+    skips = exception_dates(obj.id for obj, _, _, _ in series)
+    for obj, site_id, account_id, cost in series:
+        for day in dates(rule_of(obj), start, end, skips.get(obj.id, ())):
+            _accumulate(totals, (site_id, account_id, cost or 0), obj.room_id,
+                        day, 1, obj.duration, obj.duration * (cost or 0))
+
+    rows = [dict(scope=scope, scope_id=scope_id, period=period,
+                 period_start=first, meetings=count, minutes=minutes,
+                 cost=cost)
+            for (scope, scope_id, period, first), (count, minutes, cost)
+            in totals.items()]
+    for i in range(0, len(rows), chunk_size):
+        connection.execute(rollups.insert(), rows[i:i + chunk_size])
+    db.session.commit()
+    return len(rows)
+
+
+def _pending(scope, scope_ids, period, start=None, end=None):
+    query = db.session.query(
+            UsageDelta.scope_id, UsageDelta.period_start,
+            func.sum(UsageDelta.meetings), func.sum(UsageDelta.minutes),
+            func.sum(UsageDelta.cost)) \
+        .filter(UsageDelta.scope == scope,
+                UsageDelta.scope_id.in_(list(scope_ids)),
+                UsageDelta.period == period)
+    if start is not None:
+        query = query.filter(UsageDelta.period_start >= start)
+    if end is not None:
+        query = query.filter(UsageDelta.period_start < end)
+    return query.group_by(UsageDelta.scope_id, UsageDelta.period_start)
+
+
+def _totals(scope, scope_ids, period, start=None, end=None):
+    """
+    Return {(scope_id, period_start): Usage} with pending deltas added in
+    """
+    query = db.session.query(
+            UsageRollup.scope_id, UsageRollup.period_start,
+            UsageRollup.meetings, UsageRollup.minutes, UsageRollup.cost) \
+        .filter(UsageRollup.scope == scope,
+                UsageRollup.scope_id.in_(list(scope_ids)),
+                UsageRollup.period == period)
+    if start is not None:
+        query = query.filter(UsageRollup.period_start >= start)
+    if end is not None:
+        query = query.filter(UsageRollup.period_start < end)
+    totals = {}
+    for rows in (query, _pending(scope, scope_ids, period, start, end)):
+        for scope_id, first, count, minutes, cost in rows:
+            total = totals.get((scope_id, first))
+            if total is not None:
+                count += total.meetings
+                minutes += total.minutes
+                cost += total.cost
+            totals[(scope_id, first)] = Usage(first, count, minutes, cost)
+    return totals
+
+
+def usage(scope, scope_id, period, start=None, end=None):
+    """
+    Return the Usage of one room, site or account ordered by period
+    """
+    totals = _totals(scope, [scope_id], period, start, end)
+    return [totals[key] for key in sorted(totals)]
+
+
+def usage_by_scope(scope, scope_ids, period, start):
+    """
+    Return {scope_id: Usage} of the rooms, sites or accounts with usage in
+    the period starting at start
+    """
+    return {scope_id: total for (scope_id, _), total
+            in _totals(scope, scope_ids, period, start,
+                       start + timedelta(days=1)).items()}
@@ -0,0 +1,210 @@
+import re
+from collections import namedtuple
+
+from sqlalchemy import event, or_, text
+
+from . import db
+from .models import Room, Site, User
+
+KINDS = ('user', 'room', 'site')
+# Terms of a query beyond this are ignored, so a pasted paragraph can't
+# turn into an expensive MATCH
+MAX_TERMS = 8
+# Relative weight of a match in the label (email, room name, site code &
+# name) & in the detail (staff number, description, address) when ranking
+LABEL_WEIGHT = 10.0
+DETAIL_WEIGHT = 1.0
+# Ranking scores every match, which takes tens of milliseconds for the tens
+# of thousands of entries a first letter or two can match. Queries matching
+# more than this are too unspecific for ranking to tell much anyway, and
+# get label matches in index order instead.
+MAX_RANKED = 2000
+
+Hit = namedtuple('Hit', 'kind id label detail')
+
+# How each table is indexed: the number that tags its rowids, & SQL for the
+# label & detail of a row, with {row} standing for the table or NEW
+sources = {
+    'user': (1, User.__table__, '{row}.email',
+             "coalesce({row}.staff_number, '')",
+             ('email', 'staff_number', 'account_id')),
+    'room': (2, Room.__table__, '{row}.name',
+             "coalesce({row}.description, '')",
+             ('name', 'description', 'account_id')),
+    'site': (3, Site.__table__,
+             "{row}.code || ' ' || coalesce({row}.name, '')",
+             "coalesce({row}.address, '')",
+             ('code', 'name', 'address', 'account_id')),
+}
+
+# The kind & account are indexed as tokens so that MATCH narrows a search to
+# them, instead of filtering every match afterwards. A row's rowid is its id
+# times 4 plus its kind's tag, so triggers find its entry without a scan.
+# Prefixes of up to 5 characters, the ones typed before a typeahead has
+# narrowed anything down, are indexed too, rather than merging the entries
+# of every word they begin.
+CREATE_INDEX = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        kind, tenant, label, detail,
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '1 2 3 4 5')
+'''
+SEARCH = '''
+    SELECT rowid, kind, label, detail FROM search_index
+    WHERE search_index MATCH :match
+    ORDER BY bm25(search_index, 0.0, 0.0, :label_weight, :detail_weight)
+    LIMIT :limit
+'''
+SEARCH_UNRANKED = '''
+    SELECT rowid, kind, label, detail FROM search_index
+    WHERE search_index MATCH :match
+    LIMIT :limit
+'''
+COUNT = '''
+    SELECT count(*) FROM (
+        SELECT 1 FROM search_index WHERE search_index MATCH :match
+        LIMIT :cap)
+'''
+# Words as the unicode61 tokenizer splits them, which includes at '_'
+TOKEN = re.compile(r'[^\W_]+')
+
+
+def _entry(kind, row):
+    tag, table, label, detail, _ = sources[kind]
+    return (f"{row}.id * 4 + {tag}, '{kind}', "
+            f"'t' || coalesce({row}.account_id, 0), "
+            f"{label.format(row=row)}, {detail.format(row=row)}")
+
+
+def _triggers(kind):
+    tag, table, _, _, columns = sources[kind]
+    insert = ('INSERT INTO search_index (rowid, kind, tenant, label, detail) '
+              f'VALUES ({_entry(kind, "new")});')
+    delete = f'DELETE FROM search_index WHERE rowid = old.id * 4 + {tag};'
+    name = f'search_index_{table.name}'
+    return [
+        f'CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON '
+        f'{table.name} BEGIN {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {name}_update AFTER UPDATE OF '
+        f'{", ".join(columns)} ON {table.name} BEGIN {delete} {insert} END',
+        f'CREATE TRIGGER IF NOT EXISTS {name}_delete AFTER DELETE ON '
+        f'{table.name} BEGIN {delete} END',
+    ]
+
+
+def rebuild(connection):
+    """
+    Refill the search index from the users, rooms & sites tables
+    """
+    connection.execute(text('DELETE FROM search_index'))
+    for kind, (_, table, *_) in sources.items():
+        connection.execute(text(
+            'INSERT INTO search_index (rowid, kind, tenant, label, detail) '
+            f'SELECT {_entry(kind, table.name)} FROM {table.name}'))
+
+
+def supported(connection):
+    return connection.dialect.name == 'sqlite'
+
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_index(metadata, connection, **kw):
+    # Runs on every create_all; an index added to an existing database is
+    # filled from the rows already there. Binds without the indexed tables
+    # (e.g. replicas) are skipped.
+    if not supported(connection) or User.__table__ not in kw['tables']:
+        return
+    exists = connection.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE name = 'search_index'")).scalar()
+    connection.execute(text(CREATE_INDEX))
+    for kind in sources:
+        for statement in _triggers(kind):
+            connection.execute(text(statement))
+    if not exists:
+        rebuild(connection)
+
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_index(metadata, connection, **kw):
+    if supported(connection) and User.__table__ in kw['tables']:
+        connection.execute(text('DROP TABLE IF EXISTS search_index'))
+
+
+def _quote(term):
+    return '"' + term.replace('"', '""') + '"'
+
+
+def match_expression(terms, kinds, account_id=None, columns='label detail'):
+    """
+    Build the FTS5 query: every term as a prefix of a word in columns
+    """
+    parts = ['{%s} : (%s)' % (columns, ' AND '.join(
+        _quote(term) + '*' for term in terms))]
+    if set(kinds) != set(KINDS):
+        parts.append('kind : (%s)' % ' OR '.join(map(_quote, kinds)))
+    if account_id is not None:
+        parts.append(f'tenant : {_quote(f"t{account_id}")}')
+    return ' AND '.join(parts)
+
+
+def _search_like(terms, kinds, account_id, limit):
+    """
+    Prefix match on databases without FTS5, ordered by label only
+    """
+    models = {'user': (User, User.email, User.staff_number),
+              'room': (Room, Room.name, Room.description),
+              'site': (Site, Site.code, Site.name, Site.address)}
+    hits = []
+    for kind in kinds:
+        model, label, *columns = models[kind]
+        query = db.session.query(model).all_tenants()
+        for term in terms:
+            query = query.filter(or_(*(column.ilike(f'{term}%')
+                                       for column in [label] + columns)))
+        if account_id is not None:
+            query = query.filter(model.account_id == account_id)
+        for obj in query.order_by(label).limit(limit):
+            values = [getattr(obj, column.key) or '' for column in columns]
+            if kind == 'site':
+                hits.append(Hit(kind, obj.id, f'{obj.code} {values[0]}',
+                                values[1]))
+            else:
+                hits.append(Hit(kind, obj.id, getattr(obj, label.key),
+                                values[0]))
+    return sorted(hits, key=lambda hit: hit.label)[:limit]
+
+
+def search(query, kinds=KINDS, account_id=None, limit=10):
+    """
+    Return the users, rooms & sites matching query as typed so far, best
+    first
+
+    Every word of the query has to begin a word of the entry, so 'jo sm'
+    finds john.smith@example.com. account_id restricts the search to one
+    account. Matches in the label outrank matches in the detail; see
+    MAX_RANKED for queries matching too much to rank.
+    """
+    terms = TOKEN.findall(query.lower())[:MAX_TERMS]
+    kinds = [kind for kind in kinds if kind in KINDS]
+    if not terms or not kinds:
+        return []
+    connection = db.session.connection()
+    if not supported(connection):
+        return _search_like(terms, kinds, account_id, limit)
+    match = match_expression(terms, kinds, account_id)
+    matches = connection.execute(text(COUNT), dict(
+        match=match, cap=MAX_RANKED + 1)).scalar()
+    if matches <= MAX_RANKED:
+        rows = connection.execute(text(SEARCH), dict(
+            match=match, limit=limit, label_weight=LABEL_WEIGHT,
+            detail_weight=DETAIL_WEIGHT)).fetchall()
+    else:
+        rows = connection.execute(text(SEARCH_UNRANKED), dict(
+            match=match_expression(terms, kinds, account_id, 'label'),
+            limit=limit)).fetchall()
+        if len(rows) < limit:
+            seen = {row[0] for row in rows}
+            rows += [row for row in connection.execute(
+                text(SEARCH_UNRANKED), dict(match=match, limit=limit * 2))
+                     if row[0] not in seen][:limit - len(rows)]
+    return [Hit(kind, rowid // 4, label, detail)
+            for rowid, kind, label, detail in rows]
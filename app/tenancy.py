@@ -0,0 +1,103 @@
+from flask_login import current_user
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, attributes
+
+from . import db
+from .database import tenant_column
+from .models import Meeting, MeetingSeries, Room
+
+rooms = Room.__table__
+# Models that copy account_id from their room
+denormalized = (Meeting, MeetingSeries)
+
+
+class TenantViolation(Exception):
+    """
+    Raised when a session scoped to one account writes rows of another
+    """
+
+
+def _room_moved(obj):
+    return attributes.get_history(obj, 'room_id').has_changes() or \
+        attributes.get_history(obj, 'room').has_changes()
+
+
+@event.listens_for(Session, 'before_flush')
+def _copy_account_ids(session, flush_context, instances):
+    """
+    Set account_id of new or moved meetings & series from their room
+
+    Rooms already in the session are used as they are; the others are read
+    with one query for the whole flush.
+    """
+    pending = [obj for obj in session.new if isinstance(obj, denormalized)]
+    pending += [obj for obj in session.dirty
+                if isinstance(obj, denormalized) and _room_moved(obj)]
+    if not pending:
+        return
+    accounts = {}
+    room_ids = set()
+    for obj in pending:
+        room = obj.__dict__.get('room')
+        if room is not None:
+            accounts[obj] = room.account_id
+        elif obj.room_id is not None:
+            room_ids.add(obj.room_id)
+    if room_ids:
+        query = select([rooms.c.id, rooms.c.account_id]) \
+            .where(rooms.c.id.in_(list(room_ids)))
+        room_accounts = dict(session.connection().execute(query).fetchall())
+        for obj in pending:
+            if obj not in accounts and obj.room_id in room_accounts:
+                accounts[obj] = room_accounts[obj.room_id]
+    for obj, account_id in accounts.items():
+        if obj.account_id != account_id:
+            obj.account_id = account_id
+
+
+@event.listens_for(Session, 'before_flush')
+def _check_tenant(session, flush_context, instances):
+    account_id = session.info.get('tenant')
+    if account_id is None:
+        return
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        column = tenant_column(type(obj))
+        if column is None:
+            continue
+        values = attributes.get_history(obj, column.key).sum()
+        if any(value is not None and value != account_id
+               for value in values):
+            raise TenantViolation(
+                f'{obj!r} belongs to another account than {account_id}')
+
+
+@event.listens_for(Session, 'after_flush')
+def _follow_room_accounts(session, flush_context):
+    # A room moved to another account takes its meetings & series along
+    moved = [room for room in session.dirty if isinstance(room, Room)
+             and attributes.get_history(room, 'account_id').has_changes()]
+    connection = session.connection() if moved else None
+    for room in moved:
+        for model in denormalized:
+            table = model.__table__
+            connection.execute(
+                table.update().where(table.c.room_id == room.id)
+                .values(account_id=room.account_id))
+
+
+def init_app(app):
+    """
+    Scope the queries of requests by users other than admins to their account
+
+    Admins manage every account, so their queries are left unscoped; so are
+    anonymous requests, e.g. logins & signed calendar feeds.
+    """
+    app.config.setdefault('TENANT_SCOPING', True)
+    if not app.config['TENANT_SCOPING']:
+        return
+
+    @app.before_request
+    def scope_to_tenant():
+        if current_user.is_authenticated and not current_user.is_admin \
+                and current_user.account_id is not None:
+            db.session().info['tenant'] = current_user.account_id
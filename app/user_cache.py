@@ -0,0 +1,125 @@
+from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import db
+from .cache import LRUCache
+from .models import Account, Permission, Role, User
+
+
+class RoleSnapshot(object):
+    def __init__(self, role):
+        self.id = role.id
+        self.name = role.name
+        self.permissions = role.permissions or 0
+
+    def has_permission(self, perm):
+        return self.permissions & perm == perm
+
+    def __repr__(self):
+        return f'Role: {self.name}'
+
+
+class AccountSnapshot(object):
+    def __init__(self, account):
+        self.id = account.id
+        self.code = account.code
+        self.name = account.name
+        self.is_enabled = account.is_enabled
+
+    def __repr__(self):
+        return f'Account: {self.name}'
+
+
+class CachedUser(UserMixin):
+    """
+    A detached, read-only copy of a User together with its role & account
+
+    This is what current_user is for every request after login, so it must
+    not be used to modify the user; load the User model for that. The
+    effective permission bits are resolved once when the snapshot is built,
+    making can() & is_admin plain attribute lookups.
+    """
+    def __init__(self, user, role=None, account=None):
+        self.id = user.id
+        self.email = user.email
+        self.staff_number = user.staff_number
+        self.role_id = user.role_id
+        self.account_id = user.account_id
+        self.is_enabled = user.is_enabled
+        self.role = RoleSnapshot(role) if role is not None else None
+        self.account = AccountSnapshot(account) if account is not None else None
+        self.permissions = self.role.permissions if self.role is not None else 0
+        self.is_admin = self.can(Permission.ADMIN)
+
+    def can(self, perm):
+        return self.permissions & perm == perm
+
+    def __repr__(self):
+        return f'User: {self.email}'
+
+
+class UserCache(object):
+    """
+    Per-process cache of CachedUser objects for the Flask-Login user loader
+
+    A miss loads the user, role & account in one query. Entries are dropped
+    as soon as this process flushes a change to the user, its role or its
+    account; changes made by other processes are picked up once the entry's
+    USER_CACHE_TTL expires.
+    """
+    def __init__(self, app=None):
+        self.cache = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('USER_CACHE_SIZE', 10000)
+        app.config.setdefault('USER_CACHE_TTL', 60)
+        self.cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'],
+                              ttl=app.config['USER_CACHE_TTL'])
+
+    def load(self, id):
+        user = self.cache.get(id)
+        if user is None:
+            user = self._query(id)
+            if user is not None:
+                self.cache.set(id, user)
+        return user
+
+    def _query(self, id):
+        with db.replica():
+            row = db.session.query(User, Role, Account) \
+                .outerjoin(Role, User.role_id == Role.id) \
+                .outerjoin(Account, User.account_id == Account.id) \
+                .filter(User.id == id).first()
+        return CachedUser(*row) if row is not None else None
+
+    def invalidate(self, user_ids=(), role_ids=(), account_ids=()):
+        for id in user_ids:
+            self.cache.delete(id)
+        if role_ids or account_ids:
+            role_ids, account_ids = set(role_ids), set(account_ids)
+            self.cache.discard_if(
+                lambda user: user.role_id in role_ids
+                or user.account_id in account_ids)
+
+    def clear(self):
+        self.cache.clear()
+
+
+user_cache = UserCache()
+
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_users(session, flush_context):
+    """
+    Drop cached users affected by the User, Role & Account rows just flushed
+    """
+    changed = {User: set(), Role: set(), Account: set()}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        ids = changed.get(type(obj))
+        if ids is not None and obj.id is not None:
+            ids.add(obj.id)
+    if any(changed.values()):
+        user_cache.invalidate(changed[User], changed[Role], changed[Account])
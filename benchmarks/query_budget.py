@@ -0,0 +1,134 @@
+"""
+Fetch the list & dashboard pages under TestingConfig's QUERY_BUDGET
+
+    python -m benchmarks.query_budget
+
+A small data set is generated (see app/generator.py), part of it archived,
+& every page below is fetched with a test client, along with the page its
+Next link leads to. Pages show more rows than the budget allows queries,
+so one that loads a related row per row, rather than joining it in (see
+app/queries.py), fails with QueryBudgetExceeded. The number of statements
+each page ran is listed, with the statements of pages over the budget; the
+exit status is 1 if any page failed. Runs against an in-memory database
+unless TEST_DATABASE_URL is set.
+"""
+import os
+import re
+import sys
+from datetime import date, timedelta
+
+import click
+
+os.environ.setdefault('FLASK_ENV', 'testing')
+
+from app import create_app, db  # noqa: E402
+from app.archive import archive  # noqa: E402
+from app.generator import generate  # noqa: E402
+from app.instrumentation import (  # noqa: E402
+    QueryBudgetExceeded, count_queries)
+from app.models import Account, Role, User  # noqa: E402
+
+START = date(2026, 1, 5)
+PASSWORD = 'password'
+ADMIN_EMAIL = 'budget-admin@example.com'
+
+# More rows of each list than QUERY_BUDGET, so a query per row can't fit
+DATA = dict(accounts=2, sites_per_account=6, rooms_per_site=2, users=30,
+            meetings_per_room_per_day=2, days=3, weekends=True)
+
+ADMIN_PAGES = (
+    '/admin/users',
+    '/admin/users?sort=email&desc=1&per_page=20',
+    '/admin/users?account_id={account_id}',
+    '/admin/sites',
+    '/admin/rooms?sort=cost',
+    '/admin/rooms?account_id={account_id}',
+    '/admin/meetings?sort=date&desc=1&per_page=20',
+    '/admin/meetings?account_id={account_id}',
+    '/admin/meetings/archive?per_page=20',
+)
+USER_PAGES = (
+    '/dashboard',
+)
+
+
+def setup(app):
+    with app.app_context():
+        db.create_all()
+        generate(start=START, password=PASSWORD, **DATA)
+        # The first day goes to the archive, for its list
+        archive(cutoff=START + timedelta(days=1))
+        admin = Role.query.filter_by(name='Administrator').first()
+        db.session.add(User(email=ADMIN_EMAIL, password=PASSWORD,
+                            role_id=admin.id))
+        db.session.commit()
+        account_id = db.session.query(Account.id).order_by(Account.id) \
+            .first()[0]
+        email = db.session.query(User.email) \
+            .filter(User.account_id == account_id).order_by(User.id) \
+            .first()[0]
+        db.session.remove()
+    return account_id, email
+
+
+def client(app, email):
+    client = app.test_client()
+    response = client.post('/login', data=dict(email=email,
+                                                password=PASSWORD))
+    assert response.status_code == 302, response.status
+    return client
+
+
+def check(app, client, url):
+    """
+    Fetch one page & report it; return (failed, URL of the next page)
+    """
+    budget = app.config['QUERY_BUDGET']
+    error = after = None
+    statements = ()
+    try:
+        with count_queries() as counter:
+            response = client.get(url)
+        queries = counter.count
+        body = response.get_data(as_text=True)
+        if response.status_code != 200:
+            error = response.status
+        elif '<td>' not in body:
+            error = 'no rows to check'
+        else:
+            link = re.search(r'href="([^"]*(?:\?|&amp;)after=[^"]*)"', body)
+            after = link.group(1).replace('&amp;', '&') if link else None
+    except QueryBudgetExceeded as e:
+        queries = len(e.statements)
+        error = f'over the budget of {budget}'
+        statements = e.statements
+    click.echo(f'{queries:4} queries  {url}'
+               + (f'  FAILED: {error}' if error else ''))
+    for statement in statements:
+        click.echo(f'       {statement}')
+    return error is not None, after
+
+
+@click.command()
+def main():
+    app = create_app()
+    if app.config['QUERY_BUDGET'] is None:
+        raise click.ClickException('QUERY_BUDGET is not set; run with '
+                                   'FLASK_ENV=testing')
+    account_id, email = setup(app)
+    failed = 0
+    for pages, login in ((ADMIN_PAGES, ADMIN_EMAIL), (USER_PAGES, email)):
+        user = client(app, login)
+        for page in pages:
+            error, after = check(app, user, page.format(account_id=account_id))
+            failed += error
+            if after is not None:
+                failed += check(app, user, after)[0]
+    click.echo(f'{failed} page(s) failed.' if failed else 'All pages within '
+               f'the budget of {app.config["QUERY_BUDGET"]} queries.')
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+"""
+Benchmark the hot paths of the app against generated data sets
+
+    python -m benchmarks.run --size small --output results.json
+    python -m benchmarks.run --size small --size medium \\
+        --baseline benchmarks/baseline.json
+
+Each size is regenerated from scratch with a fixed seed (see app/generator.py)
+in BENCHMARK_DATABASE_URL, so runs on the same machine see the same data.
+Results are written as JSON; with --baseline, every benchmark whose
+throughput fell more than --tolerance below the baseline is listed & the exit
+status is 1. Refresh the baseline with --output benchmarks/baseline.json on
+the machine the comparisons run on.
+"""
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+import click
+
+os.environ.setdefault('FLASK_ENV', 'benchmark')
+
+from app import create_app, db  # noqa: E402
+from app.availability import find_free_slots  # noqa: E402
+from app.booking import find_conflicts  # noqa: E402
+from app.fragments import fragment_cache  # noqa: E402
+from app.generator import generate  # noqa: E402
+from app.importer import import_csv  # noqa: E402
+from app.search import search  # noqa: E402
+from app.models import Account, Meeting, Role, Room, Site, User  # noqa: E402
+from app.user_cache import user_cache  # noqa: E402
+
+SIZES = {
+    'small': dict(accounts=2, sites_per_account=2, rooms_per_site=5,
+                  users=200, meetings_per_room_per_day=4, days=20),
+    'medium': dict(accounts=10, sites_per_account=5, rooms_per_site=10,
+                   users=2000, meetings_per_room_per_day=6, days=30),
+    'large': dict(accounts=50, sites_per_account=5, rooms_per_site=20,
+                  users=20000, meetings_per_room_per_day=8, days=60),
+}
+
+# Fixed, so that every run books the same days
+START = date(2026, 1, 5)
+PASSWORD = 'password'
+ADMIN_EMAIL = 'bench-admin@example.com'
+
+benchmarks = []
+
+
+def benchmark(name, iterations, warmup=3, unit='ops'):
+    """
+    Register a benchmark; the function returns the operation to time, which
+    in turn returns the number of units it processed (default 1)
+    """
+    def decorator(f):
+        benchmarks.append((name, f, iterations, warmup, unit))
+        return f
+    return decorator
+
+
+def measure(op, iterations, warmup, unit):
+    for _ in range(warmup):
+        op()
+    timings = []
+    units = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        units += op() or 1
+        timings.append(time.perf_counter() - started)
+    timings.sort()
+    total = sum(timings)
+    return {
+        'iterations': iterations,
+        'unit': unit,
+        'throughput': units / total if total else 0.0,
+        'mean_ms': total / iterations * 1000,
+        'p50_ms': timings[len(timings) // 2] * 1000,
+        'p95_ms': timings[min(len(timings) - 1,
+                              int(len(timings) * 0.95))] * 1000,
+    }
+
+
+class Context(object):
+    """
+    The app & a sample of the generated ids the benchmarks draw from
+    """
+    def __init__(self, app, seed):
+        self.app = app
+        self.rng = random.Random(seed)
+        with app.app_context():
+            self.emails = [email for email, in db.session.query(User.email)
+                           .filter(User.email != ADMIN_EMAIL)
+                           .order_by(User.id).limit(1000)]
+            self.room_ids = [id for id, in db.session.query(Room.id)]
+            self.site_ids = [id for id, in db.session.query(Site.id)]
+            self.user_ids = [id for id, in db.session.query(User.id)]
+            self.account_ids = [id for id, in db.session.query(Account.id)]
+            self.days = sorted(day for day, in
+                               db.session.query(Meeting.date).distinct())
+            db.session.remove()
+
+    def client(self, email=None):
+        """
+        Return a test client, logged in as email if given
+        """
+        client = self.app.test_client()
+        if email is not None:
+            response = client.post('/login', data=dict(email=email,
+                                                        password=PASSWORD))
+            assert response.status_code == 302, response.status
+        return client
+
+    def get(self, client, url):
+        response = client.get(url)
+        assert response.status_code == 200, f'{url}: {response.status}'
+        response.close()
+
+
+@benchmark('login', iterations=20)
+def bench_login(ctx):
+    def op():
+        ctx.client(ctx.rng.choice(ctx.emails))
+    return op
+
+
+@benchmark('dashboard', iterations=200)
+def bench_dashboard(ctx):
+    clients = [ctx.client(email) for email in ctx.emails[:10]]
+
+    def op():
+        ctx.get(ctx.rng.choice(clients), '/dashboard')
+    return op
+
+
+@benchmark('admin_users', iterations=100)
+def bench_admin_users(ctx):
+    client = ctx.client(ADMIN_EMAIL)
+
+    def op():
+        # A different page every time, so the fragment cache doesn't answer
+        ctx.get(client, f'/admin/users?sort=email&per_page=50'
+                        f'&account_id={ctx.rng.choice(ctx.account_ids)}')
+    return op
+
+
+@benchmark('admin_meetings', iterations=100)
+def bench_admin_meetings(ctx):
+    client = ctx.client(ADMIN_EMAIL)
+
+    def op():
+        ctx.get(client, f'/admin/meetings?sort=date&desc=1&per_page=50'
+                        f'&room_id={ctx.rng.choice(ctx.room_ids)}')
+    return op
+
+
+@benchmark('admin_rooms', iterations=100)
+def bench_admin_rooms(ctx):
+    client = ctx.client(ADMIN_EMAIL)
+
+    def op():
+        ctx.get(client, f'/admin/rooms?sort=name&per_page=50'
+                        f'&site_id={ctx.rng.choice(ctx.site_ids)}')
+    return op
+
+
+@benchmark('import_meetings', iterations=5, warmup=1, unit='rows')
+def bench_import(ctx):
+    rows = 1000
+    # Imported meetings go after the generated ones, a fresh day each time
+    days = iter(range(1, 1000))
+
+    def op():
+        day = ctx.days[-1] + timedelta(days=next(days))
+        lines = ['title,room_id,host_id,date,start_time,duration']
+        # Rooms take turns, so no two rows overlap
+        rooms = len(ctx.room_ids)
+        for i in range(rows):
+            lines.append(f'Imported,{ctx.room_ids[i % rooms]},'
+                         f'{ctx.rng.choice(ctx.user_ids)},'
+                         f'{day:%Y-%m-%d},{i // rooms % 96 * 15},15')
+        stream = io.BytesIO('\n'.join(lines).encode())
+        with ctx.app.app_context():
+            report = import_csv(stream, 'meetings', chunk_size=1000)
+            db.session.remove()
+        assert report.imported == rows, report
+        return rows
+    return op
+
+
+@benchmark('conflict_check', iterations=500)
+def bench_conflicts(ctx):
+    def op():
+        start_time = ctx.rng.randrange(8 * 60, 18 * 60, 15)
+        with ctx.app.app_context():
+            find_conflicts(ctx.rng.choice(ctx.room_ids),
+                           ctx.rng.choice(ctx.days), start_time,
+                           start_time + 60)
+            db.session.remove()
+    return op
+
+
+@benchmark('free_slots', iterations=100)
+def bench_free_slots(ctx):
+    def op():
+        with ctx.app.app_context():
+            find_free_slots(60, site_id=ctx.rng.choice(ctx.site_ids),
+                            start=ctx.rng.choice(ctx.days), days=7,
+                            day_start=8 * 60, day_end=18 * 60)
+            db.session.remove()
+    return op
+
+
+@benchmark('search', iterations=500)
+def bench_search(ctx):
+    # Each keystroke of an email being typed into a typeahead
+    prefixes = [email[:n] for email in ctx.emails[:100]
+                for n in range(1, 8)]
+
+    def op():
+        with ctx.app.app_context():
+            search(ctx.rng.choice(prefixes),
+                   account_id=ctx.rng.choice(ctx.account_ids))
+            db.session.remove()
+    return op
+
+
+def prepare(app, size, seed):
+    """
+    Recreate the database & fill it with the data set for size
+    """
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user_cache.clear()
+        fragment_cache.backend.clear()
+        started = time.perf_counter()
+        report = generate(start=START, seed=seed, password=PASSWORD,
+                          **SIZES[size])
+        elapsed = time.perf_counter() - started
+        admin = Role.query.filter_by(name='Administrator').first()
+        db.session.add(User(email=ADMIN_EMAIL, password=PASSWORD,
+                            role_id=admin.id))
+        db.session.commit()
+        db.session.remove()
+    return report.counts, elapsed
+
+
+def run(app, size, seed, only=()):
+    counts, elapsed = prepare(app, size, seed)
+    ctx = Context(app, seed)
+    results = {}
+    for name, f, iterations, warmup, unit in benchmarks:
+        if only and name not in only:
+            continue
+        results[name] = measure(f(ctx), iterations, warmup, unit)
+        click.echo(f'{size:8} {name:18} '
+                   f'{results[name]["throughput"]:10.1f} {unit}/s  '
+                   f'p95 {results[name]["p95_ms"]:8.2f} ms', err=True)
+    return {'rows': counts, 'generate_seconds': elapsed,
+            'benchmarks': results}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print current against baseline throughput & return the regressions
+    """
+    regressions = []
+    click.echo(f'{"size":8} {"benchmark":18} {"baseline":>10} '
+               f'{"current":>10} {"change":>8}')
+    for size, current in results['sizes'].items():
+        previous = baseline.get('sizes', {}).get(size, {}).get('benchmarks', {})
+        for name, result in current['benchmarks'].items():
+            if name not in previous or not previous[name]['throughput']:
+                continue
+            before = previous[name]['throughput']
+            change = result['throughput'] / before - 1
+            flag = ''
+            if change < -tolerance:
+                regressions.append((size, name, change))
+                flag = '  REGRESSION'
+            click.echo(f'{size:8} {name:18} {before:10.1f} '
+                       f'{result["throughput"]:10.1f} {change:+8.1%}{flag}')
+    return regressions
+
+
+@click.command()
+@click.option('--size', 'sizes', multiple=True, default=['small'],
+              type=click.Choice(list(SIZES)), show_default=True,
+              help='Data set(s) to benchmark against.')
+@click.option('--only', multiple=True,
+              type=click.Choice([name for name, *_ in benchmarks]),
+              help='Run only these benchmarks.')
+@click.option('--seed', default=0, show_default=True)
+@click.option('--output', type=click.Path(dir_okay=False),
+              help='Write the results to this JSON file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False),
+              help='Compare the results with this JSON file.')
+@click.option('--tolerance', default=0.2, show_default=True,
+              help='Fraction of baseline throughput a benchmark may lose.')
+def main(sizes, only, seed, output, baseline, tolerance):
+    app = create_app()
+    results = {
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0],
+        'seed': seed,
+        'sizes': {size: run(app, size, seed, only) for size in sizes},
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance)
+        if regressions:
+            click.echo(f'{len(regressions)} benchmark(s) regressed by more '
+                       f'than {tolerance:.0%}.', err=True)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""
+Book the same rooms from many threads at once & check nothing overlaps
+
+    python -m benchmarks.stress_booking --threads 16 --bookings 200
+
+Every thread books random 15 minute aligned slots in a handful of rooms on
+one day through booking.reserve(), so most attempts collide. Afterwards the
+meetings table is searched for overlapping pairs; the exit status is 1 if
+there are any, or if the number of meetings doesn't match the bookings that
+succeeded. Runs against a fresh SQLite file unless BENCHMARK_DATABASE_URL
+is set.
+"""
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import date
+
+import click
+
+_, _path = tempfile.mkstemp(suffix='.db', prefix='stress-')
+os.environ.setdefault('BENCHMARK_DATABASE_URL', f'sqlite:///{_path}')
+os.environ.setdefault('FLASK_ENV', 'benchmark')
+
+from app import create_app, db  # noqa: E402
+from app.booking import BookingConflict, reserve  # noqa: E402
+from app.models import Account, Meeting, Room, Site  # noqa: E402
+
+DAY = date(2026, 1, 5)
+
+OVERLAPS = '''
+    SELECT count(*) FROM meetings a JOIN meetings b
+      ON a.room_id = b.room_id AND a.date = b.date AND a.id < b.id
+     AND a.start_time < b.end_time AND b.start_time < a.end_time
+'''
+
+
+def setup(app, rooms):
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        account = Account(code='STRESS', name='Stress test')
+        db.session.add(account)
+        db.session.flush()
+        site = Site(code='S1', account_id=account.id)
+        db.session.add(site)
+        db.session.flush()
+        room_ids = []
+        for i in range(rooms):
+            room = Room(name=f'R{i + 1}', site_id=site.id,
+                        account_id=account.id)
+            db.session.add(room)
+            db.session.flush()
+            room_ids.append(room.id)
+        db.session.commit()
+        db.session.remove()
+    return room_ids
+
+
+def worker(app, room_ids, bookings, seed, outcomes, lock):
+    rng = random.Random(seed)
+    counts = Counter()
+    for _ in range(bookings):
+        start_time = rng.randrange(8 * 60, 18 * 60, 15)
+        duration = rng.choice((15, 30, 60))
+        with app.app_context():
+            try:
+                reserve(rng.choice(room_ids), DAY, start_time, duration,
+                        title='Stress')
+                counts['booked'] += 1
+            except BookingConflict:
+                counts['conflict'] += 1
+            except Exception as e:
+                counts[f'error: {type(e).__name__}'] += 1
+            finally:
+                db.session.remove()
+    with lock:
+        outcomes.update(counts)
+
+
+@click.command()
+@click.option('--threads', default=16, show_default=True)
+@click.option('--bookings', default=200, show_default=True,
+              help='Booking attempts per thread.')
+@click.option('--rooms', default=4, show_default=True)
+@click.option('--seed', default=0, show_default=True)
+def main(threads, bookings, rooms, seed):
+    app = create_app()
+    room_ids = setup(app, rooms)
+    outcomes = Counter()
+    lock = threading.Lock()
+    workers = [threading.Thread(target=worker, args=(
+                   app, room_ids, bookings, seed + i, outcomes, lock))
+               for i in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        meetings = Meeting.query.count()
+        overlaps = db.session.execute(OVERLAPS).scalar()
+    attempts = threads * bookings
+    click.echo(f'{attempts} attempts in {elapsed:.2f}s '
+               f'({attempts / elapsed:.0f}/s) from {threads} threads')
+    for outcome, count in sorted(outcomes.items()):
+        click.echo(f'  {outcome}: {count}')
+    click.echo(f'{meetings} meetings, {overlaps} overlapping pairs')
+    if app.config['SQLALCHEMY_DATABASE_URI'] == f'sqlite:///{_path}':
+        os.remove(_path)
+    if overlaps or meetings != outcomes['booked']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,130 @@
 import os
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+
+def engine_options(uri):
+    """
+    Connection pool settings for SQLALCHEMY_ENGINE_OPTIONS
+
+    Every value can be overridden from the environment. File based SQLite
+    databases get a real pool too (SQLAlchemy otherwise opens a connection
+    per checkout), which keeps the pragmas applied on connect.
+    """
+    options = {
+        'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+        'pool_recycle': env_int('DB_POOL_RECYCLE', 1800),
+        'pool_size': env_int('DB_POOL_SIZE', 10),
+        'max_overflow': env_int('DB_MAX_OVERFLOW', 20),
+        'pool_timeout': env_int('DB_POOL_TIMEOUT', 30),
+    }
+    if uri.startswith('sqlite'):
+        if uri in ('sqlite://', 'sqlite:///:memory:'):
+            # Flask-SQLAlchemy keeps in-memory databases on a single connection
+            return {}
+        from sqlalchemy.pool import QueuePool
+        options['poolclass'] = QueuePool
+        # Pooled connections move between the threads of a worker
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
 class Config(object):
     # Put any configurations here that are common across all environments
-    pass
+
+    # Rows written per INSERT batch (& per commit) by the CSV importer
+    IMPORT_CHUNK_SIZE = 1000
+    # Row errors kept for the import report; later errors are only counted
+    IMPORT_MAX_ERRORS = 500
+
+    # Users cached per process by the Flask-Login user loader, & how many
+    # seconds a cached user may lag behind changes made by other processes
+    USER_CACHE_SIZE = 10000
+    USER_CACHE_TTL = 60
+
+    # Rows per page of the admin list views, & the most a client may ask for
+    ADMIN_PAGE_SIZE = 50
+    ADMIN_MAX_PAGE_SIZE = 500
+
+    # Pragmas run on every new SQLite connection. WAL lets readers carry on
+    # while a writer commits, & busy_timeout makes a writer wait for the lock
+    # instead of failing at once with "database is locked".
+    SQLITE_PRAGMAS = {
+        'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': env_int('SQLITE_BUSY_TIMEOUT', 5000),
+    }
+
+    # Rendered fragments & pages: 'lru' keeps them per process, 'redis'
+    # shares them between workers (FRAGMENT_CACHE_URL), None disables caching.
+    # With 'lru', changes made by other workers show after FRAGMENT_CACHE_TTL.
+    FRAGMENT_CACHE_BACKEND = os.environ.get('FRAGMENT_CACHE_BACKEND', 'lru')
+    FRAGMENT_CACHE_URL = os.environ.get('FRAGMENT_CACHE_URL')
+    FRAGMENT_CACHE_SIZE = 2048
+    FRAGMENT_CACHE_TTL = 300
+
+    # Passwords are hashed on a pool of PASSWORD_HASH_WORKERS threads with at
+    # most PASSWORD_HASH_QUEUE waiting; logins beyond that get a 503. Changing
+    # the method (e.g. 'pbkdf2:sha256:600000') or salt length rehashes each
+    # password at its owner's next login.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD',
+                                          'pbkdf2:sha256')
+    PASSWORD_SALT_LENGTH = env_int('PASSWORD_SALT_LENGTH', 8)
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 4)
+    PASSWORD_HASH_QUEUE = env_int('PASSWORD_HASH_QUEUE', 64)
+    PASSWORD_HASH_TIMEOUT = env_int('PASSWORD_HASH_TIMEOUT', 10)
+
+    # Per-endpoint latency, template & SQL timings shown on admin.stats, the
+    # number of recent requests percentiles are computed from, & the seconds
+    # after which a statement is logged as slow
+    REQUEST_STATS = os.environ.get('REQUEST_STATS', '0') == '1'
+    REQUEST_STATS_WINDOW = 1000
+    SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0.1))
+
+    # Scope the queries of users other than admins to their own account
+    # (see app/tenancy.py)
+    TENANT_SCOPING = os.environ.get('TENANT_SCOPING', '1') == '1'
+
+    # Background jobs (imports, rebuilds) run on JOB_WORKERS threads per
+    # process with at most JOB_QUEUE waiting; 0 workers runs them inline
+    JOB_WORKERS = env_int('JOB_WORKERS', 2)
+    JOB_QUEUE = env_int('JOB_QUEUE', 16)
+
+    # Seconds after a commit before site & account usage deltas are folded
+    # into the rollups in the background; 0 folds right after the commit
+    ROLLUP_FOLD_DELAY = float(os.environ.get('ROLLUP_FOLD_DELAY', 1.0))
+
+    # Most operations accepted by one request to api.meetings_batch
+    API_BATCH_LIMIT = env_int('API_BATCH_LIMIT', 500)
+
+    # Room status streams (feeds.site_status_events): seconds between
+    # keepalives, seconds after which a status is recomputed anyway to catch
+    # writes by other processes, & most open streams per process
+    LIVE_KEEPALIVE = env_int('LIVE_KEEPALIVE', 15)
+    LIVE_MAX_AGE = env_int('LIVE_MAX_AGE', 60)
+    LIVE_MAX_SUBSCRIBERS = env_int('LIVE_MAX_SUBSCRIBERS', 1000)
+
+    # Meetings on days more than ARCHIVE_AFTER_DAYS ago are moved to the
+    # meetings_archive table by 'flask archive meetings', ARCHIVE_BATCH_SIZE
+    # per transaction. Keep it above ICS_FEED_PAST_DAYS, as feeds only read
+    # the meetings table.
+    ARCHIVE_AFTER_DAYS = env_int('ARCHIVE_AFTER_DAYS', 365)
+    ARCHIVE_BATCH_SIZE = env_int('ARCHIVE_BATCH_SIZE', 1000)
+
+    # Days of past & future meetings included in the iCalendar feeds
+    ICS_FEED_PAST_DAYS = 30
+    ICS_FEED_FUTURE_DAYS = 365
+    # Days a subscribed feed URL keeps working before it must be renewed
+    ICS_FEED_TOKEN_DAYS = env_int('ICS_FEED_TOKEN_DAYS', 90)
+
+    # Names of SQLALCHEMY_BINDS that hold read-only replicas of the primary
+    # database. GET requests read from them unless the user wrote within the
+    # last READ_AFTER_WRITE_WINDOW seconds.
+    SQLALCHEMY_REPLICA_BINDS = []
+    READ_AFTER_WRITE_WINDOW = env_int('READ_AFTER_WRITE_WINDOW', 10)
 
 class DevelopmentConfig(Config):
     #DEBUG = True
@@ -13,9 +134,51 @@ class DevelopmentConfig(Config):
 
 class ProductionConfig(Config):
     #DEBUG = False
-    pass
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'DATABASE_URL', 'sqlite:///' + os.path.join(basedir, 'app.db'))
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # Comma separated replica URLs, e.g. a second SQLite file for testing
+    SQLALCHEMY_BINDS = {
+        f'replica{i}': url for i, url in enumerate(
+            filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(',')))
+        }
+    SQLALCHEMY_REPLICA_BINDS = sorted(SQLALCHEMY_BINDS)
+    SQLITE_PRAGMAS = dict(
+        Config.SQLITE_PRAGMAS,
+        # Negative cache_size is in KiB: 64 MiB of page cache per connection
+        cache_size=env_int('SQLITE_CACHE_SIZE', -64000),
+        mmap_size=env_int('SQLITE_MMAP_SIZE', 256 * 1024 * 1024),
+        temp_store='MEMORY',
+        )
+
+class TestingConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    # The in-memory database is private to one connection, so jobs run inline
+    # & rollup deltas are folded inline
+    JOB_WORKERS = 0
+    ROLLUP_FOLD_DELAY = 0
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    # Requests running more SQL statements than this fail, which catches
+    # N+1 query patterns; views can raise their own with @query_budget(n)
+    QUERY_BUDGET = 10
+
+class BenchmarkConfig(Config):
+    # Used by benchmarks/run.py: a file database configured like production,
+    # without CSRF or the query budget getting in the way of the measurements
+    WTF_CSRF_ENABLED = False
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_DATABASE_URI = os.environ.get(
+        'BENCHMARK_DATABASE_URL',
+        'sqlite:///' + os.path.join(basedir, 'benchmark.db'))
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    SQLITE_PRAGMAS = ProductionConfig.SQLITE_PRAGMAS
 
 app_config = {
     'development': DevelopmentConfig,
-    'production': ProductionConfig
-}
\ No newline at end of file
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+    'benchmark': BenchmarkConfig
+}
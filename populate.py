@@ -1,21 +1,12 @@
 from app import db
 #from datetime import datetime
 from app.models import *
+from app.generator import insert_regions
 
-# Add Region
-region = Region(code='hk', name='HONG KONG')
-db.session.add(region)
-region = Region(code='my', name='MALAYSIA')
-db.session.add(region)
-region = Region(code='sg', name='SINGAPORE')
-db.session.add(region)
-region = Region(code='th', name='THAILAND')
-db.session.add(region)
-region = Region(code='ca', name='CANADA')
-db.session.add(region)
-region = Region(code='us', name='UNITED STATES OF AMERICA')
-db.session.add(region)
-region = Region(code='cn', name='CHINA')
-db.session.add(region)
+# Add Regions with a single INSERT
+#
+# For accounts, sites, rooms, users & meetings at scale, use the generator:
+#   flask generate --accounts 100 --users 20000 --days 90
+insert_regions(db.session.connection())
 
-db.session.commit()
\ No newline at end of file
+db.session.commit()